@@ -0,0 +1,299 @@
+"""
+Headless batch runs of a model, fanned out over a pool of processes.
+
+Runs are the combinations of a grid of model parameters and a list of
+random seeds. Parameters are module-level names in the model file, set
+before its setup() is called (see the params argument of Simulator), e.g.
+with a model that reads a global gamma:
+
+    cellmodeller-batch Examples/ex1_simpleGrowth.py --param gamma=10,100 \\
+        --seeds 1 2 3 --max-cells 5000 --workers 4
+
+Each run is simulated in a fresh worker process, with its own OpenCL
+context, until any of its stop conditions (steps, cells, wall time) is
+met. Output goes to data/<name>/run-NNN, and a manifest.json next to the
+runs lists the parameters, seed, timing, stop reason and output files of
+each run. The manifest is rewritten as runs finish, so a sweep that is
+interrupted still has a record of the completed runs.
+
+Runs go on the device in CELLMODELLER_DEVICE (or --platform/--device), or
+are spread over several devices by a Devices.Scheduler with --devices, at
+most --per-device runs on each at once:
+
+    cellmodeller-batch model.py --seeds 1 2 3 4 --steps 1000 --devices all --per-device 2
+"""
+
+import os
+import sys
+import ast
+import glob
+import json
+import time
+import random
+import argparse
+import itertools
+import traceback
+import multiprocessing
+import numpy
+
+from CellModeller import Devices
+
+
+## The runs of a sweep, one for each combination of params (a dict of
+# parameter name: list of values) and seeds
+def makeRuns(params=None, seeds=None):
+    params = params or {}
+    names = sorted(params.keys())
+    runs = []
+    for values in itertools.product(*[params[name] for name in names]):
+        for seed in (seeds or [None]):
+            runs.append({'params': dict(zip(names, values)), 'seed': seed})
+    return runs
+
+
+## Run a model until a stop condition is met, returning a record of the run.
+# Any error in the run is caught and recorded, so that the rest of a sweep
+# carries on. pickleSteps, if given, overrides the model's own setting.
+def runOne(modelFile, dt=0.025, params=None, seed=None, steps=None, maxCells=None,
+           wallTime=None, outputDirName=None, saveOutput=True, pickleSteps=None,
+           checkpointFormat='pickle', platform=None, device=None, logFile=None, profile=False):
+    record = {'model': modelFile, 'params': params or {}, 'seed': seed,
+              'platform': platform, 'device': device, 'status': 'failed',
+              'outputDir': None, 'checkpoints': [], 'log': logFile}
+    (stdout, stderr) = (sys.stdout, sys.stderr)
+    log = open(logFile, 'w') if logFile else None
+    if log:
+        sys.stdout = sys.stderr = log
+    t0 = time.time()
+    try:
+        # Import here, so that OpenCL is only initialised in the workers
+        from CellModeller.Simulator import Simulator
+        if platform is None or device is None:
+            (record['platform'], record['device']) = Devices.deviceFromEnv()
+        if seed is not None:
+            random.seed(seed)
+            numpy.random.seed(seed)
+        sim = Simulator(modelFile, dt, pickleSteps=pickleSteps or 50, checkpointFormat=checkpointFormat,
+                        outputDirName=outputDirName, saveOutput=saveOutput,
+                        clPlatformNum=record['platform'], clDeviceNum=record['device'], params=params,
+                        profile=profile)
+        # models may turn output on or off in setup
+        sim.setSaveOutput(saveOutput)
+        if pickleSteps is not None:
+            sim.pickleSteps = pickleSteps
+        record['pickleSteps'] = sim.pickleSteps
+        record['outputDir'] = getattr(sim, 'outputDirPath', None)
+        t1 = time.time()
+        record['setupTime'] = t1-t0
+        while True:
+            if steps is not None and sim.stepNum >= steps:
+                record['stopReason'] = 'steps'
+                break
+            if maxCells is not None and len(sim.cellStates) >= maxCells:
+                record['stopReason'] = 'cells'
+                break
+            if wallTime is not None and time.time()-t1 >= wallTime:
+                record['stopReason'] = 'wallTime'
+                break
+            sim.step()
+        if sim.saveOutput:
+            # the final state, which the next step would have written
+            sim.writeOutput()
+        sim.flushOutput()
+        record['runTime'] = time.time()-t1
+        record['steps'] = sim.stepNum
+        record['cells'] = len(sim.cellStates)
+        record['stepsPerSec'] = sim.stepNum/record['runTime'] if record['runTime'] > 0 else None
+        if profile:
+            # per-phase totals, and the times of each step in a CSV file
+            record['profile'] = sim.profiler.summary()
+            profileFile = os.path.splitext(logFile)[0]+'-profile.csv' if logFile else 'profile.csv'
+            sim.profiler.writeCSV(profileFile)
+            record['profileFile'] = profileFile
+        record['status'] = 'done'
+    except Exception:
+        record['error'] = traceback.format_exc()
+        print(record['error'])
+    finally:
+        record['wallTime'] = time.time()-t0
+        if log:
+            (sys.stdout, sys.stderr) = (stdout, stderr)
+            log.close()
+    if record['outputDir']:
+        record['checkpoints'] = sorted(glob.glob(os.path.join(record['outputDir'], 'step-*')))
+    return record
+
+
+# Device slots (see Devices.Scheduler) free for runs in the worker processes
+_slots = None
+
+def _initWorker(slots):
+    global _slots
+    _slots = slots
+
+
+def _runWorker(args):
+    (index, kwargs) = args
+    # take a free device slot for this run, and give it back when done
+    slot = _slots.get()
+    try:
+        (kwargs['platform'], kwargs['device']) = slot
+        # the device of the run is also visible to the model (and any
+        # processes it starts)
+        os.environ[Devices.deviceEnvVar] = Devices.formatDevice(slot)
+        record = runOne(**kwargs)
+    finally:
+        _slots.put(slot)
+    record['index'] = index
+    return record
+
+
+## Run a sweep over a process pool, writing a manifest of the runs to
+# manifestFile (if given) as they finish. runs are as from makeRuns,
+# runArgs are passed to runOne for every run. Runs are placed on the
+# devices of scheduler (a Devices.Scheduler), by default workers runs at a
+# time on the platform and device in runArgs, or CELLMODELLER_DEVICE.
+# Returns the run records, in the order of runs.
+def runBatch(modelFile, runs, workers=None, name=None, manifestFile=None, scheduler=None, **runArgs):
+    modelFile = os.path.abspath(modelFile)
+    modelName = os.path.splitext(os.path.basename(modelFile))[0]
+    name = name or modelName + '-batch-' + time.strftime('%y-%m-%d-%H-%M-%S')
+    batchDir = os.path.join('data', name)
+    if 'CMPATH' in os.environ:
+        batchDir = os.path.join(os.environ['CMPATH'], batchDir)
+    os.makedirs(batchDir, exist_ok=True)
+    if manifestFile is None:
+        manifestFile = os.path.join(batchDir, 'manifest.json')
+    (platform, device) = (runArgs.pop('platform', None), runArgs.pop('device', None))
+    if scheduler is None:
+        (envPlatform, envDevice) = Devices.deviceFromEnv()
+        device = (envPlatform if platform is None else platform, envDevice if device is None else device)
+        scheduler = Devices.Scheduler([device], maxPerDevice=workers or os.cpu_count() or 1)
+    # one worker per device slot, unless there are fewer runs
+    workers = max(min(workers or len(scheduler), len(scheduler), len(runs)), 1)
+
+    tasks = []
+    for (i, run) in enumerate(runs):
+        kwargs = dict(runArgs)
+        kwargs.update(run)
+        kwargs['modelFile'] = modelFile
+        kwargs['outputDirName'] = os.path.join(name, 'run-%03i' % i)
+        kwargs['logFile'] = os.path.join(batchDir, 'run-%03i.log' % i)
+        tasks.append((i, kwargs))
+
+    manifest = {'model': modelFile, 'name': name, 'workers': workers,
+                'slots': [Devices.formatDevice(slot) for slot in scheduler],
+                'runArgs': runArgs, 'started': time.strftime('%Y-%m-%d %H:%M:%S'),
+                'runs': [None]*len(runs)}
+    t0 = time.time()
+    print("Running %i runs of %s on %i workers, output in %s" % (len(runs), modelName, workers, batchDir))
+    print("Device slots: %s" % ' '.join(manifest['slots']))
+    # spawn, so that workers do not inherit an OpenCL context, and one run
+    # per worker process so each starts with a fresh context and model
+    ctx = multiprocessing.get_context('spawn')
+    slots = ctx.Queue()
+    for slot in scheduler:
+        slots.put(slot)
+    pool = ctx.Pool(workers, initializer=_initWorker, initargs=(slots,), maxtasksperchild=1)
+    try:
+        for record in pool.imap_unordered(_runWorker, tasks):
+            manifest['runs'][record['index']] = record
+            manifest['wallTime'] = time.time()-t0
+            _writeManifest(manifestFile, manifest)
+            print("run %03i %-6s %s device=%i:%i steps=%s cells=%s %.1fs" % (record['index'], record['status'],
+                  json.dumps(record['params']), record['platform'], record['device'],
+                  record.get('steps'), record.get('cells'), record['wallTime']))
+        pool.close()
+    finally:
+        pool.terminate()
+        pool.join()
+    manifest['finished'] = time.strftime('%Y-%m-%d %H:%M:%S')
+    _writeManifest(manifestFile, manifest)
+    print("Batch finished in %.1fs, manifest written to %s" % (time.time()-t0, manifestFile))
+    return manifest['runs']
+
+
+def _writeManifest(filename, manifest):
+    tmp = filename + '.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(manifest, f, indent=1, default=str)
+    os.replace(tmp, filename)
+
+
+## Parse a parameter value from the command line as a python literal,
+# or a string if it is not one
+def _parseValue(s):
+    try:
+        return ast.literal_eval(s)
+    except (ValueError, SyntaxError):
+        return s
+
+
+def _parseParam(s):
+    if '=' not in s:
+        raise argparse.ArgumentTypeError("parameters are given as name=value1,value2,...")
+    (name, values) = s.split('=', 1)
+    return (name.strip(), [_parseValue(v) for v in values.split(',')])
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='cellmodeller-batch',
+                                     description="Run a CellModeller model over a grid of parameters and seeds, in parallel.")
+    parser.add_argument('model', help="model (.py) file")
+    parser.add_argument('--param', action='append', type=_parseParam, default=[], metavar='NAME=V1,V2,...',
+                        help="values of a module-level parameter of the model; runs are all combinations")
+    parser.add_argument('--params-file', help="JSON file of a list of parameter dicts, one per run (instead of --param)")
+    parser.add_argument('--seeds', type=int, nargs='+', help="random seeds, each parameter combination is run with each")
+    parser.add_argument('--steps', type=int, help="stop after this many steps")
+    parser.add_argument('--max-cells', type=int, help="stop when there are this many cells")
+    parser.add_argument('--wall-time', type=float, help="stop after this many seconds of simulation")
+    parser.add_argument('--workers', type=int,
+                        help="number of worker processes (default: number of CPUs, or of device slots with --devices)")
+    parser.add_argument('--dt', type=float, default=0.025, help="time step")
+    parser.add_argument('--pickle-steps', type=int,
+                        help="steps between output files (default: the model's, or 50)")
+    parser.add_argument('--checkpoint-format', choices=['pickle', 'npz'], default='pickle')
+    parser.add_argument('--no-output', action='store_true', help="don't write output files")
+    parser.add_argument('--profile', action='store_true',
+                        help="time the phases of each step, into the manifest and run-NNN-profile.csv")
+    parser.add_argument('--platform', type=int, help="OpenCL platform number (default from CELLMODELLER_DEVICE, or 0)")
+    parser.add_argument('--device', type=int, help="OpenCL device number (default from CELLMODELLER_DEVICE, or 0)")
+    parser.add_argument('--devices', metavar='P:D,...',
+                        help="schedule runs over these devices, or 'all' (CELLMODELLER_DEVICES restricts which)")
+    parser.add_argument('--per-device', type=int, default=1, help="maximum concurrent runs per device, with --devices")
+    parser.add_argument('--mem-per-sim', type=float, help="device memory needed by a run (MB), to limit runs per device")
+    parser.add_argument('--policy', choices=['roundRobin', 'memory'], default='roundRobin',
+                        help="assign device slots round robin, or to the device with the most memory left")
+    parser.add_argument('--name', help="name of the batch output directory in data/")
+    parser.add_argument('--manifest', help="manifest file (default: manifest.json in the batch directory)")
+    args = parser.parse_args(argv)
+
+    if args.steps is None and args.max_cells is None and args.wall_time is None:
+        parser.error("at least one of --steps, --max-cells and --wall-time is needed")
+    if args.params_file:
+        with open(args.params_file) as f:
+            runs = [{'params': p, 'seed': seed} for p in json.load(f) for seed in (args.seeds or [None])]
+    else:
+        runs = makeRuns(dict(args.param), args.seeds)
+
+    scheduler = None
+    if args.devices:
+        devices = None if args.devices == 'all' else args.devices.split(',')
+        memPerSim = args.mem_per_sim*1024*1024 if args.mem_per_sim else None
+        scheduler = Devices.Scheduler(devices, maxPerDevice=args.per_device, memPerSim=memPerSim,
+                                      policy=args.policy)
+    records = runBatch(args.model, runs, workers=args.workers, name=args.name, manifestFile=args.manifest,
+                       scheduler=scheduler,
+                       dt=args.dt, steps=args.steps, maxCells=args.max_cells, wallTime=args.wall_time,
+                       saveOutput=not args.no_output, pickleSteps=args.pickle_steps,
+                       checkpointFormat=args.checkpoint_format, platform=args.platform, device=args.device,
+                       profile=args.profile)
+    failed = [r for r in records if r['status'] != 'done']
+    if failed:
+        print("%i of %i runs failed, see their logs" % (len(failed), len(records)))
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -206,22 +206,114 @@ void cyl_inv_inertia_tensor(float muA, float l, float4 axis, float4 res[]) {
 
 
 
+// bucket of the spatial hash grid of size hash_size (a power of 2) holding
+// grid square g (of colony g.w)
+int grid_hash(const int4 g, const int hash_size)
+{
+  uint h = ((uint)g.x*73856093u) ^ ((uint)g.y*19349663u) ^ ((uint)g.z*83492791u) ^
+           ((uint)g.w*2654435761u);
+  return (int)(h & (uint)(hash_size-1));
+}
+
 // Set the sq of each cell based on its position.
+// With hash_size = 0 sqs are indices into the dense x,y grid given by
+// grid_(x,y)_(min,max), otherwise they are buckets of a spatial hash of the
+// x,y,z grid squares and colony, which are kept in cell_grid.
 __kernel void bin_cells(const int grid_x_min,
                         const int grid_x_max,
                         const int grid_y_min,
                         const int grid_y_max,
                         const float grid_spacing,
+                        const int hash_size,
                         __global const float4* centers,
+                        __global const int* colonies,
+                        __global int4* cell_grid,
                         __global int* sqs)
 {
   int i = get_global_id(0);
-  int x = (int)floor(centers[i].x / grid_spacing) - grid_x_min;
-  int y = (int)floor(centers[i].y / grid_spacing) - grid_y_min;
+  if (hash_size) {
+    int4 g = (int4)((int)floor(centers[i].x / grid_spacing),
+                    (int)floor(centers[i].y / grid_spacing),
+                    (int)floor(centers[i].z / grid_spacing), colonies[i]);
+    cell_grid[i] = g;
+    sqs[i] = grid_hash(g, hash_size);
+    return;
+  }
+  // clamped, so that every sq is in [0, n_sqs) even if rounding puts a
+  // cell on the grid's edge just outside it
+  int x = clamp((int)floor(centers[i].x / grid_spacing) - grid_x_min, 0, grid_x_max-grid_x_min-1);
+  int y = clamp((int)floor(centers[i].y / grid_spacing) - grid_y_min, 0, grid_y_max-grid_y_min-1);
   sqs[i] = y*(grid_x_max-grid_x_min) + x;
 }
 
 
+// Find the sqs neighbouring cell i (including its own), returning how many.
+// For the dense grid these are the (up to) 9 surrounding squares in x,y, for
+// the hash grid the buckets of the 27 surrounding squares in x,y,z, each
+// listed once even if several squares share a bucket.
+int neighbour_sqs(const int i,
+                  const int grid_x_min,
+                  const int grid_x_max,
+                  const int grid_y_min,
+                  const int grid_y_max,
+                  const int hash_size,
+                  __global const int* sqs,
+                  __global const int4* cell_grid,
+                  int nbr_sqs[27])
+{
+  int n = 0;
+  if (hash_size) {
+    int4 g = cell_grid[i];
+    for (int dz = -1; dz < 2; dz++) {
+      for (int dy = -1; dy < 2; dy++) {
+        for (int dx = -1; dx < 2; dx++) {
+          int sq = grid_hash(g + (int4)(dx, dy, dz, 0), hash_size);
+          int seen = 0;
+          for (int m = 0; m < n; m++)
+            seen |= (nbr_sqs[m] == sq);
+          if (!seen)
+            nbr_sqs[n++] = sq;
+        }
+      }
+    }
+    return n;
+  }
+
+  // what square are we in?
+  int grid_x_range = grid_x_max-grid_x_min;
+  int grid_y_range = grid_y_max-grid_y_min;
+  int sq_row = sqs[i] / grid_x_range; // square row
+  int sq_col = sqs[i] % grid_x_range; // square col
+
+  // our square and the eight squares surrounding it
+  // (fewer squares if we're on an edge)
+  for (int row = max(0, sq_row-1); row < min((int)(sq_row+2), grid_y_range); row++)
+    for (int col = max(0, sq_col-1); col < min((int)(sq_col+2), grid_x_range); col++)
+      nbr_sqs[n++] = row*grid_x_range + col;
+  return n;
+}
+
+
+// find the start of each sq in the sorted list of cell sqs, as
+// numpy.searchsorted(sorted_sqs, arange(n_sqs), side='left')
+__kernel void find_sq_starts(const int n_cells,
+                             const int n_sqs,
+                             __global const int* sorted_sqs,
+                             __global int* sq_inds)
+{
+  int i = get_global_id(0);
+  int sq = sorted_sqs[i];
+  int prev_sq = i > 0 ? sorted_sqs[i-1] : -1;
+  // the sqs after the previous cell's, up to this one, start here
+  for (int s = prev_sq+1; s <= sq; s++)
+    sq_inds[s] = i;
+  // any sqs after the last cell's are empty
+  if (i == n_cells-1)
+    for (int s = sq+1; s < n_sqs; s++)
+      sq_inds[s] = n_cells;
+}
+
+
 // find the closest points on two line segments
 void closest_points_on_segments(const float4 r_a,  // center of first segment
                                 const float4 r_b,  // center of second segment
@@ -350,6 +442,17 @@ float pt_to_sphere_dist(float4 v, float rad, float4 p)
   return length(p - v) - rad;
 }
 
+// Slot for a new contact of cell i, which has k contacts so far, or -1 if
+// it already has max_contacts (counted in overflow, for the host to report)
+int new_contact(int i, const int max_contacts, int* k, __global int* overflow)
+{
+  if (*k >= max_contacts) {
+    atomic_inc(overflow);
+    return -1;
+  }
+  return i*max_contacts + (*k)++;
+}
+
 __kernel void find_sphere_contacts(const int max_cells,
                                   const int max_contacts,
                                   const int n_spheres,
@@ -368,7 +471,8 @@ __kernel void find_sphere_contacts(const int max_cells,
                                   __global float4* pts,
                                   __global float4* norms,
                                   __global float* reldists,
-                                  __global float* stiff)
+                                  __global float* stiff,
+                                  __global int* overflow)
 {
   int i = get_global_id(0);
 
@@ -396,13 +500,10 @@ __kernel void find_sphere_contacts(const int max_cells,
     bool two_pts = ((cti1 >= 0) || (dist1<0.f) ) && ( (cti2 >= 0) || (dist2<0.f) );
     float stiffness = two_pts*ISQRT2 + (!two_pts)*1.0;
 
+    // need to make a new contact?
+    if (cti1 < 0 && dist1<0.f) cti1 = new_contact(i, max_contacts, &k, overflow);
     // if we're in contact, or we were in contact, recompute
-    if ((cti1 >= 0) || (dist1<0.f) ){
-      // need to make a new contact
-      if (cti1 < 0) {
-        cti1 = i*max_contacts+k;
-        k++;
-      }
+    if (cti1 >= 0) {
 
       frs[cti1] = i;
       tos[cti1] = to1;
@@ -413,11 +514,8 @@ __kernel void find_sphere_contacts(const int max_cells,
       stiff[cti1] = stiffness*sphere_coeffs[n];
     }
 
-    if ( (cti2 >= 0) || (dist2<0.f) ){
-      if (cti2 < 0) {
-        cti2 = i*max_contacts+k;
-        k++;
-      }
+    if (cti2 < 0 && dist2<0.f) cti2 = new_contact(i, max_contacts, &k, overflow);
+    if (cti2 >= 0) {
 
       frs[cti2] = i;
       tos[cti2] = to2;
@@ -449,7 +547,8 @@ __kernel void find_plane_contacts(const int max_cells,
                                   __global float4* pts,
                                   __global float4* norms,
                                   __global float* reldists,
-                                  __global float* stiff)
+                                  __global float* stiff,
+                                  __global int* overflow)
 {
   int i = get_global_id(0);
 
@@ -480,13 +579,10 @@ __kernel void find_plane_contacts(const int max_cells,
     bool two_pts = ((cti1 >= 0) || (dist1<0.f) ) && ( (cti2 >= 0) || (dist2<0.f) );
     float stiffness = two_pts*ISQRT2 + (!two_pts)*1.0;
 
+    // need to make a new contact?
+    if (cti1 < 0 && dist1<0.f) cti1 = new_contact(i, max_contacts, &k, overflow);
     // if we're in contact, or we were in contact, recompute
-    if ((cti1 >= 0) || (dist1<0.f) ){
-      // need to make a new contact
-      if (cti1 < 0) {
-        cti1 = i*max_contacts+k;
-        k++;
-      }
+    if (cti1 >= 0) {
 
       frs[cti1] = i;
       tos[cti1] = to1;
@@ -497,11 +593,8 @@ __kernel void find_plane_contacts(const int max_cells,
       stiff[cti1] = stiffness*plane_coeffs[n];
     }
 
-    if ( (cti2 >= 0) || (dist2<0.f) ){
-      if (cti2 < 0) {
-        cti2 = i*max_contacts+k;
-        k++;
-      }
+    if (cti2 < 0 && dist2<0.f) cti2 = new_contact(i, max_contacts, &k, overflow);
+    if (cti2 >= 0) {
 
       frs[cti2] = i;
       tos[cti2] = to2;
@@ -516,22 +609,77 @@ __kernel void find_plane_contacts(const int max_cells,
 }
 
 
+// Does cell a have a contact to cell b?
+bool has_contact(int a, int b, const int max_contacts,
+                 __global const int* n_cts, __global const int* tos)
+{
+  for (int m = a*max_contacts; m < a*max_contacts+n_cts[a]; m++) {
+    if (tos[m] == b) return true;
+  }
+  return false;
+}
+
+// The candidate contacts (Verlet list) of each cell: the cells in its own
+// and the surrounding grid squares that are within touching distance plus
+// skin, or that it already has a contact with either way. Contacts are
+// then looked for only among the candidates, until a cell has moved more
+// than half the skin. Cells of other colonies are never candidates.
+// n_cands is the number of candidates, which may be more than max_cands,
+// in which case only the first max_cands are kept.
+__kernel void find_candidates(const int n_cells,
+                              const int grid_x_min,
+                              const int grid_x_max,
+                              const int grid_y_min,
+                              const int grid_y_max,
+                              const int hash_size,
+                              const int n_sqs,
+                              const int max_contacts,
+                              const int max_cands,
+                              const float skin,
+                              __global const float4* centers,
+                              __global const float* lens,
+                              __global const float* rads,
+                              __global const int* colonies,
+                              __global const int* sqs,
+                              __global const int4* cell_grid,
+                              __global const int* sorted_ids,
+                              __global const int* sq_inds,
+                              __global const int* n_cts,
+                              __global const int* tos,
+                              __global int* cands,
+                              __global int* n_cands)
+{
+  int i = get_global_id(0);
+  int k = 0;
+
+  int nbr_sqs[27];
+  int n_nbr_sqs = neighbour_sqs(i, grid_x_min, grid_x_max, grid_y_min, grid_y_max,
+                                hash_size, sqs, cell_grid, nbr_sqs);
+  for (int s = 0; s < n_nbr_sqs; s++) {
+    int sq = nbr_sqs[s];
+    for (int n = sq_inds[sq]; n < (sq < n_sqs-1 ? sq_inds[sq+1] : n_cells); n++) {
+      int j = sorted_ids[n];
+      if (j == i || colonies[j] != colonies[i]) continue;
+      if (length(centers[i]-centers[j]) > 0.5f*(lens[i]+lens[j])+rads[i]+rads[j]+MARGIN+skin &&
+          !(j > i ? has_contact(i, j, max_contacts, n_cts, tos) : has_contact(j, i, max_contacts, n_cts, tos)))
+        continue;
+      if (k < max_cands) cands[i*max_cands+k] = j;
+      k++;
+    }
+  }
+  n_cands[i] = k;
+}
+
+
 //
-__kernel void find_contacts(const int max_cells,
-                            const int n_cells,
-                            const int grid_x_min,
-                            const int grid_x_max,
-                            const int grid_y_min,
-                            const int grid_y_max,
-                            const int n_sqs,
-                            const int max_contacts,
+__kernel void find_contacts(const int max_contacts,
+                            const int max_cands,
                             __global const float4* centers,
                             __global const float4* dirs,
                             __global const float* lens,
                             __global const float* rads,
-                            __global const int* sqs,
-                            __global const int* sorted_ids,
-                            __global const int* sq_inds,
+                            __global const int* cands,
+                            __global const int* n_cands,
                             __global int* n_cts,
                             __global int* frs,
                             __global int* tos,
@@ -540,7 +688,8 @@ __kernel void find_contacts(const int max_cells,
                             __global float4* norms,
                             __global float* reldists,
                             __global float* stiff,
-                            __global float* overlap)
+                            __global float* overlap,
+                            __global int* overflow)
 {
   // our id
   int i = get_global_id(0);
@@ -548,96 +697,80 @@ __kernel void find_contacts(const int max_cells,
   // collision count
   int k = n_cts[i]; //keep existing contacts
 
-  // what square are we in?
-  int grid_x_range = grid_x_max-grid_x_min;
-  int grid_y_range = grid_y_max-grid_y_min;
-  int sq_row = sqs[i] / grid_x_range; // square row
-  int sq_col = sqs[i] % grid_x_range; // square col
-
-  // loop through our square and the eight squares surrounding it
-  // (fewer squares if we're on an edge)
-  for (int row = max(0, sq_row-1); row < min((int)(sq_row+2), grid_y_range); row++) {
-    for (int col = max(0, sq_col-1); col < min((int)(sq_col+2), grid_x_range); col++) {
+  // loop through our candidates
+  int end = i*max_cands + min(n_cands[i], max_cands);
+  for (int c = i*max_cands; c < end; c++) {
 
-      // what square is this?
-      int sq = row*grid_x_range + col;
+    int j = cands[c]; // the neighboring cell
 
-      // loop through all the cell ids in the current square (but
-      // don't go past the end of the list)
-      for (int n = sq_inds[sq]; n < (sq < n_sqs-1 ? sq_inds[sq+1] : n_cells); n++) {
+    if (j<=i) continue; // we can't collide with ourself, only find low -> hi contacts
 
-        int j = sorted_ids[n]; // the neighboring cell
+    // Look for any existing contacts, count them, and store idx's
+    int n_existing_cts=0;
+    int existing_cts_idx[2];
+    for (int m=i*max_contacts; m<i*max_contacts+n_cts[i]; m++)
+    {
+      if (tos[m]==j)
+      {
+         existing_cts_idx[n_existing_cts++] = m;
+      }
+    }
 
-        if (j<=i) continue; // we can't collide with ourself, only find low -> hi contacts
+    // Are we within possible touching distance, or is there an existing contact to update?
+    if (length(centers[i]-centers[j]) > 0.5*(lens[i]+lens[j])+rads[i]+rads[j]+MARGIN && n_existing_cts==0)
+    {
+      // if not...
+      continue;
+    }
 
-        // Look for any existing contacts, count them, and store idx's
-        int n_existing_cts=0;
-        int existing_cts_idx[2];
-        for (int m=i*max_contacts; m<i*max_contacts+n_cts[i]; m++)
-        {
-          if (tos[m]==j)
-          {
-             existing_cts_idx[n_existing_cts++] = m;
-          }
-        }
+    // if so, find closest points
+    float4 pi, pj; // pi is point on our line seg, pj point on other
+    float4 pi2, pj2; // optional second points
+    int two_pts = 0; // are there two contacts?
+    closest_points_on_segments(centers[i], centers[j],
+                               dirs[i], dirs[j],
+                               lens[i], lens[j],
+                               &pi, &pj, &pi2, &pj2, &two_pts);
+
+    float4 v_ij = pj-pi; // vector between closest points
+    float dist = length(v_ij) - (rads[i]+rads[j]);
+    float4 norm = normalize(v_ij); // normal on our cell at the contact
+    float4 pt = pi + rads[i]*norm; // point on the capsule surface
+      
+    int ct_i; // index of a new contact
 
-        // Are we within possible touching distance, or is there an existing contact to update?
-        if (length(centers[i]-centers[j]) > 0.5*(lens[i]+lens[j])+rads[i]+rads[j]+MARGIN && n_existing_cts==0)
+    float stiffness = two_pts*ISQRT2 + (!two_pts)*1.0;
+    
+    float overlap_length = two_pts*fabs(dot(pi-pi2,dirs[i]))/(2*POINT) + (!two_pts)*1.0;
+      
+    if (dist < MARGIN)
+    {
+        if (n_existing_cts==0 && (ct_i = new_contact(i, max_contacts, &k, overflow)) >= 0)
         {
-          // if not...
-          continue;
+          // make new contact and compute distance etc.
+          frs[ct_i] = i;
+          tos[ct_i] = j;
+          dists[ct_i] = dist;
+          pts[ct_i] = pt;
+          norms[ct_i] = norm;
+          reldists[ct_i] = stiffness*RHS_FRAC*dist;
+          stiff[ct_i] = stiffness;
+          overlap[ct_i] = overlap_length;
         }
-
-        // if so, find closest points
-        float4 pi, pj; // pi is point on our line seg, pj point on other
-        float4 pi2, pj2; // optional second points
-        int two_pts = 0; // are there two contacts?
-        closest_points_on_segments(centers[i], centers[j],
-                                   dirs[i], dirs[j],
-                                   lens[i], lens[j],
-                                   &pi, &pj, &pi2, &pj2, &two_pts);
-
-        float4 v_ij = pj-pi; // vector between closest points
-        float dist = length(v_ij) - (rads[i]+rads[j]);
-        float4 norm = normalize(v_ij); // normal on our cell at the contact
-        float4 pt = pi + rads[i]*norm; // point on the capsule surface
-          
-        int ct_i;
-        ct_i = i*max_contacts+k; // index of this contact
-
-        float stiffness = two_pts*ISQRT2 + (!two_pts)*1.0;
-        
-        float overlap_length = two_pts*fabs(dot(pi-pi2,dirs[i]))/(2*POINT) + (!two_pts)*1.0;
-          
-        if (dist < MARGIN)
-        {
-            if (n_existing_cts==0)
-            {
-              // make new contact and compute distance etc.
-              k++; // next contact
-              frs[ct_i] = i;
-              tos[ct_i] = j;
-              dists[ct_i] = dist;
-              pts[ct_i] = pt;
-              norms[ct_i] = norm;
-              reldists[ct_i] = stiffness*RHS_FRAC*dist;
-              stiff[ct_i] = stiffness;
-              overlap[ct_i] = overlap_length;
-            }
 	}
-        if(n_existing_cts>0){
-          // recompute dist etc. for existing contact
-          int idx = existing_cts_idx[0];
-          dists[idx] = dist;
-          pts[idx] = pt;
-          norms[idx] = norm;
-          reldists[idx] = stiffness*RHS_FRAC*dist;
-          stiff[idx] = stiffness;
-          overlap[idx]=overlap_length;
-        }
+    if(n_existing_cts>0){
+      // recompute dist etc. for existing contact
+      int idx = existing_cts_idx[0];
+      dists[idx] = dist;
+      pts[idx] = pt;
+      norms[idx] = norm;
+      reldists[idx] = stiffness*RHS_FRAC*dist;
+      stiff[idx] = stiffness;
+      overlap[idx]=overlap_length;
+    }
 
 
-        if (!two_pts){
+    if (!two_pts){
 	  if(n_existing_cts>1){
 	    // Not parallel, but were before - how to deal with this?
 	    // Set stiffness and rhs (reldists) to zero so that this row has no effect
@@ -646,48 +779,44 @@ __kernel void find_contacts(const int max_cells,
 	    pts[idx] = pt;
 	    norms[idx] = norm;*/
 	    reldists[idx] = 0.0;
-            stiff[idx] = 0.0;
-          overlap[idx]=overlap_length;
+        stiff[idx] = 0.0;
+      overlap[idx]=overlap_length;
 	  }
 	  continue;
 	}
 
-        // if we had two contacts, add the second point
-        v_ij = pj2-pi2;
-        dist = length(v_ij) - (rads[i]+rads[j]);
-        norm = normalize(v_ij);
-        pt = pi2 + rads[i]*norm;
-          
+    // if we had two contacts, add the second point
+    v_ij = pj2-pi2;
+    dist = length(v_ij) - (rads[i]+rads[j]);
+    norm = normalize(v_ij);
+    pt = pi2 + rads[i]*norm;
+      
 	// Are cells moving together or penetrating?
 	if (dist < MARGIN)
 	{
-            if (n_existing_cts<2)
-            {
-              ct_i = i*max_contacts+k;
-              k++;
-              frs[ct_i] = i;
-              tos[ct_i] = j;
-              dists[ct_i] = dist;
-              pts[ct_i] = pt;
-              norms[ct_i] = norm;
-              reldists[ct_i] = stiffness*RHS_FRAC*dist;
-              stiff[ct_i] = stiffness;
-              overlap[ct_i]=overlap_length;
-            }
-	}
-        if(n_existing_cts>1){
-          // recompute dist etc. for existing contact
-          int idx = existing_cts_idx[1];
-          dists[idx] = dist;
-          pts[idx] = pt;
-          norms[idx] = norm;
-          reldists[idx] = stiffness*RHS_FRAC*dist;
-          stiff[idx] = stiffness;
-          overlap[idx]=overlap_length;
+        if (n_existing_cts<2 && (ct_i = new_contact(i, max_contacts, &k, overflow)) >= 0)
+        {
+          frs[ct_i] = i;
+          tos[ct_i] = j;
+          dists[ct_i] = dist;
+          pts[ct_i] = pt;
+          norms[ct_i] = norm;
+          reldists[ct_i] = stiffness*RHS_FRAC*dist;
+          stiff[ct_i] = stiffness;
+          overlap[ct_i]=overlap_length;
         }
-
-      }
+	}
+    if(n_existing_cts>1){
+      // recompute dist etc. for existing contact
+      int idx = existing_cts_idx[1];
+      dists[idx] = dist;
+      pts[idx] = pt;
+      norms[idx] = norm;
+      reldists[idx] = stiffness*RHS_FRAC*dist;
+      stiff[idx] = stiffness;
+      overlap[idx]=overlap_length;
     }
+
   }
   n_cts[i] = k;
 
@@ -701,58 +830,40 @@ __kernel void find_contacts(const int max_cells,
 
 
 
-__kernel void collect_tos(const int max_cells,
-                          const int n_cells,
-                          const int grid_x_min,
-                          const int grid_x_max,
-                          const int grid_y_min,
-                          const int grid_y_max,
-                          const int n_sqs,
-                          const int max_contacts,
-                          __global const int* sqs,
-                          __global const int* sorted_ids,
-                          __global const int* sq_inds,
+__kernel void collect_tos(const int max_contacts,
+                          const int max_cands,
+                          __global const int* cands,
+                          __global const int* n_cands,
                           __global const int* n_cts,
                           __global const int* frs,
                           __global const int* tos,
                           __global int* cell_tos,
-                          __global int* n_cell_tos)
+                          __global int* n_cell_tos,
+                          __global int* overflow)
 {
   // our id
   int i = get_global_id(0);
 
-  // what square are we in?
-  int grid_x_range = grid_x_max-grid_x_min;
-  int grid_y_range = grid_y_max-grid_y_min;
-  int sq_row = sqs[i] / grid_x_range; // square row
-  int sq_col = sqs[i] % grid_x_range; // square col
-
   int k = 0; // how many cts are we the 'to' of?
 
-  // loop through our square and the eight squares surrounding it
-  // (fewer squares if we're on an edge)
-  for (int row = max(0, sq_row-1); row < min((int)(sq_row+2), grid_y_range); row++) {
-    for (int col = max(0, sq_col-1); col < min((int)(sq_col+2), grid_x_range); col++) {
+  // loop through our candidates
+  int end = i*max_cands + min(n_cands[i], max_cands);
+  for (int c = i*max_cands; c < end; c++) {
 
-      // what square is this?
-      int sq = row*grid_x_range + col;
+    int j = cands[c]; // the neighboring cell
 
-      // loop through all the cell ids in the current square (but
-      // don't go past the end of the list)
-      for (int n = sq_inds[sq]; n < (sq < n_sqs-1 ? sq_inds[sq+1] : n_cells); n++) {
+    if (j>=i || j<0) continue; // only looking at cells with lower ids
 
-        int j = sorted_ids[n]; // the neighboring cell
-
-        if (j>=i || j<0) continue; // only looking at cells with lower ids
-
-        // look through all the other cell's contacts
-        for (int m = 0; m < n_cts[j]; m++) {
-          int ct_i = (int)(j)*(int)(max_contacts)+m;
-          if (tos[ct_i] == i) {
-            // if one of them is us, collect it
-            cell_tos[i*max_contacts+k] = ct_i;
-            k++;
-          }
+    // look through all the other cell's contacts
+    for (int m = 0; m < n_cts[j]; m++) {
+      int ct_i = (int)(j)*(int)(max_contacts)+m;
+      if (tos[ct_i] == i) {
+        // if one of them is us, collect it, if there is room
+        if (k < max_contacts) {
+          cell_tos[i*max_contacts+k] = ct_i;
+          k++;
+        } else {
+          atomic_inc(overflow);
         }
       }
     }
@@ -768,12 +879,35 @@ __kernel void collect_tos(const int max_cells,
 }
 
 
-__kernel void build_matrix(const int max_contacts,
+// The matrix is built from a compacted list of the contacts: the contacts
+// of cell i are entries offsets[i] to offsets[i]+n_cts[i]-1, and slots
+// holds the slot in the (cell, max_contacts) contact arrays of each entry.
+__kernel void compact_contacts(const int max_contacts,
+                               __global const int* n_cts,
+                               __global const int* offsets,
+                               __global const float* reldists,
+                               __global int* slots,
+                               __global float* ent_reldists)
+{
+  int i = get_global_id(0);
+  int start = offsets[i];
+  for (int m = 0; m < n_cts[i]; m++) {
+    slots[start+m] = i*max_contacts+m;
+    ent_reldists[start+m] = reldists[i*max_contacts+m];
+  }
+}
+
+// entry in the compacted list of the contact in slot n
+int ct_entry(int n, const int max_contacts, __global const int* offsets)
+{
+  return offsets[n/max_contacts] + n%max_contacts;
+}
+
+__kernel void build_matrix(__global const int* slots,
                            __global const float4* centers,
                            __global const float4* dirs,
                            __global const float* lens,
                            __global const float* rads,
-                           __global const int* n_cts,
                            __global const int* frs,
                            __global const int* tos,
                            __global const float4* pts,
@@ -782,12 +916,8 @@ __kernel void build_matrix(const int max_contacts,
                            __global float8* to_ents,
                            __global float* stiff)
 {
-  int id = get_global_id(0);
-  int ct = get_global_id(1);
-
-  if (ct >= n_cts[id]) return;
-
-  int i = id*max_contacts + ct;
+  int c = get_global_id(0);
+  int i = slots[c];
 
   int a = frs[i];
   float4 r_a = pts[i]-centers[a];
@@ -802,13 +932,13 @@ __kernel void build_matrix(const int max_contacts,
   //fr_ent.s4 = -dot(nxr_a, Ia[1]);
   //fr_ent.s5 = -dot(nxr_a, Ia[2]);
   fr_ent.s6 = dot(dirs[a], r_a) * dot(dirs[a], norms[i])/(lens[a]+2.f*rads[a]);
-  fr_ents[i] = fr_ent * stiff[i];
+  fr_ents[c] = fr_ent * stiff[i];
 
   int b = tos[i];
 
   // plane and sphere contacts have no to_ent, and have negative indices
   if (b < 0) {
-    to_ents[i] = 0.f;
+    to_ents[c] = 0.f;
     return;
   }
 
@@ -824,10 +954,10 @@ __kernel void build_matrix(const int max_contacts,
   //to_ent.s4 = -dot(nxr_b, Ib[1]);
   //to_ent.s5 = -dot(nxr_b, Ib[2]);
   to_ent.s6 = dot(dirs[b], r_b) * dot(dirs[b], norms[i])/(lens[b]+2.f*rads[b]);
-  to_ents[i] = to_ent * stiff[i];
+  to_ents[c] = to_ent * stiff[i];
 }
 
-__kernel void calculate_Bx(const int max_contacts,
+__kernel void calculate_Bx(__global const int* slots,
                            __global const int* frs,
                            __global const int* tos,
                            __global const float8* fr_ents,
@@ -835,61 +965,66 @@ __kernel void calculate_Bx(const int max_contacts,
                            __global const float8* deltap,
                            __global float* Bx)
 {
-  int id = get_global_id(0);
-  int ct = get_global_id(1);
-  int i = id*max_contacts + ct;
+  int c = get_global_id(0);
+  int i = slots[c];
   int a = frs[i];
   int b = tos[i];
-  if (a == 0 && b == 0) return; // not a contact
-  float8 to_ents_i = b < 0 ? 0.f : to_ents[i];
+  float8 to_ents_c = b < 0 ? 0.f : to_ents[c];
   //my machine can't dot float8s...
-  float res0123 = dot(fr_ents[i].s0123, deltap[a].s0123) - dot(to_ents_i.s0123, deltap[b].s0123);
-  float res4567 = dot(fr_ents[i].s4567, deltap[a].s4567) - dot(to_ents_i.s4567, deltap[b].s4567);
-  Bx[i] = res0123 + res4567;
+  float res0123 = dot(fr_ents[c].s0123, deltap[a].s0123) - dot(to_ents_c.s0123, deltap[b].s0123);
+  float res4567 = dot(fr_ents[c].s4567, deltap[a].s4567) - dot(to_ents_c.s4567, deltap[b].s4567);
+  Bx[c] = res0123 + res4567;
 }
 
 
-__kernel void calculate_BTBx(const int max_contacts,
-                             __global const int* n_cts,
-                             __global const int* n_cell_tos,
-                             __global const int* cell_tos,
-                             __global const float8* fr_ents,
-                             __global const float8* to_ents,
-                             __global const float* Bx,
-                             __global float8* BTBx)
+// row i of B^T Bx, summing over contacts from and to cell i
+float8 cell_BTBx(int i,
+                 const int max_contacts,
+                 __global const int* n_cts,
+                 __global const int* offsets,
+                 __global const int* n_cell_tos,
+                 __global const int* cell_tos,
+                 __global const float8* fr_ents,
+                 __global const float8* to_ents,
+                 __global const float* Bx)
 {
-  int i = get_global_id(0);
   int base = i*max_contacts;
   float8 res = 0.f;
-  for (int k = base; k < base+n_cts[i]; k++) {
-    float8 oldres = res;
-    res += fr_ents[k]*Bx[k];
+  for (int c = offsets[i]; c < offsets[i]+n_cts[i]; c++) {
+    res += fr_ents[c]*Bx[c];
   }
   for (int k = base; k < base+n_cell_tos[i]; k++) {
     int n = cell_tos[k];
     if (n < 0) continue;
-    res -= to_ents[n]*Bx[n];
+    int c = ct_entry(n, max_contacts, offsets);
+    res -= to_ents[c]*Bx[c];
   }
-  BTBx[i] = res;
+  return res;
 }
 
-__kernel void calculate_Mx(const float muA,
-			       const float gamma,
-			       __global const float4* dirs,
-			       __global const float* lens,
-			       __global const float* rads,
-			       __global const float8* x,
-			       __global float8* Mx)
+__kernel void calculate_BTBx(const int max_contacts,
+                             __global const int* n_cts,
+                             __global const int* offsets,
+                             __global const int* n_cell_tos,
+                             __global const int* cell_tos,
+                             __global const float8* fr_ents,
+                             __global const float8* to_ents,
+                             __global const float* Bx,
+                             __global float8* BTBx)
 {
   int i = get_global_id(0);
-  float l = lens[i] + 2.f * rads[i];
+  BTBx[i] = cell_BTBx(i, max_contacts, n_cts, offsets, n_cell_tos, cell_tos,
+                      fr_ents, to_ents, Bx);
+}
 
-  float8 xi = x[i];
+// row i of Mx, where M is the (block diagonal) mass/inertia matrix
+float8 cell_Mx(float muA, float gamma, float4 dir, float l, float8 xi)
+{
   float8 v = 0.f;
   v.s012 = xi.s012 * muA * l;
 
   float4 I[4];
-  cyl_inertia_tensor(muA, l, dirs[i], I);
+  cyl_inertia_tensor(muA, l, dir, I);
   float4 L = 0.f;
   L.s012 = xi.s345;
   float4 w = matmul(I, L);
@@ -897,13 +1032,24 @@ __kernel void calculate_Mx(const float muA,
 
   //float4 w = 0.f;
   //w.s012 = xi.s345;
-  //float4 a = dirs[i];
+  //float4 a = dir;
   //float4 vv = (w - a*dot(a,w)) * muA * l*l*l / 12.f;
   //v.s345 = vv.s012;
-  
+
   v.s6 = xi.s6 * gamma;
+  return v;
+}
 
-  Mx[i] = v;
+__kernel void calculate_Mx(const float muA,
+			       const float gamma,
+			       __global const float4* dirs,
+			       __global const float* lens,
+			       __global const float* rads,
+			       __global const float8* x,
+			       __global float8* Mx)
+{
+  int i = get_global_id(0);
+  Mx[i] = cell_Mx(muA, gamma, dirs[i], lens[i] + 2.f*rads[i], x[i]);
 }
 
 
@@ -934,6 +1080,300 @@ __kernel void calculate_Minv_x(const float muA,
 }
 
 
+// Preconditioners for the CGS, built from the diagonal blocks of
+// A = B^TB + M/gamma. P^-1 for cell i is stored as 8 rows Pinv[i*8+k]:
+//   precond 1 -- Jacobi, Pinv[i*8] is the inverse of the diagonal
+//   precond 2 -- block Jacobi, rows 0-6 are the inverse of the 7x7 block
+// The blocks are only positive semi-definite: rotation of a cell about its
+// own axis has no inertia and moves no contacts. That direction is given
+// the mean rotational stiffness of the cell, so that P^-1 does not blow up
+// components of the residual along it, and a small multiple of the mean
+// diagonal is added before inverting in case of any other degeneracy.
+#define PRECOND_SHIFT 1e-6f
+
+// D += v v^T, for the first 7 components of v
+void add_outer(float D[7][7], float8 v)
+{
+  float e[8];
+  vstore8(v, 0, e);
+  for (int r = 0; r < 7; r++)
+    for (int c = 0; c < 7; c++)
+      D[r][c] += e[r]*e[c];
+}
+
+__kernel void build_preconditioner(const int max_contacts,
+                                   const int precond,
+                                   const float muA,
+                                   const float gamma,
+                                   __global const int* n_cts,
+                                   __global const int* offsets,
+                                   __global const int* n_cell_tos,
+                                   __global const int* cell_tos,
+                                   __global const float8* fr_ents,
+                                   __global const float8* to_ents,
+                                   __global const float4* dirs,
+                                   __global const float* lens,
+                                   __global const float* rads,
+                                   __global float8* Pinv)
+{
+  int i = get_global_id(0);
+  float D[7][7];
+  float e[8];
+  for (int r = 0; r < 7; r++)
+    for (int c = 0; c < 7; c++)
+      D[r][c] = 0.f;
+
+  // M/gamma, see calculate_Mx
+  float l = lens[i] + 2.f*rads[i];
+  float4 I[4];
+  cyl_inertia_tensor(muA, l, dirs[i], I);
+  for (int c = 0; c < 3; c++) {
+    D[c][c] = muA*l/gamma;
+    vstore4(I[c], 0, e);
+    for (int r = 0; r < 3; r++)
+      D[3+r][3+c] = e[r]/gamma;
+  }
+  D[6][6] = 1.f;
+
+  // B^TB, from the contacts from and to this cell
+  int base = i*max_contacts;
+  for (int c = offsets[i]; c < offsets[i]+n_cts[i]; c++) {
+    add_outer(D, fr_ents[c]);
+  }
+  for (int k = base; k < base+n_cell_tos[i]; k++) {
+    int n = cell_tos[k];
+    if (n < 0) continue;
+    add_outer(D, to_ents[ct_entry(n, max_contacts, offsets)]);
+  }
+
+  float4 a = dirs[i];
+  vstore4(a, 0, e);
+  float rot = (D[3][3] + D[4][4] + D[5][5])/3.f;
+  for (int r = 0; r < 3; r++)
+    for (int c = 0; c < 3; c++)
+      D[3+r][3+c] += rot*e[r]*e[c];
+
+  float shift = 0.f;
+  for (int r = 0; r < 7; r++)
+    shift += D[r][r];
+  shift *= PRECOND_SHIFT/7.f;
+  for (int r = 0; r < 7; r++)
+    D[r][r] += shift;
+
+  if (precond == 1) {
+    for (int r = 0; r < 7; r++)
+      e[r] = 1.f/D[r][r];
+    e[7] = 0.f;
+    Pinv[i*8] = vload8(0, e);
+    return;
+  }
+
+  // invert by Gauss-Jordan elimination (D is positive definite, so no
+  // pivoting is needed)
+  float A[7][7];
+  for (int r = 0; r < 7; r++)
+    for (int c = 0; c < 7; c++)
+      A[r][c] = r == c ? 1.f : 0.f;
+  for (int c = 0; c < 7; c++) {
+    float inv = 1.f/D[c][c];
+    for (int j = 0; j < 7; j++) {
+      D[c][j] *= inv;
+      A[c][j] *= inv;
+    }
+    for (int r = 0; r < 7; r++) {
+      if (r == c) continue;
+      float f = D[r][c];
+      for (int j = 0; j < 7; j++) {
+        D[r][j] -= f*D[c][j];
+        A[r][j] -= f*A[c][j];
+      }
+    }
+  }
+  for (int r = 0; r < 7; r++) {
+    for (int c = 0; c < 7; c++)
+      e[c] = A[r][c];
+    e[7] = 0.f;
+    Pinv[i*8+r] = vload8(0, e);
+  }
+  Pinv[i*8+7] = 0.f;
+}
+
+// z = P^-1 r for cell i
+float8 cell_precond(int i, const int precond, __global const float8* Pinv, float8 r)
+{
+  if (precond == 1) return Pinv[i*8]*r;
+  float z[8];
+  for (int k = 0; k < 7; k++)
+    z[k] = dot(Pinv[i*8+k].s0123, r.s0123) + dot(Pinv[i*8+k].s4567, r.s4567);
+  z[7] = 0.f;
+  return vload8(0, z);
+}
+
+__kernel void apply_preconditioner(const int precond,
+                                   __global const float8* Pinv,
+                                   __global const float8* r,
+                                   __global float8* z)
+{
+  int i = get_global_id(0);
+  z[i] = cell_precond(i, precond, Pinv, r[i]);
+}
+
+
+// Fused conjugate gradient kernels.
+//
+// These keep the CG scalars on the device, in scalars[]:
+//   scalars[0] -- r^T z for the current residual r and z = P^-1 r
+//   scalars[1] -- alpha = r^T z / p^T Ap
+//   scalars[2] -- beta = r_new^T z_new / r^T z
+//   scalars[3] -- r^T r, to test for convergence
+// Without a preconditioner z is r.
+// Dot products are summed per work group into partials[], which are then
+// reduced by a single work group. Work group size must be a power of 2.
+
+float dot8(float8 a, float8 b)
+{
+  return dot(a.s0123, b.s0123) + dot(a.s4567, b.s4567);
+}
+
+// sum v over the work group, and write the result to partials[group id]
+void group_sum(float v, __local float* scratch, __global float* partials)
+{
+  int lid = get_local_id(0);
+  scratch[lid] = v;
+  barrier(CLK_LOCAL_MEM_FENCE);
+  for (int s = get_local_size(0)/2; s > 0; s >>= 1) {
+    if (lid < s) scratch[lid] += scratch[lid+s];
+    barrier(CLK_LOCAL_MEM_FENCE);
+  }
+  if (lid == 0) partials[get_group_id(0)] = scratch[0];
+}
+
+// sum partials[0:n] with a single work group
+float reduce_partials(const int n, __global const float* partials,
+                      __local float* scratch)
+{
+  int lid = get_local_id(0);
+  float v = 0.f;
+  for (int k = lid; k < n; k += get_local_size(0)) {
+    v += partials[k];
+  }
+  scratch[lid] = v;
+  barrier(CLK_LOCAL_MEM_FENCE);
+  for (int s = get_local_size(0)/2; s > 0; s >>= 1) {
+    if (lid < s) scratch[lid] += scratch[lid+s];
+    barrier(CLK_LOCAL_MEM_FENCE);
+  }
+  return scratch[0];
+}
+
+// Ap = B^T Bp + Mp/gamma, and partial sums of p^T Ap
+// (Bp must already be computed by calculate_Bx)
+__kernel void cg_calculate_Ap(const int n_cells,
+                              const int max_contacts,
+                              const float muA,
+                              const float gamma,
+                              __global const int* n_cts,
+                              __global const int* offsets,
+                              __global const int* n_cell_tos,
+                              __global const int* cell_tos,
+                              __global const float8* fr_ents,
+                              __global const float8* to_ents,
+                              __global const float4* dirs,
+                              __global const float* lens,
+                              __global const float* rads,
+                              __global const float* Bp,
+                              __global const float8* p,
+                              __global float8* Ap,
+                              __local float* scratch,
+                              __global float* partials)
+{
+  int i = get_global_id(0);
+  float pAp = 0.f;
+  if (i < n_cells) {
+    float8 pi = p[i];
+    float8 res = cell_BTBx(i, max_contacts, n_cts, offsets, n_cell_tos, cell_tos,
+                           fr_ents, to_ents, Bp);
+    res += cell_Mx(muA, gamma, dirs[i], lens[i]+2.f*rads[i], pi) / gamma;
+    Ap[i] = res;
+    pAp = dot8(pi, res);
+  }
+  group_sum(pAp, scratch, partials);
+}
+
+// alpha = r^T z / p^T Ap
+__kernel void cg_alpha(const int n_partials,
+                       __global const float* partials,
+                       __global float* scalars,
+                       __local float* scratch)
+{
+  float pAp = reduce_partials(n_partials, partials, scratch);
+  if (get_local_id(0) == 0) {
+    scalars[1] = pAp > 0.f ? scalars[0]/pAp : 0.f;
+  }
+}
+
+// x = x + alpha*p, r = r - alpha*Ap, z = P^-1 r, and partial sums of
+// r^T r and r^T z (in the first and second half of partials)
+__kernel void cg_update_xr(const int n_cells,
+                           const int precond,
+                           __global const float* scalars,
+                           __global const float8* p,
+                           __global const float8* Ap,
+                           __global const float8* Pinv,
+                           __global float8* x,
+                           __global float8* r,
+                           __global float8* z,
+                           __local float* scratch,
+                           __global float* partials)
+{
+  int i = get_global_id(0);
+  float rr = 0.f;
+  float rz = 0.f;
+  if (i < n_cells) {
+    float alpha = scalars[1];
+    x[i] += alpha*p[i];
+    float8 ri = r[i] - alpha*Ap[i];
+    r[i] = ri;
+    rr = dot8(ri, ri);
+    rz = rr;
+    if (precond) {
+      float8 zi = cell_precond(i, precond, Pinv, ri);
+      z[i] = zi;
+      rz = dot8(ri, zi);
+    }
+  }
+  group_sum(rr, scratch, partials);
+  group_sum(rz, scratch, partials+get_num_groups(0));
+}
+
+// beta = r_new^T z_new / r^T z
+__kernel void cg_beta(const int n_partials,
+                      __global const float* partials,
+                      __global float* scalars,
+                      __local float* scratch)
+{
+  float rr = reduce_partials(n_partials, partials, scratch);
+  barrier(CLK_LOCAL_MEM_FENCE);
+  float rz = reduce_partials(n_partials, partials+n_partials, scratch);
+  if (get_local_id(0) == 0) {
+    scalars[2] = scalars[0] > 0.f ? rz/scalars[0] : 0.f;
+    scalars[0] = rz;
+    scalars[3] = rr;
+  }
+}
+
+// p = z + beta*p
+__kernel void cg_update_p(const int n_cells,
+                          __global const float* scalars,
+                          __global const float8* z,
+                          __global float8* p)
+{
+  int i = get_global_id(0);
+  if (i >= n_cells) return;
+  p[i] = z[i] + scalars[2]*p[i];
+}
+
+
 __kernel void predict(__global const float4* centers,
                         __global const float4* dirs,
                         __global const float* lens,
@@ -1042,4 +1482,173 @@ __kernel void add_impulse(const float muA,
   dlens[i] = max(0.f, dlens[i]+dplen);
 }
 
+// Divide a list of cells into two equal sized daughter cells each.
+// d1s may be the same as parents (daughter reuses the parent's slot).
+// jitter is added to the direction of each daughter.
+__kernel void divide_cells(const int alternate_divisions,
+                           __global const int* parents,
+                           __global const int* d1s,
+                           __global const int* d2s,
+                           __global const float4* jitter,
+                           __global float4* centers,
+                           __global float4* dirs,
+                           __global float* lens,
+                           __global float* rads,
+                           __global float* vols,
+                           __global float4* dcenters,
+                           __global float4* dangs,
+                           __global float8* warm_deltap,
+                           __global float4* cand_centers,
+                           __global float* cand_lens,
+                           __global float* cand_moves,
+                           __global int* daughters)
+{
+  int n = get_global_id(0);
+  int i = parents[n];
+  int a = d1s[n];
+  int b = d2s[n];
+
+  float4 parent_center = centers[i];
+  float4 parent_dir = dirs[i];
+  float parent_rad = rads[i];
+  float parent_len = lens[i];
+  float parent_vol = vols[i];
+  float4 parent_dlin = dcenters[i];
+  float4 parent_dang = dangs[i];
+  float8 parent_deltap = warm_deltap[i];
+
+  float daughter_len = parent_len/2.f - parent_rad;
+  float daughter_offset = daughter_len/2.f + parent_rad;
+  float4 center_offset = parent_dir*daughter_offset;
+
+  centers[a] = parent_center - center_offset;
+  centers[b] = parent_center + center_offset;
+
+  if (!alternate_divisions) {
+    dirs[a] = normalize(parent_dir + jitter[2*n]);
+    dirs[b] = normalize(parent_dir + jitter[2*n+1]);
+  } else {
+    float4 cdir = parent_dir;
+    cdir.x = -parent_dir.y;
+    cdir.y = parent_dir.x;
+    dirs[a] = cdir;
+    dirs[b] = cdir;
+  }
+
+  lens[a] = daughter_len;
+  lens[b] = daughter_len;
+  rads[a] = parent_rad;
+  rads[b] = parent_rad;
+  vols[a] = parent_vol/2.f;
+  vols[b] = parent_vol/2.f;
+
+  // Inherit velocities from parent (conserve momentum)
+  dcenters[a] = parent_dlin;
+  dcenters[b] = parent_dlin;
+  dangs[a] = parent_dang;
+  dangs[b] = parent_dang;
+
+  // Daughters start the next solve from the parent's solution, with the
+  // length change shared between them
+  parent_deltap.s6 *= 0.5f;
+  warm_deltap[a] = parent_deltap;
+  warm_deltap[b] = parent_deltap;
+
+  // Daughters lie inside the parent, so can keep its contact candidates
+  // (see divide_candidates): carry over how far it had moved since they
+  // were found, and count moves from here
+  float moved = length(parent_center-cand_centers[i]) + 0.5f*fabs(parent_len-cand_lens[i]) + cand_moves[i];
+  cand_centers[a] = centers[a];
+  cand_centers[b] = centers[b];
+  cand_lens[a] = daughter_len;
+  cand_lens[b] = daughter_len;
+  cand_moves[a] = moved;
+  cand_moves[b] = moved;
+  daughters[i] = b+1;
+}
+
+// Update the contact candidates of cells i < n_old after divide_cells,
+// where each parent became daughters d1 = parent and d2 = daughters[parent]-1
+// (daughters is 0 for cells that did not divide). Daughter cells are added
+// to the candidates of each cell that had their parent, and d2 gets the
+// candidates of d1 and d1 itself. This keeps every pair within touching
+// distance of each other in the candidates, as daughters are contained in
+// their parent. Counts can go over max_cands, as in find_candidates.
+__kernel void divide_candidates(const int max_cands,
+                                __global const int* daughters,
+                                __global int* cands,
+                                __global int* n_cands)
+{
+  int i = get_global_id(0);
+  __global int* cell_cands = cands + i*max_cands;
+  int n = n_cands[i];
+  int k = n;
+  for (int c = 0; c < min(n, max_cands); c++) {
+    int d = daughters[cell_cands[c]]-1;
+    if (d < 0) continue;
+    if (k < max_cands) cell_cands[k] = d;
+    k++;
+  }
+  int b = daughters[i]-1;
+  if (b >= 0) {
+    __global int* d2_cands = cands + b*max_cands;
+    for (int c = 0; c < min(k, max_cands); c++) {
+      d2_cands[c] = cell_cands[c];
+    }
+    if (k < max_cands) d2_cands[k] = i;
+    n_cands[b] = k+1;
+    if (k < max_cands) cell_cands[k] = b;
+    k++;
+  }
+  n_cands[i] = k;
+}
+
+// Add j to the neighbours nbrs[0..k) of a cell, unless it is already there
+int add_neighbour(__global int* nbrs, int k, int j)
+{
+  for (int l = 0; l < k; l++) {
+    if (nbrs[l] == j) return k;
+  }
+  nbrs[k] = j;
+  return k+1;
+}
+
+// The neighbours of each cell: the cells it has contacts to (ct_tos, not
+// planes or spheres) and the cells with contacts to it (the frs of
+// cell_tos), without duplicates. At most 2*max_contacts per cell.
+__kernel void find_neighbours(const int max_contacts,
+                              __global const int* n_cts,
+                              __global const int* frs,
+                              __global const int* tos,
+                              __global const int* n_cell_tos,
+                              __global const int* cell_tos,
+                              __global int* nbrs,
+                              __global int* n_nbrs)
+{
+  int i = get_global_id(0);
+  __global int* cell_nbrs = nbrs + i*2*max_contacts;
+  int k = 0;
+  for (int m = 0; m < n_cts[i]; m++) {
+    int j = tos[i*max_contacts+m];
+    if (j < 0) continue; // plane or sphere contact
+    k = add_neighbour(cell_nbrs, k, j);
+  }
+  for (int m = 0; m < n_cell_tos[i]; m++) {
+    k = add_neighbour(cell_nbrs, k, frs[cell_tos[i*max_contacts+m]]);
+  }
+  n_nbrs[i] = k;
+}
 
+// Copy the neighbours of each cell to its place in the CSR list
+__kernel void compact_neighbours(const int max_contacts,
+                                 __global const int* nbrs,
+                                 __global const int* n_nbrs,
+                                 __global const int* offsets,
+                                 __global int* cell_nbrs)
+{
+  int i = get_global_id(0);
+  int start = offsets[i];
+  for (int k = 0; k < n_nbrs[i]; k++) {
+    cell_nbrs[start+k] = nbrs[i*2*max_contacts+k];
+  }
+}
@@ -7,8 +7,13 @@ from pyopencl.array import vec
 from pyopencl.array import max as device_max
 from pyopencl.elementwise import ElementwiseKernel
 from pyopencl.reduction import ReductionKernel
+from pyopencl.algorithm import RadixSort
+from pyopencl.scan import ExclusiveScanKernel
 import random
 import time
+from CellModeller.Capacity import newCapacity, copyRows
+from CellModeller.CLProgramCache import buildProgram
+from CellModeller.Profiler import Profiler
 
 
 ct_map = {}
@@ -18,6 +23,12 @@ class CLBacterium:
     OpenCL.
     """
 
+    # work group size for the fused CGS kernels (must be a power of 2)
+    cgs_group_size = 64
+
+    # preconditioner names, and the precond flag passed to the kernels
+    preconditioners = {None: 0, 'jacobi': 1, 'block_jacobi': 2}
+
     def __init__(self, simulator,
                  max_substeps=8,
                  max_cells=10000,
@@ -26,21 +37,37 @@ class CLBacterium:
                  max_spheres=1,
                  max_sqs=192**2,
                  grid_spacing=5.0,
+                 device_grid=True,
+                 hash_grid_size=None,
+                 contact_skin=1.0,
                  muA=1.0,
                  gamma=10.0,
                  dt=None,
+                 adaptive_dt=False,
+                 min_dt=None,
+                 max_tick_move=0.5,
+                 max_overlap=0.5,
                  cgs_tol=5e-3,
+                 fused_cgs=False,
+                 cgs_check_interval=8,
+                 preconditioner=None,
+                 warm_start_cgs=False,
                  jitter_z=True,
                  alternate_divisions=False,
                  printing=True,
-                 compNeighbours=False):
+                 compNeighbours=False,
+                 grow_factor=1.5,
+                 grow_threshold=0.9):
 
-        # Should we compute neighbours? (bit slow)
+        # Should we compute neighbours? They are found on the device each
+        # step, see update_neighbours
         self.computeNeighbours = compNeighbours
 
         self.frame_no = 0
         self.simulator = simulator
         self.regulator = None
+        # phase timers, shared with the simulator (see Profiler)
+        self.profiler = getattr(simulator, 'profiler', None) or Profiler()
         
         self.time_begin = time.time()
         self.seconds_elapsed = 0
@@ -53,16 +80,73 @@ class CLBacterium:
         self.max_spheres = max_spheres
         self.max_sqs = max_sqs
         self.grid_spacing = grid_spacing
+        # Bin and sort cells into grid squares on the device, rather than
+        # copying cell positions to the host each tick (False for debugging)
+        self.device_grid = device_grid
+        # Number of buckets (a power of 2) of a spatial hash of the x,y,z
+        # grid squares, to use in place of the dense x,y grid of max_sqs
+        # squares. This covers colonies of any extent, in 3D.
+        if hash_grid_size is not None and (hash_grid_size <= 0 or hash_grid_size & (hash_grid_size-1)):
+            raise ValueError("hash_grid_size must be a power of 2, got %s" % hash_grid_size)
+        self.hash_grid_size = hash_grid_size or 0
+        if self.hash_grid_size:
+            self.max_sqs = max(self.max_sqs, self.hash_grid_size)
         self.muA = muA
         self.gamma = gamma
         self.dt = dt
+        # Choose the length of each tick from how far cells moved, how much
+        # they overlapped and whether contacts were left unresolved in the
+        # last one, between min_dt and dt (the simulator dt if None), see
+        # accept_tick
+        self.adaptive_dt = adaptive_dt
+        self.min_dt = min_dt
+        self.max_tick_move = max_tick_move
+        self.max_overlap = max_overlap
+        self.next_dt = None
+        # ticks taken in each frame, and ticks rejected in all frames so far
+        self.frame_ticks = []
+        self.tick_rejects = 0
         self.cgs_tol = cgs_tol
+        # Use the fused CGS kernels, which keep the CG scalars on the device
+        # and only check for convergence every cgs_check_interval iterations
+        self.fused_cgs = fused_cgs
+        self.cgs_check_interval = cgs_check_interval
+        # Preconditioner for the CGS: None, 'jacobi' or 'block_jacobi'
+        if preconditioner not in self.preconditioners:
+            raise ValueError("Unknown preconditioner '%s', options are %s" % (preconditioner, list(self.preconditioners.keys())))
+        self.preconditioner = preconditioner
+        self.precond = self.preconditioners[preconditioner]
+        # Start the first solve of each frame from the solution of the first
+        # solve of the previous frame, rather than from zero
+        self.warm_start_cgs = warm_start_cgs
+        # (substep, iterations, residual) of each solve in the current frame
+        self.cgs_stats = []
+        # total CGS iterations of each frame
+        self.cgs_frame_iters = []
 
         self.max_substeps = max_substeps
 
+        # max_cells and max_contacts are grown by grow_factor when more
+        # than grow_threshold of the space is in use, see reserve()
+        self.grow_factor = grow_factor
+        self.grow_threshold = grow_threshold
+
         self.n_cells = 0
         self.n_cts = 0
         self.n_planes = 0
+        # contacts the matrix entries have room for (see compact_contacts),
+        # grown as needed
+        self.max_ents = 4*self.max_cells
+        # contacts that did not fit in max_contacts, in all frames so far
+        self.ct_overflows = 0
+        # Contacts are looked for among candidates found within contact_skin
+        # of touching, which are reused until a cell has moved more than half
+        # the skin, see update_candidates
+        self.contact_skin = contact_skin
+        self.max_cands = max_contacts
+        self.cands_stale = True
+        self.cands_n_cells = 0
+        self.n_cand_builds = 0
         self.n_spheres = 0
 
         self.next_id = 0
@@ -77,6 +161,13 @@ class CLBacterium:
         #self.init_kernels()
         self.init_data()
 
+        # neighbours in CSR form, see update_neighbours. Cell states get
+        # their neighbours from these when they ask for them.
+        self.cell_nbr_offsets = numpy.zeros(1, numpy.int32)
+        self.cell_nbrs = numpy.zeros(0, numpy.int32)
+        if self.computeNeighbours and self.simulator:
+            self.simulator.cellStore.neighbourIds = self.neighbour_ids
+
         self.parents = {}
 
         self.jitter_z = jitter_z
@@ -99,14 +190,17 @@ class CLBacterium:
 
     def addCell(self, cellState, pos=(0,0,0), dir=(1,0,0), rad=0.5, **kwargs):
         i = cellState.idx
+        self.reserve(max(self.n_cells, i)+1)
         self.n_cells += 1
         cid = cellState.id
         self.cell_centers[i] = tuple(pos+(0,))
         self.cell_dirs[i] = tuple(dir+(0,))
         self.cell_lens[i] = cellState.length
         self.cell_rads[i] = rad
+        self.cell_colonies[i] = getattr(cellState, 'colony', 0)
         self.initCellState(cellState)
-        self.set_cells()
+        # only the new cell has changed on the host
+        self.set_cells(i, i+1)
         self.calc_cell_geom() # cell needs a volume
 
     #---
@@ -146,7 +240,7 @@ class CLBacterium:
         self.set_spheres()
 
     def hasNeighbours(self):
-        return False
+        return bool(self.computeNeighbours)
 
     def divide(self, parentState, daughter1State, daughter2State, *args, **kwargs):
         self.divide_cell(parentState.idx, daughter1State.idx, daughter2State.idx)
@@ -154,6 +248,11 @@ class CLBacterium:
         self.initCellState(daughter1State)
         self.initCellState(daughter2State)
 
+    def divideCells(self, pidxs, d1idxs, d2idxs, d1States, d2States):
+        """Divide a batch of cells, see divide_cells."""
+        self.divide_cells(pidxs, d1idxs, d2idxs)
+        self.initCellStates(numpy.concatenate((d1idxs, d2idxs)))
+
     def init_cl(self):
         if self.simulator:
             (self.context, self.queue) = self.simulator.getOpenCL()
@@ -163,10 +262,11 @@ class CLBacterium:
         from pkg_resources import resource_string
         kernel_src = resource_string(__name__, 'CLBacterium.cl').decode()
 
-        self.program = cl.Program(self.context, kernel_src).build(cache_dir=False)
+        self.program = buildProgram(self.context, kernel_src)
         # Some kernels that seem like they should be built into pyopencl...
         self.vclearf = ElementwiseKernel(self.context, "float8 *v", "v[i]=0.0", "vecclearf")
         self.vcleari = ElementwiseKernel(self.context, "int *v", "v[i]=0", "veccleari")
+        self.vclearf4 = ElementwiseKernel(self.context, "float4 *v", "v[i]=0.0f", "vecclearf4")
         self.vadd = ElementwiseKernel(self.context, "float8 *res, const float8 *in1, const float8 *in2",
                                       "res[i] = in1[i] + in2[i]", "vecadd")
         self.vsub = ElementwiseKernel(self.context, "float8 *res, const float8 *in1, const float8 *in2",
@@ -199,6 +299,52 @@ class CLBacterium:
         self.vdot = ReductionKernel(self.context, numpy.float32, neutral="0",
                 reduce_expr="a+b", map_expr="dot(x[i].s0123,y[i].s0123)+dot(x[i].s4567,y[i].s4567)",
                 arguments="__global float8 *x, __global float8 *y")
+
+        # x,y extent of cell centers as (min x, min y, -max x, -max y)
+        self.grid_extent = ReductionKernel(self.context, vec.float4,
+                neutral="(float4)(MAXFLOAT)", reduce_expr="fmin(a,b)",
+                map_expr="(float4)(c[i].x, c[i].y, -c[i].x, -c[i].y)",
+                arguments="__global const float4 *c")
+        # furthest any cell has moved (plus half its growth) since the
+        # contact candidates were found
+        self.max_move = ReductionKernel(self.context, numpy.float32, neutral="0",
+                reduce_expr="fmax(a,b)", map_expr="length(c[i]-c0[i]) + 0.5f*fabs(l[i]-l0[i]) + m[i]",
+                arguments="__global const float4 *c, __global const float4 *c0, "
+                          "__global const float *l, __global const float *l0, __global const float *m")
+        # largest of how far any point on a cell's axis moves in the tick,
+        # over max_move, and how far it overlaps any contact at the end of
+        # the tick, over max_overlap, see accept_tick
+        self.tick_error = ReductionKernel(self.context, numpy.float32, neutral="0",
+                reduce_expr="fmax(a,b)",
+                map_expr="tick_error(i, max_contacts, max_move, max_overlap, dc, da, l, dl, n_cts, dists)",
+                arguments="const int max_contacts, const float max_move, const float max_overlap, "
+                          "__global const float4 *dc, __global const float4 *da, "
+                          "__global const float *l, __global const float *dl, "
+                          "__global const int *n_cts, __global const float *dists",
+                preamble="""
+                float tick_error(int i, int max_contacts, float max_move, float max_overlap,
+                                 __global const float4 *dc, __global const float4 *da,
+                                 __global const float *l, __global const float *dl,
+                                 __global const int *n_cts, __global const float *dists)
+                {
+                    float move = length(dc[i].s012) + 0.5f*l[i]*length(da[i].s012) + 0.5f*fabs(dl[i]);
+                    float overlap = 0.f;
+                    for (int k=i*max_contacts; k<i*max_contacts+n_cts[i]; k++)
+                        overlap = fmax(overlap, -dists[k]);
+                    return fmax(move/max_move, overlap/max_overlap);
+                }
+                """)
+        # offsets of each cell's contacts or neighbours from their counts
+        self.scan_counts = ExclusiveScanKernel(self.context, numpy.int32, "a+b", "0")
+        # sort cell ids by grid square
+        self.sort_sqs = RadixSort(self.context, "int *sqs, int *ids",
+                key_expr="sqs[i]", sort_arg_names=["sqs", "ids"])
+
+        # Kernels for the fused CGS, retrieved once as they are called
+        # several times per iteration
+        self.cgs_kernels = dict([(name, cl.Kernel(self.program, name)) for name in
+                                 ['calculate_Bx', 'cg_calculate_Ap', 'cg_alpha',
+                                  'cg_update_xr', 'cg_beta', 'cg_update_p']])
     
 
     def init_data(self):
@@ -219,8 +365,14 @@ class CLBacterium:
         self.pred_cell_lens_dev = cl_array.zeros(self.queue, cell_geom, numpy.float32)
         self.cell_rads = numpy.zeros(cell_geom, numpy.float32)
         self.cell_rads_dev = cl_array.zeros(self.queue, cell_geom, numpy.float32)
+        # colony of each cell, cells only have contacts within their colony
+        # (see Simulator replicates)
+        self.cell_colonies = numpy.zeros(cell_geom, numpy.int32)
+        self.cell_colonies_dev = cl_array.zeros(self.queue, cell_geom, numpy.int32)
         self.cell_sqs = numpy.zeros(cell_geom, numpy.int32)
         self.cell_sqs_dev = cl_array.zeros(self.queue, cell_geom, numpy.int32)
+        # x,y,z grid square of each cell, for the hash grid
+        self.cell_grid_dev = cl_array.zeros(self.queue, cell_geom, vec.int4)
         self.cell_n_cts = numpy.zeros(cell_geom, numpy.int32)
         self.cell_n_cts_dev = cl_array.zeros(self.queue, cell_geom, numpy.int32)
         self.cell_dcenters = numpy.zeros(cell_geom, vec.float4)
@@ -275,10 +427,23 @@ class CLBacterium:
         self.ct_pts_dev = cl_array.zeros(self.queue, ct_geom, vec.float4)
         self.ct_norms = numpy.zeros(ct_geom, vec.float4)
         self.ct_norms_dev = cl_array.zeros(self.queue, ct_geom, vec.float4)
+        self.ct_reldists_dev = cl_array.zeros(self.queue, ct_geom, numpy.float32)
         self.ct_stiff_dev = cl_array.zeros(self.queue, ct_geom, numpy.float32)
         self.ct_overlap_dev = cl_array.zeros(self.queue, ct_geom, numpy.float32)
-        self.neighbours = numpy.zeros(ct_geom, numpy.int32)
-        self.cell_cts = numpy.zeros(self.max_cells, numpy.int32)
+        # count of contacts that did not fit in max_contacts (see new_contact
+        # in CLBacterium.cl), reported and cleared each frame
+        self.ct_overflow_dev = cl_array.zeros(self.queue, (1,), numpy.int32)
+
+        # candidate contacts of each cell (see find_candidates), and the
+        # positions and lengths they were found at
+        self.cell_cands_dev = cl_array.zeros(self.queue, (self.max_cells, self.max_cands), numpy.int32)
+        self.cell_n_cands_dev = cl_array.zeros(self.queue, cell_geom, numpy.int32)
+        self.cand_centers_dev = cl_array.zeros(self.queue, cell_geom, vec.float4)
+        self.cand_lens_dev = cl_array.zeros(self.queue, cell_geom, numpy.float32)
+        # how far a cell's parent had moved since they were found, and the
+        # daughter (+1) of each parent while dividing, see divide_candidates
+        self.cand_moves_dev = cl_array.zeros(self.queue, cell_geom, numpy.float32)
+        self.cell_daughters_dev = cl_array.zeros(self.queue, cell_geom, numpy.int32)
 
         # where the contacts pointing to this cell are collected
         self.cell_tos = numpy.zeros(ct_geom, numpy.int32)
@@ -286,25 +451,26 @@ class CLBacterium:
         self.n_cell_tos = numpy.zeros(cell_geom, numpy.int32)
         self.n_cell_tos_dev = cl_array.zeros(self.queue, cell_geom, numpy.int32)
 
+        if self.computeNeighbours:
+            # neighbours of each cell before compaction (up to max_contacts
+            # each way), their counts (and one past the last cell, so the
+            # scan gives the total), and the CSR offsets and neighbours
+            self.nbr_tmp_dev = cl_array.zeros(self.queue, (self.max_cells, 2*self.max_contacts), numpy.int32)
+            self.cell_n_nbrs_dev = cl_array.zeros(self.queue, (self.max_cells+1,), numpy.int32)
+            self.cell_nbr_offsets_dev = cl_array.zeros(self.queue, (self.max_cells+1,), numpy.int32)
+            self.cell_nbrs_dev = cl_array.zeros(self.queue, (self.max_cells*2*self.max_contacts,), numpy.int32)
 
-        # the constructed 'matrix'
-        mat_geom = (self.max_cells*self.max_contacts,)
-        self.ct_inds = numpy.zeros(mat_geom, numpy.int32)
-        self.ct_inds_dev = cl_array.zeros(self.queue, mat_geom, numpy.int32)
-        self.ct_reldists = numpy.zeros(mat_geom, numpy.float32)
-        self.ct_reldists_dev = cl_array.zeros(self.queue, mat_geom, numpy.float32)
 
-        self.fr_ents = numpy.zeros(mat_geom, vec.float8)
-        self.fr_ents_dev = cl_array.zeros(self.queue, mat_geom, vec.float8)
-        self.to_ents = numpy.zeros(mat_geom, vec.float8)
-        self.to_ents_dev = cl_array.zeros(self.queue, mat_geom, vec.float8)
-        
+        # the constructed 'matrix', over the compacted contacts
+        self.ct_offsets_dev = cl_array.zeros(self.queue, cell_geom, numpy.int32)
+        self.init_entries()
 
         # vectors and intermediates
         self.deltap = numpy.zeros(cell_geom, vec.float8)
         self.deltap_dev = cl_array.zeros(self.queue, cell_geom, vec.float8)
-        self.Mx = numpy.zeros(mat_geom, numpy.float32)
-        self.Mx_dev = cl_array.zeros(self.queue, mat_geom, numpy.float32)
+        # last solution of the first substep, indexed by cell idx
+        self.warm_deltap_dev = cl_array.zeros(self.queue, cell_geom, vec.float8)
+        self.Mx_dev = cl_array.zeros(self.queue, cell_geom, vec.float8)
         self.BTBx = numpy.zeros(cell_geom, vec.float8)
         self.BTBx_dev = cl_array.zeros(self.queue, cell_geom, vec.float8)
         self.Minvx_dev = cl_array.zeros(self.queue, cell_geom, vec.float8)
@@ -314,18 +480,78 @@ class CLBacterium:
         self.Ap_dev = cl_array.zeros(self.queue, cell_geom, vec.float8)
         self.res_dev = cl_array.zeros(self.queue, cell_geom, vec.float8)
         self.rhs_dev = cl_array.zeros(self.queue, cell_geom, vec.float8)
+
+        # preconditioner (rows of the inverse of each cell's block), and z = P^-1 res
+        pinv_geom = (self.max_cells if self.precond else 1, 8)
+        self.Pinv_dev = cl_array.zeros(self.queue, pinv_geom, vec.float8)
+        self.z_dev = cl_array.zeros(self.queue, cell_geom, vec.float8)
+
+        # fused CGS per work group partial sums, and scalars (see CLBacterium.cl)
+        n_groups = (self.max_cells+self.cgs_group_size-1)//self.cgs_group_size
+        self.cgs_partials_dev = cl_array.zeros(self.queue, (2*n_groups,), numpy.float32)
+        self.cgs_scalars = numpy.zeros((4,), numpy.float32)
+        self.cgs_scalars_dev = cl_array.zeros(self.queue, (4,), numpy.float32)
     
 
+    def init_entries(self):
+        """Set up the matrix entries, for max_ents contacts."""
+        ent_geom = (self.max_ents,)
+        self.ct_slots_dev = cl_array.zeros(self.queue, ent_geom, numpy.int32)
+        self.ent_reldists_dev = cl_array.zeros(self.queue, ent_geom, numpy.float32)
+        self.fr_ents_dev = cl_array.zeros(self.queue, ent_geom, vec.float8)
+        self.to_ents_dev = cl_array.zeros(self.queue, ent_geom, vec.float8)
+        self.Bx_dev = cl_array.zeros(self.queue, ent_geom, numpy.float32)
+
+    def reserve_entries(self, n_cts):
+        """Make sure there is space for the matrix entries of n_cts
+        contacts. Entries are rebuilt each substep, so are not copied.
+        """
+        if n_cts <= self.max_ents:
+            return
+        self.max_ents = newCapacity(self.max_ents, n_cts, self.grow_factor, 1.0)
+        self.init_entries()
+
+    def reserve(self, n_cells, n_contacts=None):
+        """Make sure there is space for n_cells cells with n_contacts
+        contacts each, reallocating host and device arrays if needed.
+
+        Cell data is copied to the new arrays, contact data is not since it
+        is rebuilt at the start of each tick.
+        """
+        max_cells = newCapacity(self.max_cells, n_cells,
+                                self.grow_factor, self.grow_threshold)
+        max_contacts = self.max_contacts
+        if n_contacts is not None:
+            max_contacts = newCapacity(self.max_contacts, n_contacts,
+                                       self.grow_factor, self.grow_threshold)
+        if max_cells == self.max_cells and max_contacts == self.max_contacts:
+            return
+
+        t = time.time()
+        old = dict(self.__dict__)
+        self.max_cells = max_cells
+        self.max_contacts = max_contacts
+        self.init_data()
+        copyRows(self.queue, old, self.__dict__, old['max_cells'], self.n_cells)
+        self.queue.finish()
+        self.cands_stale = True
+        if self.printing:
+            print('Resized CLBacterium to max_cells = %i, max_contacts = %i in %f second(s)' % (self.max_cells, self.max_contacts, time.time()-t))
+
     def load_from_cellstates(self, cell_states):
+        if cell_states:
+            self.reserve(max([cs.idx for cs in cell_states.values()])+1)
         for (cid,cs) in list(cell_states.items()):
             i = cs.idx
             self.cell_centers[i] = tuple(cs.pos)+(0,)
             self.cell_dirs[i] = tuple(cs.dir)+(0,)
             self.cell_rads[i] = cs.radius
             self.cell_lens[i] = cs.length
+            self.cell_colonies[i] = getattr(cs, 'colony', 0)
         
         self.n_cells = len(cell_states)
         self.set_cells()
+        self.cands_stale = True
         self.calc_cell_area(self.cell_areas_dev, self.cell_rads_dev, self.cell_lens_dev)
         self.calc_cell_vol(self.cell_vols_dev, self.cell_rads_dev, self.cell_lens_dev)
 
@@ -432,23 +658,30 @@ class CLBacterium:
 
     def get_cells(self):
         """Copy cell centers, dirs, lens, and rads from the device."""
-        self.cell_centers[0:self.n_cells] = self.cell_centers_dev[0:self.n_cells].get()
-        self.cell_dirs[0:self.n_cells] = self.cell_dirs_dev[0:self.n_cells].get()
-        self.cell_lens[0:self.n_cells] = self.cell_lens_dev[0:self.n_cells].get()
-        self.cell_rads[0:self.n_cells] = self.cell_rads_dev[0:self.n_cells].get()
-        self.cell_dlens[0:self.n_cells] = self.cell_dlens_dev[0:self.n_cells].get()
-        self.cell_dcenters[0:self.n_cells] = self.cell_dcenters_dev[0:self.n_cells].get()
-        self.cell_dangs[0:self.n_cells] = self.cell_dangs_dev[0:self.n_cells].get()
-
-    def set_cells(self):
-        """Copy cell centers, dirs, lens, and rads to the device from local."""
-        self.cell_centers_dev[0:self.n_cells].set(self.cell_centers[0:self.n_cells])
-        self.cell_dirs_dev[0:self.n_cells].set(self.cell_dirs[0:self.n_cells])
-        self.cell_lens_dev[0:self.n_cells].set(self.cell_lens[0:self.n_cells])
-        self.cell_rads_dev[0:self.n_cells].set(self.cell_rads[0:self.n_cells])
-        self.cell_dlens_dev[0:self.n_cells].set(self.cell_dlens[0:self.n_cells])
-        self.cell_dcenters_dev[0:self.n_cells].set(self.cell_dcenters[0:self.n_cells])
-        self.cell_dangs_dev[0:self.n_cells].set(self.cell_dangs[0:self.n_cells])
+        with self.profiler.phase('transfer'):
+            self.cell_centers[0:self.n_cells] = self.cell_centers_dev[0:self.n_cells].get()
+            self.cell_dirs[0:self.n_cells] = self.cell_dirs_dev[0:self.n_cells].get()
+            self.cell_lens[0:self.n_cells] = self.cell_lens_dev[0:self.n_cells].get()
+            self.cell_rads[0:self.n_cells] = self.cell_rads_dev[0:self.n_cells].get()
+            self.cell_dlens[0:self.n_cells] = self.cell_dlens_dev[0:self.n_cells].get()
+            self.cell_dcenters[0:self.n_cells] = self.cell_dcenters_dev[0:self.n_cells].get()
+            self.cell_dangs[0:self.n_cells] = self.cell_dangs_dev[0:self.n_cells].get()
+
+    def set_cells(self, start=0, end=None):
+        """Copy cell centers, dirs, lens, rads and colonies to the device
+        from local, for cells start to end (default all).
+        """
+        if end is None:
+            end = self.n_cells
+        with self.profiler.phase('transfer'):
+            self.cell_centers_dev[start:end].set(self.cell_centers[start:end])
+            self.cell_dirs_dev[start:end].set(self.cell_dirs[start:end])
+            self.cell_lens_dev[start:end].set(self.cell_lens[start:end])
+            self.cell_rads_dev[start:end].set(self.cell_rads[start:end])
+            self.cell_colonies_dev[start:end].set(self.cell_colonies[start:end])
+            self.cell_dlens_dev[start:end].set(self.cell_dlens[start:end])
+            self.cell_dcenters_dev[start:end].set(self.cell_dcenters[start:end])
+            self.cell_dangs_dev[start:end].set(self.cell_dangs[start:end])
 
     def set_planes(self):
         """Copy plane pts, norms, and coeffs to the device from local."""
@@ -517,8 +750,7 @@ class CLBacterium:
         # pull cells from the device and update simulator
         if self.simulator:
             self.get_cells()
-            for state in list(self.simulator.cellStates.values()):
-                self.updateCellState(state)
+            self.updateCellStates()
 
     def progress_init(self, dt):
         self.set_cells()
@@ -529,34 +761,117 @@ class CLBacterium:
             self.n_ticks = 1 
         # print("n_ticks = %d"%(self.n_ticks))
         self.actual_dt = dt / float(self.n_ticks)
+        if self.adaptive_dt:
+            # ticks of next_dt (carried over from the last frame, starting
+            # from self.dt) or shorter, to end at dt
+            self.max_dt = dt
+            self.dt_left = dt
+            self.next_dt = min(self.next_dt or self.dt or dt, dt)
+            self.actual_dt = self.split_dt(self.next_dt)
+        self.n_frame_ticks = 0
+        self.cgs_stats = []
         self.progress_initialised = True
 
     def progress(self):
+        if self.adaptive_dt:
+            if self.dt_left > 0:
+                if self.tick(self.actual_dt):
+                    self.dt_left -= self.actual_dt
+                    self.n_frame_ticks += 1
+                    if self.dt_left > 0:
+                        self.actual_dt = self.split_dt(self.next_dt)
+                return False
+            return True
         if self.n_ticks:
             if self.tick(self.actual_dt):
                 self.n_ticks -= 1
+                self.n_frame_ticks += 1
             return False
         else:
             return True
 
+    def split_dt(self, dt):
+        """Length of the next tick: the rest of the frame (dt_left) in equal
+        ticks no longer than dt.
+        """
+        return self.dt_left / math.ceil(self.dt_left/dt*(1.0-1e-6))
+
+    def accept_tick(self, dt):
+        """Whether the tick of length dt just solved is within the error
+        bounds: no point on a cell's axis moves more than max_tick_move, no
+        contact overlaps by more than max_overlap at the end of the tick,
+        and no new contacts were left when max_substeps ran out. Sets
+        next_dt, the length of tick that would just meet the bounds (at
+        most twice dt, and between min_dt and max_dt).
+
+        A tick of min_dt is always accepted. Assumes that cell_dcenters,
+        cell_dangs, cell_dlens, cell_n_cts and ct_dists are current on the
+        device.
+        """
+        n = self.n_cells
+        error = 0.0
+        if n > 0:
+            error = float(self.tick_error(numpy.int32(self.max_contacts),
+                                          numpy.float32(self.max_tick_move),
+                                          numpy.float32(self.max_overlap),
+                                          self.cell_dcenters_dev[0:n], self.cell_dangs_dev[0:n],
+                                          self.cell_lens_dev[0:n], self.cell_dlens_dev[0:n],
+                                          self.cell_n_cts_dev[0:n], self.ct_dists_dev).get())
+        if self.unresolved_cts > 0:
+            error = max(error, 2.0)
+        # moves and overlaps grow about in proportion to dt
+        min_dt = self.min_dt or self.max_dt/64.0
+        self.next_dt = dt*min(2.0, max(0.2, 0.9/error)) if error > 0 else 2.0*dt
+        self.next_dt = max(min(self.next_dt, self.max_dt), min_dt)
+        return error <= 1.0 or dt <= min_dt*(1.0+1e-6)
+
+    def reject_tick(self):
+        """Discard the tick just solved, so that it is solved again with a
+        tick of next_dt.
+        """
+        n = self.n_cells
+        self.vclearf4(self.cell_dcenters_dev[0:n])
+        self.vclearf4(self.cell_dangs_dev[0:n])
+        self.cell_dlens_dev[0:n].fill(0)
+        self.sub_tick_initialised = False
+        self.actual_dt = self.split_dt(self.next_dt)
+        self.tick_rejects += 1
+
     def progress_finalise(self):
         self.frame_no += 1
         self.progress_initialised = False
         self.seconds_elapsed = numpy.float32(time.time() - self.time_begin)
         self.minutes_elapsed = (numpy.float32(self.seconds_elapsed) / 60.0)  
         self.hours_elapsed = (numpy.float32(self.minutes_elapsed) / 60.0)  
+        # neighbours from this frame's contacts, before the contact arrays
+        # are reallocated
+        if self.simulator and self.computeNeighbours:
+            with self.profiler.phase('neighbours'):
+                self.update_neighbours()
+        # grow contact arrays for the next frame if cells are near the limit,
+        # or if contacts were dropped for want of space
+        if self.n_cells > 0:
+            n_contacts = int(device_max(self.cell_n_cts_dev[0:self.n_cells]).get())
+            n_overflow = int(self.ct_overflow_dev.get()[0])
+            if n_overflow > 0:
+                print('Warning: %i contact(s) did not fit in max_contacts = %i in frame %i' % (n_overflow, self.max_contacts, self.frame_no))
+                self.ct_overflows += n_overflow
+                self.ct_overflow_dev.fill(0)
+                n_contacts = self.max_contacts+1
+            self.reserve(self.n_cells, n_contacts)
+        self.cgs_frame_iters.append(sum([st[1] for st in self.cgs_stats]))
+        self.frame_ticks.append(self.n_frame_ticks)
         if self.frame_no % 10 == 0:
-            print('% 8i    % 8i cells    % 8i contacts    %f hour(s) or %f minute(s) or %f second(s)' % (self.frame_no, self.n_cells, self.n_cts, self.hours_elapsed, self.minutes_elapsed, self.seconds_elapsed))
+            print('% 8i    % 8i cells    % 8i contacts    % 8i CGS iterations    %f hour(s) or %f minute(s) or %f second(s)' % (self.frame_no, self.n_cells, self.n_cts, self.cgs_frame_iters[-1], self.hours_elapsed, self.minutes_elapsed, self.seconds_elapsed))
+            if self.adaptive_dt:
+                print('% 8i    % 8i ticks    next dt = %g    % 8i ticks rejected' % (self.frame_no, self.n_frame_ticks, self.next_dt, self.tick_rejects))
         # pull cells from the device and update simulator
         if self.simulator:
             self.get_cells()
             # TJR: added incremental construction of this dict to same places as idToIdx - not fully tested
             #idxToId = {idx: id for id, idx in self.simulator.idToIdx.iteritems()}
-            # TJR: add flag for this cos a bit time consuming
-            if self.computeNeighbours:
-                self.updateCellNeighbours(self.simulator.idxToId)
-            for state in list(self.simulator.cellStates.values()):
-                self.updateCellState(state)
+            with self.profiler.phase('cellStates'):
+                self.updateCellStates()
 
     def step(self, dt):
         """Step forward dt units of time.
@@ -578,28 +893,19 @@ class CLBacterium:
         #self.cell_dlens_dev.set(dt*self.cell_dlens)
         self.cell_dlens_dev[0:self.n_cells].set(dt*self.cell_growth_rates[0:self.n_cells])
 
-        # redefine gridding based on the range of cell positions
-        self.cell_centers[0:self.n_cells] = self.cell_centers_dev[0:self.n_cells].get()
-        self.update_grid() # we assume local cell_centers is current
-
-        # get each cell into the correct sq and retrieve from the device
-        self.bin_cells()
-
-        # sort cells and find sq index starts in the list
-        self.cell_sqs = self.cell_sqs_dev[0:self.n_cells].get() # get updated cell sqs
-        self.sort_cells()
-        self.sorted_ids_dev.set(self.sorted_ids) # push changes to the device
-        self.sq_inds_dev.set(self.sq_inds)
-
         self.n_cts = 0
         self.vcleari(self.cell_n_cts_dev) # clear the accumulated contact count
         self.sub_tick_i=0
+        self.unresolved_cts = 0
         self.sub_tick_initialised=True
 
     def tick(self, dt):
         if not self.sub_tick_initialised:
             self.sub_tick_init(dt)
         if self.sub_tick(dt):
+            if self.adaptive_dt and not self.accept_tick(dt):
+                self.reject_tick()
+                return False
             self.sub_tick_finalise()
             return True
         else:
@@ -607,28 +913,37 @@ class CLBacterium:
 
     def sub_tick(self, dt):
         old_n_cts = self.n_cts
-        self.predict()
-        # find all contacts
-        self.find_contacts()
-        # place 'backward' contacts in cells
-        self.collect_tos()
+        with self.profiler.phase('contacts'):
+            self.predict()
+            # find all contacts
+            self.find_contacts()
+            # place 'backward' contacts in cells
+            self.collect_tos()
 
         self.sub_tick_i += 1
         alpha = 10**(self.sub_tick_i)
         new_cts = self.n_cts - old_n_cts
         if (new_cts>0 or self.sub_tick_i==0) and self.sub_tick_i<self.max_substeps:
-            self.build_matrix() # Calculate entries of the matrix
+            with self.profiler.phase('matrix'):
+                self.compact_contacts()
+                self.build_matrix() # Calculate entries of the matrix
             #print "max cell contacts = %i"%cl_array.max(self.cell_n_cts_dev).get()
-            self.CGSSolve(dt, alpha) # invert MTMx to find deltap
+            with self.profiler.phase('cgs'):
+                self.CGSSolve(dt, alpha) # invert MTMx to find deltap
+            if self.warm_start_cgs and self.sub_tick_i==1:
+                self.save_warm_start()
             self.add_impulse()
             return False
         else:
+            # new contacts not solved for, when max_substeps ran out
+            self.unresolved_cts = new_cts
             return True
 
     def sub_tick_finalise(self):
         #print "Substeps = %d"%self.sub_tick_i
-        self.integrate()
-        self.calc_cell_geom()
+        with self.profiler.phase('move'):
+            self.integrate()
+            self.calc_cell_geom()
         self.sub_tick_initialised=False
 
     def initCellState(self, state):
@@ -649,18 +964,52 @@ class CLBacterium:
         #self.cell_dlens[i] = state.growthRate
         state.startVol = state.volume
 
-    def updateCellNeighbours(self, idx2Id):
-        ct_tos = self.ct_tos_dev[0:self.n_cells,:].get()
-        cell_to_cts = self.cell_n_cts_dev[0:self.n_cells].get()
-        cell_cts = numpy.zeros(self.n_cells, numpy.int32)
-        for i in range(self.n_cells):
-            for j in range(cell_to_cts[i]):
-                if ct_tos[i,j]>0:#not a plane contact
-                    self.neighbours[i, cell_cts[i]] = idx2Id[ct_tos[i,j]]
-                    cell_cts[i] += 1
-                    self.neighbours[ct_tos[i,j], cell_cts[ct_tos[i,j]]] = idx2Id[i]
-                    cell_cts[ct_tos[i,j]] += 1
-        self.cell_cts = cell_cts
+    def update_neighbours(self):
+        """Find the neighbours of each cell, the other cells it has contacts
+        with either way, without duplicates, and copy them to the host in
+        CSR form: the neighbours of cell i are the idxs
+        cell_nbrs[cell_nbr_offsets[i]:cell_nbr_offsets[i+1]].
+
+        Assumes cell_n_cts, ct_frs, ct_tos, cell_tos and n_cell_tos are
+        current on the device.
+        """
+        n = self.n_cells
+        if n == 0:
+            self.cell_nbr_offsets = numpy.zeros(1, numpy.int32)
+            self.cell_nbrs = numpy.zeros(0, numpy.int32)
+            return
+        self.program.find_neighbours(self.queue, (n,), None,
+                                     numpy.int32(self.max_contacts),
+                                     self.cell_n_cts_dev.data,
+                                     self.ct_frs_dev.data,
+                                     self.ct_tos_dev.data,
+                                     self.n_cell_tos_dev.data,
+                                     self.cell_tos_dev.data,
+                                     self.nbr_tmp_dev.data,
+                                     self.cell_n_nbrs_dev.data)
+        self.cell_n_nbrs_dev[n:n+1].fill(0)
+        self.scan_counts(self.cell_n_nbrs_dev[0:n+1], self.cell_nbr_offsets_dev[0:n+1], queue=self.queue)
+        self.program.compact_neighbours(self.queue, (n,), None,
+                                        numpy.int32(self.max_contacts),
+                                        self.nbr_tmp_dev.data,
+                                        self.cell_n_nbrs_dev.data,
+                                        self.cell_nbr_offsets_dev.data,
+                                        self.cell_nbrs_dev.data)
+        self.cell_nbr_offsets = self.cell_nbr_offsets_dev[0:n+1].get()
+        n_nbrs = int(self.cell_nbr_offsets[n])
+        self.cell_nbrs = self.cell_nbrs_dev[0:n_nbrs].get() if n_nbrs else numpy.zeros(0, numpy.int32)
+
+    def neighbour_idxs(self, i):
+        """Idxs of the neighbours of cell i, as found in the last step."""
+        if i+1 >= len(self.cell_nbr_offsets):
+            # a cell added since
+            return self.cell_nbrs[0:0]
+        return self.cell_nbrs[self.cell_nbr_offsets[i]:self.cell_nbr_offsets[i+1]]
+
+    def neighbour_ids(self, i):
+        """Ids of the neighbours of cell i, as found in the last step."""
+        idxToId = self.simulator.idxToId
+        return [idxToId[j] for j in self.neighbour_idxs(i).tolist()]
 
     def updateCellState(self, state):
         cid = state.id
@@ -679,11 +1028,10 @@ class CLBacterium:
         state.effGrowth = state.effGrowth / state.cellAge
         state.oldLen = state.length
 
-        state.neighbours = [] #clear contacts
-        if self.computeNeighbours: #populate cellstate.neighbours
-            for n in range(self.cell_cts[i]):
-                if self.neighbours[i,n] not in state.neighbours:
-                    state.neighbours.append(self.neighbours[i,n]) #ids of all cells in physical contact
+        if self.computeNeighbours: #ids of all cells in physical contact
+            state.neighbours = self.neighbour_ids(i)
+        else:
+            state.neighbours = []
         state.cts = len(state.neighbours)
 
         state.volume = state.length # TO DO: do something better here
@@ -694,6 +1042,77 @@ class CLBacterium:
         self.cell_growth_rates[i] = state.growthRate*state.length
 
 
+    def updateCellStates(self):
+        """Update the simulator's CellStore from our local copy of the
+        cells, for all cells at once (see updateCellState).
+
+        Assumes that our local copy of cells is current.
+        """
+        store = self.simulator.cellStore
+        n = self.n_cells
+        pos = self.cell_centers.view(numpy.float32).reshape((self.max_cells, 4))[0:n,0:3]
+        dirs = self.cell_dirs.view(numpy.float32).reshape((self.max_cells, 4))[0:n,0:3]
+        lens = self.cell_lens[0:n]
+
+        store['vel'][:] = pos - store['pos']
+        store['pos'][:] = pos
+        store['dir'][:] = dirs
+        store['radius'][:] = self.cell_rads[0:n]
+        store['length'][:] = lens
+        oldLen = store['oldLen']
+        store['strainRate'][:] = (lens - oldLen)/oldLen
+
+        #currently the effective growth rate is calculated over the entire history of the cell
+        cellAge = store['cellAge']
+        store['effGrowth'][:] = store['effGrowth']*cellAge + store['strainRate']*oldLen
+        cellAge += 1
+        store['effGrowth'] /= cellAge
+        oldLen[:] = lens
+
+        if self.computeNeighbours:
+            # cell states read their neighbours from the CSR arrays
+            store['cts'][:] = numpy.diff(self.cell_nbr_offsets)
+
+        store['volume'][:] = lens # TO DO: do something better here
+        half = (0.5*lens)[:,numpy.newaxis]*dirs
+        store['ends'][:,0,:] = pos - half
+        store['ends'][:,1,:] = pos + half
+        # Length vel is linearisation of exponential growth
+        self.cell_growth_rates[0:n] = store['growthRate']*lens
+
+    def grid_cells(self, centers=None):
+        """Bin the cells into grid squares, by centers (default
+        cell_centers), sort them by square, and find the start of each
+        square in the sorted list.
+
+        Assumes centers is current on the device.
+
+        Calculates cell_sqs, sorted_ids and sq_inds on the device.
+        """
+        if centers is None:
+            centers = self.cell_centers_dev
+        if self.hash_grid_size:
+            # the hash grid covers everything, no need to find the extent
+            self.n_sqs = self.hash_grid_size
+        elif self.device_grid:
+            self.update_grid_dev(centers)
+        else:
+            # redefine gridding based on the range of cell positions
+            coords = centers[0:self.n_cells].get().view(numpy.float32).reshape((self.n_cells, 4))
+            self.set_grid(coords[:,0].min(), coords[:,0].max(), coords[:,1].min(), coords[:,1].max())
+
+        # get each cell into the correct sq
+        self.bin_cells(centers)
+
+        # sort cells and find sq index starts in the list
+        if self.device_grid:
+            self.sort_cells_dev()
+        else:
+            self.cell_sqs = self.cell_sqs_dev[0:self.n_cells].get() # get updated cell sqs
+            self.sort_cells()
+            self.sorted_ids_dev.set(self.sorted_ids) # push changes to the device
+            self.sq_inds_dev.set(self.sq_inds)
+
     def update_grid(self):
         """Update our grid_(x,y)_min, grid_(x,y)_max, and n_sqs.
 
@@ -702,28 +1121,42 @@ class CLBacterium:
         coords = self.cell_centers.view(numpy.float32).reshape((self.max_cells, 4))
 
         x_coords = coords[:,0]
-        min_x_coord = x_coords.min()
-        max_x_coord = x_coords.max()
+        y_coords = coords[:,1]
+        self.set_grid(x_coords.min(), x_coords.max(), y_coords.min(), y_coords.max())
+
+    def update_grid_dev(self, centers):
+        """Update our grid_(x,y)_min, grid_(x,y)_max, and n_sqs, to cover
+        centers.
+
+        Assumes that centers is current on the device. Only the extent
+        of the cells is copied back.
+        """
+        ext = self.grid_extent(centers[0:self.n_cells]).get()
+        self.set_grid(ext['x'], -ext['z'], ext['y'], -ext['w'])
+
+    def set_grid(self, min_x_coord, max_x_coord, min_y_coord, max_y_coord):
+        """Set the grid to cover the given range of cell positions, growing
+        sq_inds if there are more than max_sqs squares.
+        """
+        # the square of the largest coord is included, even if the coord is
+        # on its lower edge (bin_cells also clamps to the grid)
         self.grid_x_min = int(math.floor(min_x_coord / self.grid_spacing))
-        self.grid_x_max = int(math.ceil(max_x_coord / self.grid_spacing))
-        if self.grid_x_min == self.grid_x_max:
-            self.grid_x_max += 1
+        self.grid_x_max = int(math.floor(max_x_coord / self.grid_spacing)) + 1
 
-        y_coords = coords[:,1]
-        min_y_coord = y_coords.min()
-        max_y_coord = y_coords.max()
         self.grid_y_min = int(math.floor(min_y_coord / self.grid_spacing))
-        self.grid_y_max = int(math.ceil(max_y_coord / self.grid_spacing))
-        if self.grid_y_min == self.grid_y_max:
-            self.grid_y_max += 1
+        self.grid_y_max = int(math.floor(max_y_coord / self.grid_spacing)) + 1
 
         self.n_sqs = (self.grid_x_max-self.grid_x_min)*(self.grid_y_max-self.grid_y_min)
+        if self.n_sqs > self.max_sqs:
+            self.max_sqs = newCapacity(self.max_sqs, self.n_sqs, self.grow_factor, 1.0)
+            self.sq_inds = numpy.zeros((self.max_sqs,), numpy.int32)
+            self.sq_inds_dev = cl_array.zeros(self.queue, (self.max_sqs,), numpy.int32)
 
 
-    def bin_cells(self):
-        """Call the bin_cells kernel.
+    def bin_cells(self, centers):
+        """Call the bin_cells kernel, on centers.
 
-        Assumes cell_centers is current on the device.
+        Assumes centers is current on the device.
 
         Calculates cell_sqs.
         """
@@ -735,7 +1168,10 @@ class CLBacterium:
                                numpy.int32(self.grid_y_min),
                                numpy.int32(self.grid_y_max),
                                numpy.float32(self.grid_spacing),
-                               self.cell_centers_dev.data,
+                               numpy.int32(self.hash_grid_size),
+                               centers.data,
+                               self.cell_colonies_dev.data,
+                               self.cell_grid_dev.data,
                                self.cell_sqs_dev.data).wait()
 
 
@@ -756,12 +1192,137 @@ class CLBacterium:
         self.sq_inds_dev.set(self.sq_inds)
 
 
+    def sort_cells_dev(self):
+        """Sort the cells by grid square and find the start of each
+        grid square's cells in that list, on the device.
+
+        Assumes that cell_sqs is current on the device.
+
+        Calculates sorted_ids and sq_inds on the device.
+        """
+        ids = cl_array.arange(self.queue, 0, self.n_cells, 1, dtype=numpy.int32)
+        # bin_cells keeps every sq in [0, n_sqs), so these bits hold them all
+        key_bits = max(2, int(self.n_sqs-1).bit_length())
+        key_bits += key_bits%2 # the sort takes 2 bits at a time
+        ((sorted_sqs, sorted_ids), evt) = self.sort_sqs(self.cell_sqs_dev[0:self.n_cells], ids,
+                                                         key_bits=key_bits)
+        cl.enqueue_copy(self.queue, self.sorted_ids_dev.data, sorted_ids.data,
+                        byte_count=sorted_ids.nbytes)
+
+        self.program.find_sq_starts(self.queue,
+                                    (self.n_cells,),
+                                    None,
+                                    numpy.int32(self.n_cells),
+                                    numpy.int32(self.n_sqs),
+                                    sorted_sqs.data,
+                                    self.sq_inds_dev.data).wait()
+
+
+    def update_candidates(self, centers, lens):
+        """Find the candidate contacts again if any cell has moved more than
+        half of contact_skin since they were last found (counting half its
+        change in length), or cells have been added or set since.
+
+        Assumes that cell_centers, cell_lens and cell_rads are current on the
+        device, and centers and lens are the positions and lengths contacts
+        will be found at.
+        """
+        n = self.n_cells
+        if n == 0:
+            return
+        if not self.cands_stale and n == self.cands_n_cells:
+            move = self.max_move(centers[0:n], self.cand_centers_dev[0:n],
+                                 lens[0:n], self.cand_lens_dev[0:n], self.cand_moves_dev[0:n]).get()
+            if 2.0*move <= self.contact_skin:
+                return
+        # the surrounding squares must hold every cell within touching
+        # distance (at most the longest cell plus two of the widest radii)
+        # plus MARGIN (see CLBacterium.cl) plus skin
+        reach = float(device_max(lens[0:n]).get()) + 2.0*float(device_max(self.cell_rads_dev[0:n]).get()) + \
+            0.01 + self.contact_skin
+        if reach > self.grid_spacing:
+            self.grid_spacing = reach
+        with self.profiler.phase('grid'):
+            # binned where the contacts will be found
+            self.grid_cells(centers)
+        self.find_candidates(centers, lens)
+        cl.enqueue_copy(self.queue, self.cand_centers_dev.data, centers.data,
+                        byte_count=n*centers.dtype.itemsize)
+        cl.enqueue_copy(self.queue, self.cand_lens_dev.data, lens.data,
+                        byte_count=n*lens.dtype.itemsize)
+        self.cand_moves_dev.fill(0)
+        self.cands_stale = False
+        self.cands_n_cells = n
+        self.n_cand_builds += 1
+
+    def find_candidates(self, centers, lens):
+        """Call the find_candidates kernel, growing max_cands and calling it
+        again if a cell has more candidates than there is room for.
+
+        Assumes that cell_rads, cell_sqs, sorted_ids, sq_inds, cell_n_cts and
+        ct_tos are current on the device.
+
+        Calculates cell_cands and cell_n_cands.
+        """
+        while True:
+            self.program.find_candidates(self.queue,
+                                         (self.n_cells,),
+                                         None,
+                                         numpy.int32(self.n_cells),
+                                         numpy.int32(self.grid_x_min),
+                                         numpy.int32(self.grid_x_max),
+                                         numpy.int32(self.grid_y_min),
+                                         numpy.int32(self.grid_y_max),
+                                         numpy.int32(self.hash_grid_size),
+                                         numpy.int32(self.n_sqs),
+                                         numpy.int32(self.max_contacts),
+                                         numpy.int32(self.max_cands),
+                                         numpy.float32(self.contact_skin),
+                                         centers.data,
+                                         lens.data,
+                                         self.cell_rads_dev.data,
+                                         self.cell_colonies_dev.data,
+                                         self.cell_sqs_dev.data,
+                                         self.cell_grid_dev.data,
+                                         self.sorted_ids_dev.data,
+                                         self.sq_inds_dev.data,
+                                         self.cell_n_cts_dev.data,
+                                         self.ct_tos_dev.data,
+                                         self.cell_cands_dev.data,
+                                         self.cell_n_cands_dev.data).wait()
+            n_cands = int(device_max(self.cell_n_cands_dev[0:self.n_cells]).get())
+            if n_cands <= self.max_cands:
+                return
+            self.max_cands = newCapacity(self.max_cands, n_cands, self.grow_factor, 1.0)
+            self.cell_cands_dev = cl_array.zeros(self.queue, (self.max_cells, self.max_cands), numpy.int32)
+
+    def divide_candidates(self, n):
+        """Call the divide_candidates kernel, after divide_cells has added n
+        daughters, or mark the candidates stale if there is not room for
+        them.
+
+        Assumes cell_cands, cell_n_cands and cell_daughters are current on
+        the device, and n_cells is the number of cells before division.
+        """
+        self.program.divide_candidates(self.queue,
+                                       (self.n_cells,),
+                                       None,
+                                       numpy.int32(self.max_cands),
+                                       self.cell_daughters_dev.data,
+                                       self.cell_cands_dev.data,
+                                       self.cell_n_cands_dev.data).wait()
+        n_cells = self.n_cells + n
+        if int(device_max(self.cell_n_cands_dev[0:n_cells]).get()) > self.max_cands:
+            self.cands_stale = True
+        else:
+            self.cands_n_cells = n_cells
+
     def find_contacts(self, predict=True):
-        """Call the find_contacts kernel.
+        """Call the find_contacts kernel, on the candidate contacts (see
+        update_candidates).
 
         Assumes that cell_centers, cell_dirs, cell_lens, cell_rads,
-        cell_sqs, cell_dcenters, cell_dlens, cell_dangs,
-        sorted_ids, and sq_inds are current on the device.
+        cell_dcenters, cell_dlens and cell_dangs are current on the device.
 
         Calculates cell_n_cts, ct_frs, ct_tos, ct_dists, ct_pts,
         ct_norms, ct_reldists, and n_cts.
@@ -775,6 +1336,8 @@ class CLBacterium:
             dirs = self.cell_dirs_dev
             lens = self.cell_lens_dev
 
+        self.update_candidates(centers, lens)
+
         self.program.find_plane_contacts(self.queue,
                                          (self.n_cells,),
                                          None,
@@ -795,7 +1358,8 @@ class CLBacterium:
                                          self.ct_pts_dev.data,
                                          self.ct_norms_dev.data,
                                          self.ct_reldists_dev.data,
-                                         self.ct_stiff_dev.data).wait()
+                                         self.ct_stiff_dev.data,
+                                         self.ct_overflow_dev.data).wait()
 
         self.program.find_sphere_contacts(self.queue,
                                          (self.n_cells,),
@@ -818,26 +1382,20 @@ class CLBacterium:
                                          self.ct_pts_dev.data,
                                          self.ct_norms_dev.data,
                                          self.ct_reldists_dev.data,
-                                         self.ct_stiff_dev.data).wait()
+                                         self.ct_stiff_dev.data,
+                                         self.ct_overflow_dev.data).wait()
 
         self.program.find_contacts(self.queue,
                                    (self.n_cells,),
                                    None,
-                                   numpy.int32(self.max_cells),
-                                   numpy.int32(self.n_cells),
-                                   numpy.int32(self.grid_x_min),
-                                   numpy.int32(self.grid_x_max),
-                                   numpy.int32(self.grid_y_min),
-                                   numpy.int32(self.grid_y_max),
-                                   numpy.int32(self.n_sqs),
                                    numpy.int32(self.max_contacts),
+                                   numpy.int32(self.max_cands),
                                    centers.data,
                                    dirs.data,
                                    lens.data,
                                    self.cell_rads_dev.data,
-                                   self.cell_sqs_dev.data,
-                                   self.sorted_ids_dev.data,
-                                   self.sq_inds_dev.data,
+                                   self.cell_cands_dev.data,
+                                   self.cell_n_cands_dev.data,
                                    self.cell_n_cts_dev.data,
                                    self.ct_frs_dev.data,
                                    self.ct_tos_dev.data,
@@ -846,60 +1404,76 @@ class CLBacterium:
                                    self.ct_norms_dev.data,
                                    self.ct_reldists_dev.data,
                                    self.ct_stiff_dev.data,
-                                   self.ct_overlap_dev.data).wait()
+                                   self.ct_overlap_dev.data,
+                                   self.ct_overflow_dev.data).wait()
 
         # set dtype to int32 so we don't overflow the int32 when summing
         #self.n_cts = self.cell_n_cts_dev.get().sum(dtype=numpy.int32)
-        self.n_cts = cl_array.sum(self.cell_n_cts_dev[0:self.n_cells]).get()
+        self.n_cts = int(cl_array.sum(self.cell_n_cts_dev[0:self.n_cells]).get())
 
 
     def collect_tos(self):
         """Call the collect_tos kernel.
 
-        Assumes that cell_sqs, sorted_ids, sq_inds, cell_n_cts,
-        ct_frs, and ct_tos are current on the device.
+        Assumes that cell_cands, cell_n_cands, cell_n_cts, ct_frs, and
+        ct_tos are current on the device.
 
         Calculates cell_tos and n_cell_tos.
         """
         self.program.collect_tos(self.queue,
                                  (self.n_cells,),
                                  None,
-                                 numpy.int32(self.max_cells),
-                                 numpy.int32(self.n_cells),
-                                 numpy.int32(self.grid_x_min),
-                                 numpy.int32(self.grid_x_max),
-                                 numpy.int32(self.grid_y_min),
-                                 numpy.int32(self.grid_y_max),
-                                 numpy.int32(self.n_sqs),
                                  numpy.int32(self.max_contacts),
-                                 self.cell_sqs_dev.data,
-                                 self.sorted_ids_dev.data,
-                                 self.sq_inds_dev.data,
+                                 numpy.int32(self.max_cands),
+                                 self.cell_cands_dev.data,
+                                 self.cell_n_cands_dev.data,
                                  self.cell_n_cts_dev.data,
                                  self.ct_frs_dev.data,
                                  self.ct_tos_dev.data,
                                  self.cell_tos_dev.data,
-                                 self.n_cell_tos_dev.data).wait()
+                                 self.n_cell_tos_dev.data,
+                                 self.ct_overflow_dev.data).wait()
+
 
+    def compact_contacts(self):
+        """Call the compact_contacts kernel, so that the matrix is built
+        and applied over the n_cts contacts rather than max_contacts slots
+        for each cell.
+
+        Assumes cell_n_cts and ct_reldists are current on the device, and
+        n_cts is the total of cell_n_cts.
+
+        Calculates ct_offsets, ct_slots and ent_reldists.
+        """
+        self.reserve_entries(self.n_cts)
+        self.scan_counts(self.cell_n_cts_dev[0:self.n_cells], self.ct_offsets_dev[0:self.n_cells], queue=self.queue)
+        self.program.compact_contacts(self.queue,
+                                      (self.n_cells,),
+                                      None,
+                                      numpy.int32(self.max_contacts),
+                                      self.cell_n_cts_dev.data,
+                                      self.ct_offsets_dev.data,
+                                      self.ct_reldists_dev.data,
+                                      self.ct_slots_dev.data,
+                                      self.ent_reldists_dev.data).wait()
 
     def build_matrix(self):
         """Build the matrix so we can calculate M^TMx = Ax.
 
         Assumes cell_centers, cell_dirs, cell_lens, cell_rads,
-        ct_inds, ct_frs, ct_tos, ct_dists, and ct_norms are current on
+        ct_slots, ct_frs, ct_tos, ct_dists, and ct_norms are current on
         the device.
 
         Calculates fr_ents and to_ents.
         """
         self.program.build_matrix(self.queue,
-                                  (self.n_cells, self.max_contacts),
+                                  (self.n_cts,),
                                   None,
-                                  numpy.int32(self.max_contacts),
+                                  self.ct_slots_dev.data,
                                   self.pred_cell_centers_dev.data,
                                   self.pred_cell_dirs_dev.data,
                                   self.pred_cell_lens_dev.data,
                                   self.cell_rads_dev.data,
-                                  self.cell_n_cts_dev.data,
                                   self.ct_frs_dev.data,
                                   self.ct_tos_dev.data,
                                   self.ct_pts_dev.data,
@@ -912,25 +1486,26 @@ class CLBacterium:
     def calculate_Ax(self, Ax, x, dt, alpha):
 
         self.program.calculate_Bx(self.queue,
-                                  (self.n_cells, self.max_contacts),
+                                  (self.n_cts,),
                                   None,
-                                  numpy.int32(self.max_contacts),
+                                  self.ct_slots_dev.data,
                                   self.ct_frs_dev.data,
                                   self.ct_tos_dev.data,
                                   self.fr_ents_dev.data,
                                   self.to_ents_dev.data,
                                   x.data,
-                                  self.Mx_dev.data).wait()
+                                  self.Bx_dev.data).wait()
         self.program.calculate_BTBx(self.queue,
                                     (self.n_cells,),
                                     None,
                                     numpy.int32(self.max_contacts),
                                     self.cell_n_cts_dev.data,
+                                    self.ct_offsets_dev.data,
                                     self.n_cell_tos_dev.data,
                                     self.cell_tos_dev.data,
                                     self.fr_ents_dev.data,
                                     self.to_ents_dev.data,
-                                    self.Mx_dev.data,
+                                    self.Bx_dev.data,
                                     Ax.data).wait()
         # Tikhonov test
         #self.vaddkx(Ax, numpy.float32(0.01), Ax, x)
@@ -960,7 +1535,11 @@ class CLBacterium:
 
         # There must be a way to do this using built in pyopencl - what
         # is it?!
-        self.vclearf(self.deltap_dev[0:self.n_cells])
+        if self.warm_start_cgs and self.sub_tick_i==1:
+            cl.enqueue_copy(self.queue, self.deltap_dev.data, self.warm_deltap_dev.data,
+                            byte_count=self.n_cells*self.deltap_dev.dtype.itemsize)
+        else:
+            self.vclearf(self.deltap_dev[0:self.n_cells])
         self.vclearf(self.rhs_dev[0:self.n_cells])
 
         # put M^T n^Tv_rel in rhs (b)
@@ -969,11 +1548,12 @@ class CLBacterium:
                                     None,
                                     numpy.int32(self.max_contacts),
                                     self.cell_n_cts_dev.data,
+                                    self.ct_offsets_dev.data,
                                     self.n_cell_tos_dev.data,
                                     self.cell_tos_dev.data,
                                     self.fr_ents_dev.data,
                                     self.to_ents_dev.data,
-                                    self.ct_reldists_dev.data,
+                                    self.ent_reldists_dev.data,
                                     self.rhs_dev.data).wait()
 
 
@@ -981,23 +1561,31 @@ class CLBacterium:
         self.calculate_Ax(self.BTBx_dev, self.deltap_dev, dt, alpha)
         self.vsub(self.res_dev[0:self.n_cells], self.rhs_dev[0:self.n_cells], self.BTBx_dev[0:self.n_cells])
 
-        # p = res
-        cl.enqueue_copy(self.queue, self.p_dev[0:self.n_cells].data, self.res_dev[0:self.n_cells].data)
-
         # rsold = l2norm(res)
         rsold = self.vdot(self.res_dev[0:self.n_cells], self.res_dev[0:self.n_cells]).get()
         rsfirst = rsold
         if math.sqrt(rsold/self.n_cells) < self.cgs_tol:
-            if self.printing and self.frame_no%10==0:
-                print('% 5i'%self.frame_no + '% 6i cells  % 6i cts  % 6i iterations  residual = %f' % (self.n_cells,
-            self.n_cts, 0, math.sqrt(rsold/self.n_cells)))
-            return (0.0, rsold)
+            return self.cgs_report(0, math.sqrt(rsold/self.n_cells))
+
+        # z = P^-1 res, p = z, rzold = res^Tz (z is res without a preconditioner)
+        if self.precond:
+            self.build_preconditioner()
+            self.apply_preconditioner(self.res_dev, self.z_dev)
+            cl.enqueue_copy(self.queue, self.p_dev[0:self.n_cells].data, self.z_dev[0:self.n_cells].data)
+            rzold = self.vdot(self.res_dev[0:self.n_cells], self.z_dev[0:self.n_cells]).get()
+        else:
+            cl.enqueue_copy(self.queue, self.p_dev[0:self.n_cells].data, self.res_dev[0:self.n_cells].data)
+            rzold = rsold
 
         # iterate
         # max iters = matrix dimension = 7 (dofs) * num cells
         #dying=False
         max_iters = self.n_cells*7
-            
+
+        if self.fused_cgs:
+            (iters, rsnew) = self.fused_cgs_iterate(rsold, rzold, max_iters)
+            return self.cgs_report(iters, math.sqrt(rsnew/self.n_cells))
+
         for iter in range(max_iters):
             # Ap
             self.calculate_Ax(self.Ap_dev[0:self.n_cells], self.p_dev[0:self.n_cells], dt, alpha)
@@ -1005,8 +1593,8 @@ class CLBacterium:
             # p^TAp
             pAp = self.vdot(self.p_dev[0:self.n_cells], self.Ap_dev[0:self.n_cells]).get()
 
-            # alpha = rsold/p^TAp
-            alpha = numpy.float32(rsold/pAp)
+            # alpha = rzold/p^TAp
+            alpha = numpy.float32(rzold/pAp)
 
             # x = x + alpha*p, x=self.disp
             self.vaddkx(self.deltap_dev[0:self.n_cells], alpha, self.deltap_dev[0:self.n_cells], self.p_dev[0:self.n_cells])
@@ -1026,16 +1614,165 @@ class CLBacterium:
             #if rsnew/rsold>2.0:
             #    break
 
-            # p = res + rsnew/rsold *p
-            self.vaddkx(self.p_dev[0:self.n_cells], numpy.float32(rsnew/rsold), self.res_dev[0:self.n_cells], self.p_dev[0:self.n_cells])
+            # p = z + rznew/rzold *p
+            if self.precond:
+                self.apply_preconditioner(self.res_dev, self.z_dev)
+                rznew = self.vdot(self.res_dev[0:self.n_cells], self.z_dev[0:self.n_cells]).get()
+                self.vaddkx(self.p_dev[0:self.n_cells], numpy.float32(rznew/rzold), self.z_dev[0:self.n_cells], self.p_dev[0:self.n_cells])
+            else:
+                rznew = rsnew
+                self.vaddkx(self.p_dev[0:self.n_cells], numpy.float32(rznew/rzold), self.res_dev[0:self.n_cells], self.p_dev[0:self.n_cells])
 
-            rsold = rsnew
+            rzold = rznew
             #print '        ',iter,rsold
 
+        return self.cgs_report(iter+1, math.sqrt(rsnew/self.n_cells))
+
+    def save_warm_start(self):
+        """Keep deltap as the starting point for the first solve of the
+        next frame (see warm_start_cgs).
+        """
+        cl.enqueue_copy(self.queue, self.warm_deltap_dev.data, self.deltap_dev.data,
+                        byte_count=self.n_cells*self.deltap_dev.dtype.itemsize)
+
+    def cgs_report(self, iters, residual):
+        """Record (and print every 10 frames) the iterations and residual of
+        a solve, for each substep of the frame.
+
+        Returns (iters, residual).
+        """
+        self.cgs_stats.append((self.sub_tick_i, iters, residual))
         if self.printing and self.frame_no%10==0:
-            print('% 5i'%self.frame_no + '% 6i cells  % 6i cts  % 6i iterations  residual = %f' % (self.n_cells, self.n_cts, iter+1, math.sqrt(rsnew/self.n_cells)))
-        return (iter+1, math.sqrt(rsnew/self.n_cells))
+            print('% 5i'%self.frame_no + '% 6i cells  % 6i cts  substep % 2i  % 6i iterations  residual = %f' % (self.n_cells,
+                self.n_cts, self.sub_tick_i, iters, residual))
+        return (iters, residual)
+
+    def build_preconditioner(self):
+        """Build the preconditioner from the diagonal blocks of the matrix
+        built by build_matrix.
+        """
+        self.program.build_preconditioner(self.queue,
+                                          (self.n_cells,),
+                                          None,
+                                          numpy.int32(self.max_contacts),
+                                          numpy.int32(self.precond),
+                                          numpy.float32(self.muA),
+                                          numpy.float32(self.gamma),
+                                          self.cell_n_cts_dev.data,
+                                          self.ct_offsets_dev.data,
+                                          self.n_cell_tos_dev.data,
+                                          self.cell_tos_dev.data,
+                                          self.fr_ents_dev.data,
+                                          self.to_ents_dev.data,
+                                          self.cell_dirs_dev.data,
+                                          self.cell_lens_dev.data,
+                                          self.cell_rads_dev.data,
+                                          self.Pinv_dev.data).wait()
+
+    def apply_preconditioner(self, x, Pinvx):
+        self.program.apply_preconditioner(self.queue,
+                                          (self.n_cells,),
+                                          None,
+                                          numpy.int32(self.precond),
+                                          self.Pinv_dev.data,
+                                          x.data,
+                                          Pinvx.data).wait()
+
+    def fused_cgs_iterate(self, rsold, rzold, max_iters):
+        """Run CG iterations on deltap with the fused kernels.
+
+        Assumes res, z (if preconditioned) and p are set up, rsold =
+        res^Tres and rzold = res^Tz. alpha and beta stay on the device, and
+        the residual is only copied back every cgs_check_interval
+        iterations to test for convergence.
+
+        Returns (iterations, res^T res).
+        """
+        n = self.n_cells
+        wg = self.cgs_group_size
+        n_groups = (n+wg-1)//wg
+        gsize = (n_groups*wg,)
+        lsize = (wg,)
+        scratch = cl.LocalMemory(4*wg)
+        knl = self.cgs_kernels
+        z_dev = self.z_dev if self.precond else self.res_dev
+
+        self.cgs_scalars[0] = rzold
+        self.cgs_scalars[3] = rsold
+        cl.enqueue_copy(self.queue, self.cgs_scalars_dev.data, self.cgs_scalars)
+
+        rsnew = rsold
+        for iter in range(max_iters):
+            # Bp, Ap = B^TBp + Mp/gamma, p^TAp
+            knl['calculate_Bx'](self.queue, (self.n_cts,), None,
+                                self.ct_slots_dev.data,
+                                self.ct_frs_dev.data,
+                                self.ct_tos_dev.data,
+                                self.fr_ents_dev.data,
+                                self.to_ents_dev.data,
+                                self.p_dev.data,
+                                self.Bx_dev.data)
+            knl['cg_calculate_Ap'](self.queue, gsize, lsize,
+                                   numpy.int32(n),
+                                   numpy.int32(self.max_contacts),
+                                   numpy.float32(self.muA),
+                                   numpy.float32(self.gamma),
+                                   self.cell_n_cts_dev.data,
+                                   self.ct_offsets_dev.data,
+                                   self.n_cell_tos_dev.data,
+                                   self.cell_tos_dev.data,
+                                   self.fr_ents_dev.data,
+                                   self.to_ents_dev.data,
+                                   self.cell_dirs_dev.data,
+                                   self.cell_lens_dev.data,
+                                   self.cell_rads_dev.data,
+                                   self.Bx_dev.data,
+                                   self.p_dev.data,
+                                   self.Ap_dev.data,
+                                   scratch,
+                                   self.cgs_partials_dev.data)
+            # alpha = rzold/p^TAp
+            knl['cg_alpha'](self.queue, lsize, lsize,
+                            numpy.int32(n_groups),
+                            self.cgs_partials_dev.data,
+                            self.cgs_scalars_dev.data,
+                            scratch)
+            # x = x + alpha*p, res = res - alpha*Ap, z = P^-1 res,
+            # rsnew = res^Tres, rznew = res^Tz
+            knl['cg_update_xr'](self.queue, gsize, lsize,
+                                numpy.int32(n),
+                                numpy.int32(self.precond),
+                                self.cgs_scalars_dev.data,
+                                self.p_dev.data,
+                                self.Ap_dev.data,
+                                self.Pinv_dev.data,
+                                self.deltap_dev.data,
+                                self.res_dev.data,
+                                z_dev.data,
+                                scratch,
+                                self.cgs_partials_dev.data)
+            # beta = rznew/rzold
+            knl['cg_beta'](self.queue, lsize, lsize,
+                           numpy.int32(n_groups),
+                           self.cgs_partials_dev.data,
+                           self.cgs_scalars_dev.data,
+                           scratch)
 
+            # Test for convergence
+            if (iter+1)%self.cgs_check_interval == 0 or iter == max_iters-1:
+                cl.enqueue_copy(self.queue, self.cgs_scalars, self.cgs_scalars_dev.data)
+                rsnew = self.cgs_scalars[3]
+                if math.sqrt(rsnew/n) < self.cgs_tol:
+                    break
+
+            # p = z + beta*p
+            knl['cg_update_p'](self.queue, gsize, lsize,
+                               numpy.int32(n),
+                               self.cgs_scalars_dev.data,
+                               z_dev.data,
+                               self.p_dev.data)
+
+        return (iter+1, rsnew)
 
     def predict(self):
         """Predict cell centers, dirs, lens for a timestep dt based
@@ -1094,14 +1831,13 @@ class CLBacterium:
     def divide_cell(self, i, d1i, d2i):
         """Divide a cell into two equal sized daughter cells.
 
-        Fails silently if we're out of cells.
+        Grows the arrays if we're out of cells.
 
         Assumes our local copy of cells is current.
 
         Calculates new cell_centers, cell_dirs, cell_lens, and cell_rads.
         """
-        if self.n_cells >= self.max_cells:
-            return
+        self.reserve(self.n_cells+1)
         # idxs of the two new cells
         a = d1i
         b = d2i
@@ -1150,6 +1886,8 @@ class CLBacterium:
         self.cell_lens[b] = daughter_len
         self.cell_rads[a] = parent_rad
         self.cell_rads[b] = parent_rad
+        self.cell_colonies[a] = self.cell_colonies[i]
+        self.cell_colonies[b] = self.cell_colonies[i]
 
         self.n_cells += 1
 
@@ -1169,11 +1907,113 @@ class CLBacterium:
         self.cell_dangs[a] = parent_dang
         self.cell_dangs[b] = parent_dang
 
+        # Daughters start the next solve from the parent's solution
+        if self.warm_start_cgs:
+            dp = self.warm_deltap_dev[i:i+1].get()
+            dp['s6'] *= 0.5
+            self.warm_deltap_dev[a:a+1].set(dp)
+            self.warm_deltap_dev[b:b+1].set(dp)
+
 
         #return indices of daughter cells
         return (a,b)
 
 
+    def divide_cells(self, pidxs, d1idxs, d2idxs):
+        """Divide a list of cells into two equal sized daughter cells
+        each, using one call to the divide_cells kernel.
+
+        Grows the arrays if we're out of cells.
+
+        Assumes cells are current on the device. Updates cell centers,
+        dirs, lens, rads, vols and velocities on the device, and copies
+        back only the daughter cells to keep our local copy current.
+        """
+        n = len(pidxs)
+        if n == 0:
+            return
+        self.reserve(self.n_cells+n)
+        # the daughters can keep their parents' contact candidates, if they
+        # are current and each parent becomes d1 and a new cell d2
+        keep_cands = not self.cands_stale and self.cands_n_cells == self.n_cells and \
+            not self.alternate_divisions and numpy.array_equal(pidxs, d1idxs) and \
+            numpy.min(d2idxs) >= self.n_cells
+
+        # direction jitter for each daughter (d1,d2 of each parent in turn)
+        jitter = numpy.zeros((2*n,), vec.float4)
+        if not self.alternate_divisions:
+            jit = jitter.view(numpy.float32).reshape((2*n, 4))
+            jit[:,0:3] = numpy.random.uniform(-0.001,0.001,(2*n,3))
+            if not self.jitter_z: jit[:,2] = 0.0
+
+        parents_dev = cl_array.to_device(self.queue, numpy.asarray(pidxs, numpy.int32))
+        d1s_dev = cl_array.to_device(self.queue, numpy.asarray(d1idxs, numpy.int32))
+        d2s_dev = cl_array.to_device(self.queue, numpy.asarray(d2idxs, numpy.int32))
+        jitter_dev = cl_array.to_device(self.queue, jitter)
+
+        self.program.divide_cells(self.queue,
+                                  (n,),
+                                  None,
+                                  numpy.int32(self.alternate_divisions),
+                                  parents_dev.data,
+                                  d1s_dev.data,
+                                  d2s_dev.data,
+                                  jitter_dev.data,
+                                  self.cell_centers_dev.data,
+                                  self.cell_dirs_dev.data,
+                                  self.cell_lens_dev.data,
+                                  self.cell_rads_dev.data,
+                                  self.cell_vols_dev.data,
+                                  self.cell_dcenters_dev.data,
+                                  self.cell_dangs_dev.data,
+                                  self.warm_deltap_dev.data,
+                                  self.cand_centers_dev.data,
+                                  self.cand_lens_dev.data,
+                                  self.cand_moves_dev.data,
+                                  self.cell_daughters_dev.data).wait()
+        if keep_cands:
+            self.divide_candidates(n)
+        else:
+            self.cands_stale = True
+        self.cell_daughters_dev.fill(0)
+
+        self.n_cells += n
+        self.parents.update(zip(d2idxs, d1idxs))
+        colonies = self.cell_colonies[pidxs]
+        self.cell_colonies[d1idxs] = colonies
+        self.cell_colonies[d2idxs] = colonies
+
+        # copy the daughters back into our local copy
+        idxs = numpy.concatenate((d1idxs, d2idxs))
+        idxs_dev = cl_array.to_device(self.queue, numpy.asarray(idxs, numpy.int32))
+        for (local, dev) in [(self.cell_centers, self.cell_centers_dev),
+                             (self.cell_dirs, self.cell_dirs_dev),
+                             (self.cell_lens, self.cell_lens_dev),
+                             (self.cell_rads, self.cell_rads_dev),
+                             (self.cell_dcenters, self.cell_dcenters_dev),
+                             (self.cell_dangs, self.cell_dangs_dev)]:
+            local[idxs] = cl_array.take(dev, idxs_dev).get()
+
+    def initCellStates(self, idxs):
+        """Vectorized initCellState for the cells with the given idxs."""
+        store = self.simulator.cellStore
+        cols = store.columns
+        pos = self.cell_centers.view(numpy.float32).reshape((self.max_cells, 4))[idxs,0:3]
+        dirs = self.cell_dirs.view(numpy.float32).reshape((self.max_cells, 4))[idxs,0:3]
+        lens = self.cell_lens[idxs]
+        cols['pos'][idxs] = pos
+        cols['dir'][idxs] = dirs
+        cols['radius'][idxs] = self.cell_rads[idxs]
+        cols['length'][idxs] = lens
+        #for effective growth calulations
+        cols['oldLen'][idxs] = lens
+        cols['volume'][idxs] = lens # TO DO: do something better here
+        half = (0.5*lens)[:,numpy.newaxis]*dirs
+        cols['ends'][idxs,0,:] = pos - half
+        cols['ends'][idxs,1,:] = pos + half
+        cols['strainRate'][idxs] = 0.0
+        cols['startVol'][idxs] = lens
+
     def calc_cell_geom(self):
         """Calculate cell geometry using lens/rads on card."""
         # swap cell vols and cell_vols old
@@ -1189,66 +2029,46 @@ class CLBacterium:
                             self.cell_lens_dev[0:self.n_cells])
 
 
-    def profileGrid(self):
+    def profile_calls(self, name, func, n):
+        """Time n calls of func on the current cells, printing the time per
+        call and appending it to the file <name>_prof.
+        """
+        prof = Profiler(True, self.queue)
+        for i in range(n):
+            with prof.phase(name):
+                func()
+        prof.endStep(0)
+        t = prof.totals[name]/n
+        print("%s timing for %i calls, time per call (s) = %f"%(name, n, t))
+        open("%s_prof"%name,"a").write( "%i, %i, %f\n"%(self.n_cells,self.n_cts,t) )
+        return t
+
+    def profileGrid(self, n=1000):
         if self.n_cts==0:
             return
-        import time
-        t1 = time.clock()
-        for i in range(1000):
-            # redefine gridding based on the range of cell positions
-            self.cell_centers = self.cell_centers_dev.get()
-            self.update_grid() # we assume local cell_centers is current
-
-            # get each cell into the correct sq and retrieve from the device
-            self.bin_cells()
-
-            # sort cells and find sq index starts in the list
-            self.cell_sqs = self.cell_sqs_dev.get() # get updated cell sqs
-            self.sort_cells()
-            self.sorted_ids_dev.set(self.sorted_ids) # push changes to the device
-            self.sq_inds_dev.set(self.sq_inds)
-        t2 = time.clock()
-        print("Grid stuff timing for 1000 calls, time per call (s) = %f"%((t2-t1)*0.001))
-        open("grid_prof","a").write( "%i, %i, %f\n"%(self.n_cells,self.n_cts,(t2-t1)*0.001) )
+        return self.profile_calls('grid', self.grid_cells, n)
 
-
-    def profileFindCts(self):
+    def profileFindCts(self, n=1000):
         if self.n_cts==0:
             return
-        import time
-        t1 = time.clock()
-        dt = 0.005
-        for i in range(1000):
+        def find_cts():
             self.n_cts = 0
             self.vcleari(self.cell_n_cts_dev) # clear the accumulated contact count
-            self.predict(dt)
+            self.predict()
             # find all contacts
-            self.find_contacts(dt)
+            self.find_contacts()
             # place 'backward' contacts in cells
             self.collect_tos()
+        return self.profile_calls('findcts', find_cts, n)
 
-            # compact the contacts so we can dispatch only enough threads
-            # to deal with each
-            self.ct_frs = self.ct_frs_dev.get()
-            self.ct_tos = self.ct_tos_dev.get()
-            self.compact_cts()
-            self.ct_inds_dev.set(self.ct_inds)
-        t2 = time.clock()
-        print("Find contacts timing for 1000 calls, time per call (s) = %f"%((t2-t1)*0.001))
-        open("findcts_prof","a").write( "%i, %i, %f\n"%(self.n_cells,self.n_cts,(t2-t1)*0.001) )
-
-    def profileCGS(self):
+    def profileCGS(self, n=1000):
         if self.n_cts==0:
             return
-        import time
-        t1 = time.clock()
-        dt = 0.005
-        for i in range(1000):
-            self.build_matrix(dt) # Calculate entries of the matrix
-            (iters, res) = self.CGSSolve()
-            print("cgs prof: iters=%i, res=%f"%(iters,res))
-        t2 = time.clock()
-        print("CGS timing for 1000 calls, time per call (s) = %f"%((t2-t1)*0.001))
-        open("cgs_prof","a").write( "%i, %i, %i, %f\n"%(self.n_cells,self.n_cts,iters,(t2-t1)*0.001) )
+        dt = self.actual_dt if hasattr(self, 'actual_dt') else 0.005
+        def cgs():
+            self.compact_contacts()
+            self.build_matrix() # Calculate entries of the matrix
+            self.CGSSolve(dt, 10.0)
+        return self.profile_calls('cgs', cgs, n)
 
 
@@ -61,6 +61,12 @@ class CLFixedPosition:
         state.volume = self.cell_vols[i] 
         self.cell_growth_rates[i] = state.growthRate*state.volume
 
+    def updateCellStates(self):
+        # Vectorized updateCellState over the simulator's CellStore
+        store = self.simulator.cellStore
+        store['volume'][:] = self.cell_vols[0:self.n_cells]
+        self.cell_growth_rates[0:self.n_cells] = store['growthRate']*store['volume']
+
     def get_cells(self):
         """Copy cell centers, dirs, lens, and rads from the device."""
         self.cell_centers[0:self.n_cells] = self.cell_centers_dev[0:self.n_cells].get()
@@ -81,8 +87,7 @@ class CLFixedPosition:
 
         if self.simulator:
             self.get_cells()
-            for state in list(self.simulator.cellStates.values()):
-                self.updateCellState(state)
+            self.updateCellStates()
 
         return True
 
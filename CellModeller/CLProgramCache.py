@@ -0,0 +1,156 @@
+"""
+On-disk cache of built OpenCL program binaries.
+
+Programs are keyed by a hash of the expanded kernel source, the build
+options, and the platform, device and driver versions, so a change to any
+of these gives a new entry. Binaries are kept in the 'clcache' directory
+under CMPATH (or ~/.cache/CellModeller if CMPATH is not set):
+
+    program = CLProgramCache.buildProgram(context, kernel_src)
+
+The ElementwiseKernel and ReductionKernel helpers are built by pyopencl, so
+for those the context's cache_dir is pointed at the same directory with
+useContext(context). pyopencl leaves caching to the driver on platforms
+that cache sources themselves (e.g. pocl, NVIDIA).
+
+Remove old entries with:
+
+    python -m CellModeller.CLProgramCache --max-age 30 --max-size 500
+"""
+
+import hashlib
+import os
+import pickle
+import sys
+import time
+import pyopencl as cl
+
+## Set CMCLCACHE=0 in the environment to always build from source
+enabled = os.environ.get('CMCLCACHE', '1') != '0'
+
+## Number of programs loaded from the cache, and built from source
+hits = 0
+misses = 0
+
+
+def cacheDir():
+    if 'CMPATH' in os.environ:
+        base = os.environ['CMPATH']
+    else:
+        base = os.path.join(os.path.expanduser('~'), '.cache', 'CellModeller')
+    return os.path.join(base, 'clcache')
+
+
+def cacheKey(context, src, options=None):
+    h = hashlib.sha256()
+    h.update(src.encode())
+    h.update(repr(options).encode())
+    for dev in context.devices:
+        for info in [dev.platform.name, dev.platform.version,
+                     dev.name, dev.version, dev.driver_version]:
+            h.update(info.encode())
+    return h.hexdigest()
+
+
+## Point pyopencl's own binary cache for context (used by ElementwiseKernel
+# and ReductionKernel) at our cache directory
+def useContext(context):
+    if enabled:
+        context.cache_dir = os.path.join(cacheDir(), 'pyopencl')
+
+
+## Build the program src for the devices of context, loading the binary from
+# the cache if we have built it before
+def buildProgram(context, src, options=None):
+    global hits, misses
+    if not enabled:
+        misses += 1
+        return cl.Program(context, src).build(options, cache_dir=False)
+
+    path = os.path.join(cacheDir(), cacheKey(context, src, options)+'.bin')
+    if os.path.exists(path):
+        try:
+            with open(path, 'rb') as f:
+                binaries = pickle.load(f)
+            program = cl.Program(context, context.devices, binaries).build(options)
+            os.utime(path) # mark as recently used, for prune()
+            hits += 1
+            return program
+        except Exception as e:
+            print("Ignoring bad OpenCL cache entry %s: %s" % (path, e))
+
+    misses += 1
+    program = cl.Program(context, src).build(options, cache_dir=False)
+    try:
+        os.makedirs(cacheDir(), exist_ok=True)
+        # Write then rename, so that concurrent runs never see a partial file
+        tmp = '%s.%d.tmp' % (path, os.getpid())
+        with open(tmp, 'wb') as f:
+            pickle.dump(program.get_info(cl.program_info.BINARIES), f, protocol=-1)
+        os.replace(tmp, path)
+    except OSError as e:
+        print("Couldn't write OpenCL cache entry %s: %s" % (path, e))
+    return program
+
+
+def hitRate():
+    total = hits + misses
+    return float(hits)/total if total else 0.0
+
+
+def stats():
+    return "OpenCL program cache: %i hit(s), %i miss(es), hit rate %.0f%%" \
+            % (hits, misses, 100*hitRate())
+
+
+## Remove cache entries not used in the last maxAge days, then the least
+# recently used entries until the cache is at most maxSize MB.
+# Returns the number of files removed.
+def prune(maxAge=None, maxSize=None, path=None):
+    path = path or cacheDir()
+    entries = []
+    for (dirpath, dirnames, filenames) in os.walk(path):
+        for name in filenames:
+            fname = os.path.join(dirpath, name)
+            st = os.stat(fname)
+            entries.append((st.st_mtime, st.st_size, fname))
+    entries.sort()
+
+    now = time.time()
+    size = sum([e[1] for e in entries])
+    removed = 0
+    for (mtime, fsize, fname) in entries:
+        old = maxAge is not None and now-mtime > maxAge*24*3600
+        big = maxSize is not None and size > maxSize*1024*1024
+        if not (old or big):
+            continue
+        try:
+            os.remove(fname)
+        except OSError:
+            continue
+        size -= fsize
+        removed += 1
+    return removed
+
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description='Prune the CellModeller OpenCL program cache')
+    parser.add_argument('--max-age', type=float, default=None,
+                        help='remove entries not used for this many days')
+    parser.add_argument('--max-size', type=float, default=None,
+                        help='remove least recently used entries until the cache is this many MB')
+    parser.add_argument('--clear', action='store_true', help='remove all entries')
+    parser.add_argument('--dir', default=None, help='cache directory (default %s)' % cacheDir())
+    args = parser.parse_args()
+
+    maxSize = 0 if args.clear else args.max_size
+    if args.max_age is None and maxSize is None:
+        parser.print_help()
+        sys.exit(1)
+    n = prune(args.max_age, maxSize, args.dir)
+    print("Removed %i file(s) from %s" % (n, args.dir or cacheDir()))
+
+
+if __name__ == '__main__':
+    main()
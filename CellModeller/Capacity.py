@@ -0,0 +1,62 @@
+"""
+Helpers for growing the preallocated host and device arrays used by the
+biophysics and integrator models, so that simulations are not limited by
+the max_cells/maxCells given at construction.
+
+A model that wants to grow keeps the previous arrays, reallocates for the
+new capacity with its usual init function, and copies across:
+
+    old = dict(self.__dict__)
+    self.max_cells = newCapacity(self.max_cells, n)
+    self.init_data()
+    copyRows(self.queue, old, self.__dict__, old['max_cells'], self.n_cells)
+"""
+
+import math
+import numpy
+import pyopencl as cl
+import pyopencl.array as cl_array
+
+## Default factor by which capacity grows
+growFactor = 1.5
+## Default fraction of capacity in use above which we grow
+growThreshold = 0.9
+
+
+## Capacity needed to hold n items: the current capacity if n is within
+# threshold*capacity, otherwise capacity grown geometrically by factor
+def newCapacity(capacity, n, factor=growFactor, threshold=growThreshold):
+    while n > threshold*capacity:
+        capacity = int(math.ceil(capacity*factor))
+    return capacity
+
+
+## Copy arrays from the dict old into the reallocated arrays of the same
+# name in the dict new (e.g. an object's __dict__ before and after
+# reallocation).
+# Arrays with the same shape are copied whole, arrays whose first dimension
+# grew from rows are copied up to row n. Anything else (e.g. contact arrays
+# whose row length changed) is left as newly allocated.
+def copyRows(queue, old, new, rows, n):
+    for (name, newarr) in new.items():
+        oldarr = old.get(name)
+        if oldarr is None or oldarr is newarr:
+            continue
+        if isinstance(newarr, numpy.ndarray) and isinstance(oldarr, numpy.ndarray):
+            if oldarr.dtype != newarr.dtype:
+                continue
+            if oldarr.shape == newarr.shape:
+                newarr[...] = oldarr
+            elif oldarr.shape[0] == rows and oldarr.shape[1:] == newarr.shape[1:]:
+                newarr[0:n] = oldarr[0:n]
+        elif isinstance(newarr, cl_array.Array) and isinstance(oldarr, cl_array.Array):
+            if oldarr.dtype != newarr.dtype:
+                continue
+            if oldarr.shape == newarr.shape:
+                nbytes = oldarr.nbytes
+            elif oldarr.shape[0] == rows and oldarr.shape[1:] == newarr.shape[1:]:
+                nbytes = (oldarr.nbytes//rows)*n
+            else:
+                continue
+            if nbytes > 0:
+                cl.enqueue_copy(queue, newarr.data, oldarr.data, byte_count=nbytes)
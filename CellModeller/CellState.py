@@ -1,13 +1,93 @@
+import copy
 
 class CellState:
     # Don't show these attributes in gui
     excludeAttr = ['id', 'divideFlag', 'ends','cellAdh']
 
-    def __init__(self, cid):
+    # If store is given the state is a view onto row idx of the CellStore:
+    # attributes with a column in the store are read from/written to it,
+    # anything else is kept on the object as usual.
+    def __init__(self, cid, store=None, idx=None):
+        self.__dict__['_store'] = None
+        if store is not None:
+            self.idx = idx
+            store.bind(self)
         self.id = cid
         self.growthRate = 1.0
         self.color = [0.5,0.5,0.5]
         self.divideFlag = False
         self.cellAge = 0
-        self.neighbours = []
+        if store is None or store.neighbourIds is None:
+            self.neighbours = []
         self.effGrowth = 0.0
+
+    def __getattr__(self, name):
+        # Only called if name is not found in the instance dict
+        store = self.__dict__.get('_store')
+        if store is not None:
+            if name in store.columns:
+                return store.columns[name][self.__dict__['idx']]
+            if name == 'neighbours' and store.neighbourIds is not None:
+                return store.neighbourIds(self.__dict__['idx'])
+        raise AttributeError(name)
+
+    def __setattr__(self, name, value):
+        store = self.__dict__.get('_store')
+        if store is not None and name in store.columns:
+            store.columns[name][self.__dict__['idx']] = value
+        else:
+            self.__dict__[name] = value
+
+    ## All attributes of this cell, including those held in the store
+    def getAttributes(self):
+        attrs = dict(self.__dict__)
+        del attrs['_store']
+        store = self.__dict__.get('_store')
+        if store is not None:
+            for (name, col) in store.columns.items():
+                val = col[self.idx]
+                attrs[name] = val.copy() if val.shape else val
+            if 'neighbours' not in attrs and store.neighbourIds is not None:
+                attrs['neighbours'] = store.neighbourIds(self.idx)
+        return attrs
+
+    ## Copy the row out of the store, so that this state no longer tracks it
+    # (e.g. a parent cell whose row is reused by a daughter)
+    def detach(self):
+        self.__dict__.update(self.getAttributes())
+        self.__dict__['_store'] = None
+
+    ## Make a copy of this state with a new id, bound to row idx of store
+    def copy(self, cid, store=None, idx=None):
+        state = CellState.__new__(CellState)
+        state.__dict__.update(copy.deepcopy(self.getAttributes()))
+        state.__dict__['_store'] = None
+        state.id = cid
+        if store is not None:
+            state.idx = idx
+            store.bind(state)
+        return state
+
+    ## Make a view onto row idx of store, with a copy of this state's
+    # attributes that are not held in the store. The row is not modified.
+    def copyView(self, cid, store, idx):
+        state = CellState.__new__(CellState)
+        d = state.__dict__
+        for (name, val) in self.__dict__.items():
+            if name != '_store' and name not in store.columns:
+                d[name] = copy.deepcopy(val)
+        if store.neighbourIds is not None:
+            d.pop('neighbours', None)
+        d['_store'] = store
+        d['id'] = cid
+        d['idx'] = idx
+        return state
+
+    # Pickle (and copy/deepcopy) as a plain detached state, so that saved
+    # data does not depend on the store
+    def __getstate__(self):
+        return self.getAttributes()
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.__dict__['_store'] = None
@@ -0,0 +1,141 @@
+import numpy
+
+class CellStore:
+    """
+Columnar (struct-of-arrays) storage for per-cell state.
+
+Each column is a contiguous numpy array indexed by cell idx, the same
+index used by the flat arrays in the biophysics, integrator and signalling
+models. CellState objects created by the Simulator are thin views onto one
+row of this store, so models written against the per-cell update(cells)
+interface keep working, while vectorized code can operate on whole columns:
+
+    vols = sim.cellStore['volume']      # view of the first n rows
+    sim.cellStore['divideFlag'][:] = vols > sim.cellStore['targetVol']
+
+The store grows geometrically as cells are added, so views of columns
+should not be held across steps.
+"""
+
+    # name: (dtype, shape of one row, default value)
+    defaultColumns = {
+        'pos':        (numpy.float32, (3,), 0.0),
+        'dir':        (numpy.float32, (3,), 0.0),
+        'vel':        (numpy.float32, (3,), 0.0),
+        'ends':       (numpy.float32, (2,3), 0.0),
+        'length':     (numpy.float32, (), 0.0),
+        'radius':     (numpy.float32, (), 0.0),
+        'volume':     (numpy.float32, (), 0.0),
+        'startVol':   (numpy.float32, (), 0.0),
+        'oldLen':     (numpy.float32, (), 0.0),
+        'strainRate': (numpy.float32, (), 0.0),
+        'growthRate': (numpy.float32, (), 1.0),
+        'effGrowth':  (numpy.float32, (), 0.0),
+        'cellAge':    (numpy.int32, (), 0),
+        'cellType':   (numpy.int32, (), 0),
+        'cellAdh':    (numpy.float32, (), 0.0),
+        'cts':        (numpy.int32, (), 0),
+        'time':       (numpy.float32, (), 0.0),
+        'divideFlag': (numpy.bool_, (), False),
+        'color':      (numpy.float32, (3,), 0.5),
+    }
+
+    def __init__(self, capacity=1024):
+        self.n = 0
+        self.capacity = capacity
+        # Function giving the neighbour ids of the cell with idx i, if the
+        # biophysics model finds them. CellStates then get their neighbours
+        # from it when asked, rather than holding a list.
+        self.neighbourIds = None
+        self.specs = {}
+        self.columns = {}
+        for (name, (dtype, shape, default)) in self.defaultColumns.items():
+            self.addColumn(name, dtype, shape, default)
+
+    def __len__(self):
+        return self.n
+
+    def __contains__(self, name):
+        return name in self.columns
+
+    def __getitem__(self, name):
+        # View of the rows currently in use
+        return self.columns[name][0:self.n]
+
+    def __setitem__(self, name, value):
+        self.columns[name][0:self.n] = value
+
+    ## Add a column, e.g. for a user defined attribute like targetVol.
+    # Columns should be added in the model setup(), before cells are added,
+    # so that CellState views resolve the attribute from the store.
+    def addColumn(self, name, dtype=numpy.float32, shape=(), default=0.0):
+        if name in self.columns:
+            return self.columns[name]
+        self.specs[name] = (dtype, tuple(shape), default)
+        col = numpy.empty((self.capacity,)+tuple(shape), dtype=dtype)
+        col[:] = default
+        self.columns[name] = col
+        return col
+
+    ## Make sure there is space for n rows, growing the arrays geometrically
+    def reserve(self, n):
+        if n <= self.capacity:
+            return
+        capacity = self.capacity
+        while capacity < n:
+            capacity = capacity*2
+        for (name, col) in list(self.columns.items()):
+            (dtype, shape, default) = self.specs[name]
+            newcol = numpy.empty((capacity,)+shape, dtype=dtype)
+            newcol[0:self.capacity] = col
+            newcol[self.capacity:] = default
+            self.columns[name] = newcol
+        self.capacity = capacity
+
+    ## Set row idx of every column back to its default value
+    def resetRow(self, idx):
+        self.reserve(idx+1)
+        for (name, col) in self.columns.items():
+            col[idx] = self.specs[name][2]
+        if idx >= self.n:
+            self.n = idx+1
+
+    ## Copy row src into rows dst (int or array of ints) of every column
+    def copyRows(self, src, dst):
+        dst = numpy.asarray(dst)
+        if dst.size == 0:
+            return
+        self.reserve(int(dst.max())+1)
+        for col in self.columns.values():
+            col[dst] = col[src]
+        self.n = max(self.n, int(dst.max())+1)
+
+    def reset(self):
+        self.n = 0
+        for (name, col) in self.columns.items():
+            col[:] = self.specs[name][2]
+
+    ## Bind a CellState to its row in the store.
+    # Any attributes of the state with the same name as a column are moved
+    # into the store, so detached states (e.g. unpickled) can be rebound.
+    def bind(self, state):
+        d = state.__dict__
+        idx = d['idx']
+        self.resetRow(idx)
+        for name in list(d.keys()):
+            if name in self.columns:
+                self.columns[name][idx] = d.pop(name)
+        if self.neighbourIds is not None:
+            d.pop('neighbours', None)
+        d['_store'] = self
+
+    ## Populate the store from a dict of (possibly detached) CellStates
+    def load(self, cellStates):
+        for state in cellStates.values():
+            if state.__dict__.get('_store') is not None:
+                state.detach()
+        self.reset()
+        if cellStates:
+            self.reserve(max([s.idx for s in cellStates.values()])+1)
+        for state in cellStates.values():
+            self.bind(state)
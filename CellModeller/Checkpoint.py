@@ -0,0 +1,413 @@
+"""
+Columnar checkpoints of the simulation state, an alternative to the
+step-%05i.pickle files written by Simulator.writePickle.
+
+Each checkpoint is a (compressed) numpy .npz file, step-%05i.npz, holding
+one array per CellStore column and per numeric cell attribute, rather than
+a pickle of every CellState object. Lineage is stored as the entries added
+since the previous checkpoint, and the model source is not repeated, as
+the Simulator writes it once to the output directory.
+
+Set sim.checkpointFormat = 'npz' in the model setup() to use them. They
+load with the same interface as the pickled data dict:
+
+    data = Checkpoint.load('data/ex1-.../step-00100.npz')
+    sim.loadFromPickle(data)
+
+CellStates are only built when accessed; data.column(name) gives a whole
+column without building any. Arrays in uncompressed checkpoints
+(sim.checkpointCompress = False) are memory-mapped rather than read. See
+CellModeller.io for reading whole runs.
+
+Output can be written on a background thread with a Writer, so that the
+simulation only waits for a copy of the data to be taken:
+
+    writer = Checkpoint.Writer()
+    writer.submit(Checkpoint.writeData, filename, Checkpoint.snapshot(...))
+    writer.flush()
+"""
+
+import os
+import re
+import glob
+import pickle
+import queue
+import struct
+import atexit
+import zipfile
+import threading
+from collections.abc import Mapping
+import numpy
+import numpy.lib.format
+
+from CellModeller.CellState import CellState
+
+formatVersion = 1
+
+# CellState attributes that are not stored as columns
+_ignoreAttrs = ['_store', 'id', 'idx']
+_missing = object()
+
+
+## Write a checkpoint of cellStates, whose column attributes are held in
+# store, to filename.
+# lineage is a dict of the lineage entries (id: parent id) added since the
+# last checkpoint, and arrays any other named arrays to keep (e.g. species
+# levels).
+def save(filename, cellStates, store, stepNum, lineage=None, moduleName=None,
+         arrays=None, compress=True):
+    writeData(filename, snapshot(cellStates, store, stepNum, lineage, moduleName, arrays),
+              compress)
+
+
+## The arrays of a checkpoint (see save), copied so that the simulation can
+# carry on while they are written
+def snapshot(cellStates, store, stepNum, lineage=None, moduleName=None, arrays=None):
+    n = len(cellStates)
+    states = list(cellStates.values())
+    ids = numpy.fromiter(cellStates.keys(), numpy.int64, n)
+    idxs = numpy.fromiter((s.__dict__['idx'] for s in states), numpy.int64, n)
+    # in idx order, so column reads are sequential
+    order = numpy.argsort(idxs, kind='stable')
+    ids = ids[order]
+    idxs = idxs[order]
+    states = [states[k] for k in order]
+
+    data = {}
+    data['formatVersion'] = numpy.int32(formatVersion)
+    data['stepNum'] = numpy.int64(stepNum)
+    data['moduleName'] = numpy.str_(moduleName or '')
+    data['ids'] = ids
+    data['idxs'] = idxs
+    for (name, col) in store.columns.items():
+        data['col_'+name] = col[idxs]
+
+    # Attributes kept on the CellState objects: numeric ones of the same
+    # shape for all cells become arrays, anything else is pickled
+    names = set()
+    for s in states:
+        names.update(s.__dict__.keys())
+    objects = {}
+    for name in sorted(names):
+        if name in _ignoreAttrs or name in store.columns:
+            continue
+        values = [s.__dict__.get(name, _missing) for s in states]
+        if any([v is _missing for v in values]):
+            # only some cells have it, keep {row: value}
+            objects[name] = dict([(k, v) for (k, v) in enumerate(values) if v is not _missing])
+            continue
+        try:
+            arr = numpy.asarray(values)
+        except ValueError:
+            arr = None
+        if arr is not None and arr.dtype.kind in 'biuf':
+            data['attr_'+name] = arr
+        else:
+            objects[name] = values
+    data['objects'] = numpy.frombuffer(pickle.dumps(objects, protocol=-1), numpy.uint8)
+
+    lineage = lineage or {}
+    data['lineageIds'] = numpy.fromiter(lineage.keys(), numpy.int64, len(lineage))
+    data['lineageParents'] = numpy.fromiter(lineage.values(), numpy.int64, len(lineage))
+
+    for (name, arr) in (arrays or {}).items():
+        data['data_'+name] = numpy.array(arr)
+    return data
+
+
+## Write the arrays of a snapshot to the checkpoint file filename
+def writeData(filename, data, compress=True):
+    # write then rename, so that a partial file is never left behind
+    tmp = filename + '.tmp'
+    with open(tmp, 'wb') as f:
+        if compress:
+            numpy.savez_compressed(f, **data)
+        else:
+            numpy.savez(f, **data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, filename)
+
+
+## Write the bytes data (e.g. a pickle) to filename
+def writeBytes(filename, data):
+    tmp = filename + '.tmp'
+    with open(tmp, 'wb') as f:
+        f.write(data)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, filename)
+
+
+class Writer:
+    """Runs output functions (e.g. writeData) in order on a background
+    thread.
+
+    At most maxPending writes are queued, after which submit() waits for
+    the oldest to finish, so memory use is bounded if the disk can't keep
+    up. Errors in the background are raised from the next submit() or
+    flush(). Pending writes are flushed at exit.
+    """
+
+    def __init__(self, maxPending=2):
+        self.queue = queue.Queue(maxPending)
+        self.error = None
+        self.thread = threading.Thread(target=self.run, name='CheckpointWriter')
+        self.thread.daemon = True
+        self.thread.start()
+        atexit.register(self.close)
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            try:
+                if item is None:
+                    return
+                (func, args) = item
+                func(*args)
+            except Exception as e:
+                self.error = e
+            finally:
+                self.queue.task_done()
+
+    ## Call func(*args) on the writer thread, waiting if the queue is full
+    def submit(self, func, *args):
+        self.check()
+        if not self.thread.is_alive():
+            raise RuntimeError("Checkpoint writer has been closed")
+        self.queue.put((func, args))
+
+    ## Wait for all submitted writes to finish
+    def flush(self):
+        self.queue.join()
+        self.check()
+
+    ## Flush and stop the writer thread
+    def close(self):
+        if self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+        self.check()
+
+    def check(self):
+        if self.error is not None:
+            (e, self.error) = (self.error, None)
+            raise e
+
+
+## Load a checkpoint (.npz) or pickle file, returning the data dict
+def load(filename):
+    if filename.endswith('.npz'):
+        return Checkpoint(filename)
+    with open(filename, 'rb') as f:
+        return pickle.load(f)
+
+
+class NpzArrays(Mapping):
+    """The arrays of an .npz file, read when accessed. Arrays that are
+    stored uncompressed are memory-mapped (if mmap is True).
+    """
+
+    def __init__(self, filename, mmap=True):
+        self.filename = filename
+        self.mmap = mmap
+        with zipfile.ZipFile(filename) as z:
+            self.infos = dict([(info.filename[:-len('.npy')], info) for info in z.infolist()
+                               if info.filename.endswith('.npy')])
+        self.files = list(self.infos.keys())
+
+    def __len__(self):
+        return len(self.files)
+
+    def __iter__(self):
+        return iter(self.files)
+
+    def __getitem__(self, name):
+        info = self.infos[name]
+        if self.mmap and info.compress_type == zipfile.ZIP_STORED:
+            arr = self.memmap(info)
+            if arr is not None:
+                return arr
+        with zipfile.ZipFile(self.filename) as z:
+            with z.open(info) as f:
+                return numpy.lib.format.read_array(f, allow_pickle=False)
+
+    def memmap(self, info):
+        with open(self.filename, 'rb') as f:
+            # skip the zip local file header to the .npy data
+            f.seek(info.header_offset)
+            header = f.read(30)
+            (name_len, extra_len) = struct.unpack('<HH', header[26:30])
+            f.seek(info.header_offset + 30 + name_len + extra_len)
+            version = numpy.lib.format.read_magic(f)
+            if version == (1, 0):
+                (shape, fortran, dtype) = numpy.lib.format.read_array_header_1_0(f)
+            else:
+                (shape, fortran, dtype) = numpy.lib.format.read_array_header_2_0(f)
+            offset = f.tell()
+        if dtype.hasobject or not shape or 0 in shape:
+            return None
+        return numpy.memmap(self.filename, dtype=dtype, mode='r', offset=offset,
+                            shape=shape, order='F' if fortran else 'C')
+
+
+def _stepOf(filename):
+    m = re.search(r'step-(\d+)\.npz$', filename)
+    return int(m.group(1)) if m else None
+
+
+class Checkpoint(Mapping):
+    """A checkpoint file, read as the data dict written by
+    Simulator.writePickle: cellStates, stepNum, lineage, moduleStr,
+    moduleName, and any of specData, sigData etc.
+
+    Arrays are read from the file as they are needed.
+    """
+
+    def __init__(self, filename, mmap=True):
+        self.filename = filename
+        self.npz = NpzArrays(filename, mmap)
+        self.arrays = {}
+        self.cache = {}
+        self.idxToId = None
+        self.stepNum = int(self.array('stepNum'))
+        self.moduleName = str(self.array('moduleName'))
+
+    def array(self, name):
+        if name not in self.arrays:
+            self.arrays[name] = self.npz[name]
+        return self.arrays[name]
+
+    ## Array of the CellStore column (or numeric attribute) name, in the
+    # order of ids()
+    def column(self, name):
+        if 'col_'+name in self.npz.files:
+            return self.array('col_'+name)
+        return self.array('attr_'+name)
+
+    def ids(self):
+        return self.array('ids')
+
+    ## Ids of the neighbours of the cell with idx i, from the neighbour
+    # lists in CSR form if they were saved (see
+    # CLBacterium.update_neighbours)
+    def neighbourIds(self, i):
+        offsets = self.array('data_nbrOffsets')
+        if i+1 >= len(offsets):
+            return []
+        if self.idxToId is None:
+            self.idxToId = dict(zip(self.array('idxs').tolist(), self.ids().tolist()))
+        nbrs = self.array('data_nbrIdxs')[offsets[i]:offsets[i+1]]
+        return [self.idxToId[j] for j in nbrs.tolist()]
+
+    def keys(self):
+        keys = ['cellStates', 'stepNum', 'lineage', 'moduleStr', 'moduleName']
+        keys += [k[len('data_'):] for k in self.npz.files if k.startswith('data_')]
+        return keys
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def __getitem__(self, key):
+        if key not in self.cache:
+            self.cache[key] = self.read(key)
+        return self.cache[key]
+
+    def read(self, key):
+        if key == 'cellStates':
+            return CellStates(self)
+        elif key == 'stepNum':
+            return self.stepNum
+        elif key == 'moduleName':
+            return self.moduleName
+        elif key == 'lineage':
+            return self.lineage()
+        elif key == 'moduleStr':
+            path = os.path.join(os.path.dirname(self.filename), self.moduleName)
+            if not os.path.exists(path):
+                return None
+            with open(path) as f:
+                return f.read()
+        elif 'data_'+key in self.npz.files:
+            return self.array('data_'+key)
+        raise KeyError(key)
+
+    ## Lineage up to this checkpoint, from the lineage entries of this and
+    # all earlier checkpoints in the same directory
+    def lineage(self):
+        lineage = {}
+        path = os.path.dirname(self.filename) or '.'
+        files = [f for f in glob.glob(os.path.join(path, 'step-*.npz'))
+                 if _stepOf(f) is not None and _stepOf(f) <= self.stepNum]
+        for f in sorted(files, key=_stepOf):
+            if os.path.abspath(f) == os.path.abspath(self.filename):
+                npz = self.npz
+            else:
+                npz = NpzArrays(f)
+            lineage.update(zip(npz['lineageIds'].tolist(), npz['lineageParents'].tolist()))
+        return lineage
+
+    ## Pickled non-numeric attributes, as {name: list of values}, or
+    # {name: {row: value}} for attributes only some cells have
+    def objects(self):
+        if 'objects' not in self.cache:
+            self.cache['objects'] = pickle.loads(self.array('objects').tobytes())
+        return self.cache['objects']
+
+
+class CellStates(Mapping):
+    """The cellStates dict of a Checkpoint, building each (detached)
+    CellState when it is first accessed.
+    """
+
+    def __init__(self, checkpoint):
+        self.checkpoint = checkpoint
+        self.ids = checkpoint.ids()
+        self.rows = None
+        self.states = {}
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __iter__(self):
+        return iter(self.ids.tolist())
+
+    def __contains__(self, cid):
+        self.buildRows()
+        return cid in self.rows
+
+    def buildRows(self):
+        if self.rows is None:
+            self.rows = dict(zip(self.ids.tolist(), range(len(self.ids))))
+
+    def __getitem__(self, cid):
+        state = self.states.get(cid)
+        if state is None:
+            self.buildRows()
+            state = self.build(cid, self.rows[cid])
+            self.states[cid] = state
+        return state
+
+    def build(self, cid, row):
+        ckpt = self.checkpoint
+        state = CellState.__new__(CellState)
+        d = state.__dict__
+        d['_store'] = None
+        d['id'] = int(cid)
+        d['idx'] = int(ckpt.array('idxs')[row])
+        for name in ckpt.npz.files:
+            if name.startswith('col_') or name.startswith('attr_'):
+                val = ckpt.array(name)[row]
+                d[name.split('_', 1)[1]] = val.copy() if val.shape else val
+        for (name, values) in ckpt.objects().items():
+            if isinstance(values, dict):
+                if row in values:
+                    d[name] = values[row]
+            else:
+                d[name] = values[row]
+        if 'neighbours' not in d and 'data_nbrOffsets' in ckpt.npz.files:
+            d['neighbours'] = ckpt.neighbourIds(d['idx'])
+        return state
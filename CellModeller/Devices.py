@@ -0,0 +1,170 @@
+"""
+The OpenCL devices of this node, and scheduling of simulations onto them.
+
+Devices are given as (platform number, device number), or "p:d" in the
+environment:
+
+    CELLMODELLER_DEVICE=1:0     device used by a Simulator when none is given
+    CELLMODELLER_DEVICES=0:0,1:0  devices the Scheduler may use (default all)
+
+A Scheduler divides the devices into slots, each of which runs one
+simulation at a time, at most maxPerDevice per device (fewer if memPerSim
+is given and the device does not have the memory for them). Slots are
+handed out round robin over the devices, or to the device with the most
+memory left. Batch uses a Scheduler to place its runs:
+
+    scheduler = Devices.Scheduler(maxPerDevice=2, policy='memory')
+    Batch.runBatch('model.py', runs, scheduler=scheduler, steps=1000)
+
+Run this module to list the devices, and the slots of a scheduler over them.
+"""
+
+import os
+import sys
+import argparse
+import pyopencl as cl
+
+deviceEnvVar = 'CELLMODELLER_DEVICE'
+devicesEnvVar = 'CELLMODELLER_DEVICES'
+
+
+class Device:
+    """An OpenCL device, with its platform and device numbers as used by
+    Simulator (clPlatformNum, clDeviceNum).
+    """
+
+    def __init__(self, platformNum, deviceNum, device):
+        self.platformNum = platformNum
+        self.deviceNum = deviceNum
+        self.name = device.name.strip()
+        self.platformName = device.platform.name.strip()
+        self.type = cl.device_type.to_string(device.type)
+        self.computeUnits = device.max_compute_units
+        self.globalMem = device.global_mem_size
+        self.freeMem = self.globalMem
+        try:
+            # only reported by some vendors (in KB)
+            free = device.global_free_memory_amd
+            if isinstance(free, (list, tuple)):
+                free = free[0]
+            self.freeMem = free*1024
+        except (cl.Error, AttributeError):
+            pass
+
+    @property
+    def key(self):
+        return (self.platformNum, self.deviceNum)
+
+    def __repr__(self):
+        return "%i:%i %s (%s, %s, %i compute units, %.0f MB)" % (self.platformNum, self.deviceNum,
+               self.name, self.platformName, self.type, self.computeUnits, self.freeMem/1024.0/1024.0)
+
+
+## Parse a device "p:d" (or "p", device 0) to (platform, device)
+def parseDevice(s):
+    parts = s.strip().split(':')
+    if len(parts) > 2 or not all([p.strip().isdigit() for p in parts]):
+        raise ValueError("device should be given as platform:device, not %r" % s)
+    return (int(parts[0]), int(parts[1]) if len(parts) > 1 else 0)
+
+
+def formatDevice(key):
+    return "%i:%i" % tuple(key)
+
+
+## (platform, device) from CELLMODELLER_DEVICE, or default if it is not set
+def deviceFromEnv(default=(0, 0)):
+    s = os.environ.get(deviceEnvVar)
+    return parseDevice(s) if s else default
+
+
+## All OpenCL devices, or those listed in CELLMODELLER_DEVICES
+def listDevices():
+    devices = []
+    for (p, platform) in enumerate(cl.get_platforms()):
+        for (d, device) in enumerate(platform.get_devices()):
+            devices.append(Device(p, d, device))
+    s = os.environ.get(devicesEnvVar)
+    if s:
+        keys = [parseDevice(k) for k in s.split(',') if k.strip()]
+        devices = [dev for dev in devices if dev.key in keys]
+    return devices
+
+
+class Scheduler:
+    """Slots for running simulations on a set of devices (default all, see
+    listDevices), as (platform, device). maxPerDevice simulations may run on
+    a device at once, or fewer if a simulation needs memPerSim bytes of
+    device memory. policy is 'roundRobin' or 'memory' (each slot goes to
+    the device with the most memory left).
+    """
+
+    def __init__(self, devices=None, maxPerDevice=1, memPerSim=None, policy='roundRobin'):
+        if policy not in ['roundRobin', 'memory']:
+            raise ValueError("Scheduler policy should be 'roundRobin' or 'memory', not %r" % policy)
+        if devices is None:
+            devices = listDevices()
+        else:
+            # (platform, device) pairs or "p:d" strings
+            available = dict([(dev.key, dev) for dev in listDevices()])
+            keys = [parseDevice(k) if isinstance(k, str) else tuple(k) for k in devices]
+            missing = [k for k in keys if k not in available]
+            if missing:
+                raise ValueError("No OpenCL device(s) %s" % ', '.join([formatDevice(k) for k in missing]))
+            devices = [available[k] for k in keys]
+        self.devices = devices
+        self.maxPerDevice = maxPerDevice
+        self.memPerSim = memPerSim
+        self.policy = policy
+        self.caps = dict([(dev.key, self.capacity(dev)) for dev in devices])
+        if not sum(self.caps.values()):
+            raise ValueError("No OpenCL device can run a simulation (memPerSim=%s)" % memPerSim)
+        self.slots = self.makeSlots()
+
+    ## Number of simulations that may run on dev at once
+    def capacity(self, dev):
+        cap = self.maxPerDevice
+        if self.memPerSim:
+            cap = min(cap, int(dev.freeMem // self.memPerSim))
+        return cap
+
+    ## The (platform, device) of each slot, in the order they are handed out
+    def makeSlots(self):
+        used = dict([(dev.key, 0) for dev in self.devices])
+        slots = []
+        while len(slots) < sum(self.caps.values()):
+            free = [dev for dev in self.devices if used[dev.key] < self.caps[dev.key]]
+            if self.policy == 'memory':
+                # device with the most memory per simulation once this one is added
+                dev = max(free, key=lambda dev: dev.freeMem/(used[dev.key]+1))
+                used[dev.key] += 1
+                slots.append(dev.key)
+            else:
+                for dev in free:
+                    used[dev.key] += 1
+                    slots.append(dev.key)
+        return slots
+
+    def __len__(self):
+        return len(self.slots)
+
+    def __iter__(self):
+        return iter(self.slots)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="List OpenCL devices and how simulations are scheduled on them.")
+    parser.add_argument('--per-device', type=int, default=1, help="maximum simulations per device")
+    parser.add_argument('--mem-per-sim', type=float, help="device memory needed by a simulation (MB)")
+    parser.add_argument('--policy', choices=['roundRobin', 'memory'], default='roundRobin')
+    args = parser.parse_args(argv)
+    for dev in listDevices():
+        print(dev)
+    memPerSim = args.mem_per_sim*1024*1024 if args.mem_per_sim else None
+    scheduler = Scheduler(maxPerDevice=args.per_device, memPerSim=memPerSim, policy=args.policy)
+    print("Slots: %s" % ' '.join([formatDevice(k) for k in scheduler]))
+    print("Default device (%s): %s" % (deviceEnvVar, formatDevice(deviceFromEnv())))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
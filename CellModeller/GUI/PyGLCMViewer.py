@@ -243,12 +243,12 @@ class PyGLCMViewer(PyGLWidget):
             if cid in states:
                 txt += '<b>Selected Cell (id = %d)</b><br>'%(cid)
                 s = states[cid]
-                for (name,val) in list(s.__dict__.items()):
+                for (name,val) in list(s.getAttributes().items()):
                     if name not in CellState.excludeAttr:
                         txt += '<b>' + name + '</b>:\t'
                         if type(val) in [float, np.float32, np.float64]:
                             txt += '%g'%val
-                        elif type(val) in [list, tuple, np.array]:
+                        elif type(val) in [list, tuple, np.ndarray]:
                             txt += ', '.join(['%g'%v for v in val])
                         else:
                             txt += str(val)
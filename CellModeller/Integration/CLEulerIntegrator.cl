@@ -33,3 +33,30 @@ __kernel void diluteSpecs(const int numSpecies,
     specRates[base+i] = specRates[base+i]*factor;
   }
 }
+
+__kernel void speciesDT(const int numSpecies,
+                        __global float* cellSpecLevels,
+                        __global const float* specRate,
+                        const float dt)
+{
+  int id = get_global_id(0);
+  int specbase = id*numSpecies;
+
+  for(int i=0; i < numSpecies; i++)
+  {
+    cellSpecLevels[specbase+i] += dt * specRate[specbase+i];
+  }
+}
+
+__kernel void copyRows(const int rowLen,
+                       __global const int* src,
+                       __global const int* dst,
+                       __global float* data)
+{
+  int id = get_global_id(0);
+  int sbase = src[id]*rowLen;
+  int dbase = dst[id]*rowLen;
+  for (int i = 0; i < rowLen; i++) {
+    data[dbase+i] = data[sbase+i];
+  }
+}
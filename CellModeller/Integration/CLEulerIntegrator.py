@@ -4,20 +4,35 @@ import pyopencl as cl
 import pyopencl.array as cl_array
 from pyopencl.array import vec
 import math
+import time
+from CellModeller.Capacity import newCapacity, copyRows
+from CellModeller.CLProgramCache import buildProgram
 
 class CLEulerIntegrator:
     #Simple forward Euler integration of species rates
     
-    def __init__(self, sim, nSpecies, maxCells, regul=None):
+    def __init__(self, sim, nSpecies, maxCells, regul=None, growFactor=1.5, growThreshold=0.9, deviceResident=False):
         self.sim = sim
         self.dt = self.sim.dt
         self.regul = regul
+        # With deviceResident the species levels are kept on the device
+        # between steps, and only copied to the host when needed (see
+        # syncHost and hostArrays), otherwise they are copied back after
+        # every step
+        self.deviceResident = deviceResident
+        # Which copies of the levels are current
+        self.hostValid = True
+        self.deviceValid = False
 
         self.cellStates = sim.cellStates
         self.nCells = len(self.cellStates)
 
         self.nSpecies = nSpecies
         self.maxCells = maxCells
+        # maxCells is grown by growFactor when more than growThreshold of
+        # the space is in use, see reserve()
+        self.growFactor = growFactor
+        self.growThreshold = growThreshold
 
         self.maxSpecDataLen = self.maxCells*nSpecies
         # no need to scale up signal storage
@@ -46,33 +61,72 @@ class CLEulerIntegrator:
         # Rate views (references) to the data
         self.specRate = self.rates[0:self.maxSpecDataLen].reshape(self.maxCells,self.nSpecies)
 
+    def reserve(self, n):
+        # Make sure there is space for n cells, reallocating the levels and
+        # per-cell arrays if needed. The views onto them, including the
+        # species of each cell state, are rebuilt.
+        maxCells = newCapacity(self.maxCells, n, self.growFactor, self.growThreshold)
+        if maxCells == self.maxCells:
+            return
+
+        t = time.time()
+        old = dict(self.__dict__)
+        self.maxCells = maxCells
+        self.maxSpecDataLen = self.maxCells*self.nSpecies
+        storageLen = self.maxSpecDataLen
+        self.levels = numpy.zeros(storageLen,dtype=numpy.float32)
+        self.levels[0:len(old['levels'])] = old['levels']
+        self.rates = numpy.zeros(storageLen,dtype=numpy.float32)
+        self.makeViews()
+        self.initArrays()
+        copyRows(self.queue, old, self.__dict__, old['maxCells'], old['maxCells'])
+        self.queue.finish()
+        for c in self.sim.cellStates.values():
+            c.species = self.specLevel[c.idx,:]
+        print("Resized " + self.__class__.__name__ \
+                + " to maxCells = %i in %f second(s)" % (self.maxCells, time.time()-t))
+
     def addCell(self, cellState):
         idx = cellState.idx
+        self.reserve(max(self.nCells, idx)+1)
+        self.hostArrays()
         self.nCells += 1
         cellState.species = self.specLevel[idx,:]
-        self.celltype[idx] = numpy.int32(cellState.cellType)
 
     def divide(self, pState, d1State, d2State):
         # Simulator should have organised indexing:
 
+        self.reserve(max(self.nCells+2, d1State.idx+1, d2State.idx+1))
+        self.hostArrays()
+
         # Set up slicing of levels for each daughter and copy parent levels
         d1idx = d1State.idx
         self.nCells += 1
         self.specLevel[d1idx,:] = pState.species
         d1State.species = self.specLevel[d1idx,:]
-        self.celltype[d1idx] = d1State.cellType
 
         d2idx = d2State.idx
         self.nCells += 1
         self.specLevel[d2idx,:] = pState.species
         d1State.species = self.specLevel[d1idx,:]
-        self.celltype[d1idx] = d1State.cellType
 
         d2idx = d2State.idx
         self.nCells += 1
         self.specLevel[d2idx,:] = pState.species
         d2State.species = self.specLevel[d2idx,:]
-        self.celltype[d2idx] = d2State.cellType
+
+    def divideCells(self, pidxs, d1idxs, d2idxs, d1States, d2States):
+        # Divide a batch of cells: d1 reuses the parent's row, so copy the
+        # parent levels into the d2 rows in one go
+        self.reserve(self.nCells+len(d2idxs))
+        self.nCells += len(d2idxs)
+        # on whichever side has the current levels
+        if self.hostValid:
+            self.specLevel[d2idxs,:] = self.specLevel[pidxs,:]
+        if self.deviceValid:
+            self.copyDeviceRows(pidxs, d2idxs, [self.specLevel_dev])
+        for state in d1States + d2States:
+            state.species = self.specLevel[state.idx,:]
 
     def setRegulator(self, regul):
         self.regul = regul
@@ -98,13 +152,11 @@ class CLEulerIntegrator:
         kernel_src = resource_string(__name__, 'CLEulerIntegrator.cl').decode()
         # substitute user defined kernel code, and number of signals
         kernel_src = kernel_src%(specRateKernel)
-        self.program = cl.Program(self.context, kernel_src).build(cache_dir=False)
+        self.program = buildProgram(self.context, kernel_src)
 
 
     def dydt(self):
-        self.celltype_dev.set(self.celltype)
         # compute species rates
-        self.specLevel_dev.set(self.specLevel)
         self.program.speciesRates(self.queue, (self.nCells,), None,
                                   numpy.int32(self.nSpecies),
                                   self.sim.phys.cell_centers_dev.data,
@@ -113,8 +165,7 @@ class CLEulerIntegrator:
                                   self.celltype_dev.data,
                                   self.effgrow_dev.data,
                                   self.specLevel_dev.data,
-                                  self.specRate_dev.data).wait()
-        self.specRate[:] = self.specRate_dev.get()
+                                  self.specRate_dev.data)
 
     def step(self, dt):
         if dt!=self.dt:
@@ -123,28 +174,31 @@ class CLEulerIntegrator:
 
         self.nCells = len(self.cellStates)
         # Check we have enough space allocated
-        try:
-            s = self.specLevel[self.nCells-1]
-        except IndexError:
-            # Could resize here, then would have to rebuild views
-            print("Number of cells exceeded " \
-                    + self.__class__.__name__ \
-                    + "::maxCells (" + self.maxCells + ")")
+        self.reserve(self.nCells)
 
         self.dataLen = self.nCells*self.nSpecies
 
         self.cellStates = self.sim.cellStates
-        cs = self.cellStates
-        for id,c in list(cs.items()):
-            self.effgrow[c.idx] = numpy.float32(c.effGrowth)
-        self.effgrow_dev.set(self.effgrow)
+        if self.nCells == 0:
+            return
+        self.effgrow[0:self.nCells] = self.sim.cellStore['effGrowth']
+        self.effgrow_dev[0:self.nCells].set(self.effgrow[0:self.nCells])
+        self.updateCellTypes()
+        self.syncDevice()
 
         # growth dilution of species
         self.diluteSpecies()
 
-        self.dydt()
-        self.rates[0:self.dataLen] *= self.dt
-        self.levels[0:self.dataLen] += self.rates[0:self.dataLen]
+        with self.sim.profiler.phase('dydt'):
+            self.dydt()
+        self.program.speciesDT(self.queue, (self.nCells,), None,
+                               numpy.int32(self.nSpecies),
+                               self.specLevel_dev.data,
+                               self.specRate_dev.data,
+                               numpy.float32(self.dt))
+        self.hostValid = False
+        if not self.deviceResident:
+            self.hostArrays()
 
 
 # Put the final signal levels into the cell states
@@ -153,11 +207,58 @@ class CLEulerIntegrator:
 #            if self.signalling:
 #                c.signals = self.signalling.signals(c, self.signalLevel)
 
+    ## Copy the levels to the host, if the device has changed them
+    def syncHost(self):
+        if not self.hostValid:
+            n = self.nCells
+            if n > 0:
+                self.specLevel_dev[0:n].get(ary=self.specLevel[0:n])
+            self.hostValid = True
+
+    ## Copy the levels to the device, if the host has changed them
+    def syncDevice(self):
+        if not self.deviceValid:
+            n = self.nCells
+            if n > 0:
+                self.specLevel_dev[0:n].set(self.specLevel[0:n])
+            self.deviceValid = True
+
+    ## Make the host levels (and the species of each cell state) current,
+    # for code that may change them, e.g. a model's update(). They are
+    # copied back to the device at the next step.
+    def hostArrays(self):
+        self.syncHost()
+        self.deviceValid = False
+
+    ## Upload the cell types if they have changed (e.g. in update())
+    def updateCellTypes(self):
+        cellType = self.sim.cellStore['cellType']
+        n = len(cellType)
+        if n > 0 and not numpy.array_equal(self.celltype[0:n], cellType):
+            self.celltype[0:n] = cellType
+            self.celltype_dev[0:n].set(self.celltype[0:n])
+
+    ## Copy rows srcIdxs of the device arrays to rows dstIdxs
+    def copyDeviceRows(self, srcIdxs, dstIdxs, arrays):
+        n = len(srcIdxs)
+        if n == 0:
+            return
+        src = cl_array.to_device(self.queue, numpy.asarray(srcIdxs, dtype=numpy.int32))
+        dst = cl_array.to_device(self.queue, numpy.asarray(dstIdxs, dtype=numpy.int32))
+        for arr in arrays:
+            self.program.copyRows(self.queue, (n,), None,
+                                  numpy.int32(arr.size//arr.shape[0]),
+                                  src.data, dst.data, arr.data)
+
     def setLevels(self, specLevel):
         self.cellStates = self.sim.cellStates
-        self.levels = specLevel
-        self.makeViews()
+        # Saved data may be for a different maxCells
+        self.reserve(max(len(self.cellStates), len(specLevel)//self.nSpecies))
+        self.levels[:] = 0
+        self.levels[0:len(specLevel)] = specLevel
         self.specLevel_dev.set(self.specLevel)
+        self.hostValid = True
+        self.deviceValid = True
         cs = self.cellStates
         for id,c in list(cs.items()):
             c.species = self.specLevel[c.idx,:]
@@ -166,11 +267,8 @@ class CLEulerIntegrator:
 
 
     def diluteSpecies(self):
-        self.specLevel_dev.set(self.specLevel)
         self.program.diluteSpecs(self.queue, (self.nCells,), None,
                                  numpy.int32(self.nSpecies),
                                  self.sim.phys.cell_old_vols_dev.data,
                                  self.sim.phys.cell_vols_dev.data,
-                                 self.specLevel_dev.data).wait()
-        self.specLevel[:] = self.specLevel_dev.get()
-
+                                 self.specLevel_dev.data)
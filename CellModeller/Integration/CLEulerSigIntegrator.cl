@@ -327,3 +327,44 @@ __kernel void signalRatesImplicit(const int numSignals,
         }
     }
 }
+
+__kernel void copyRows(const int rowLen,
+                       __global const int* src,
+                       __global const int* dst,
+                       __global float* data)
+{
+  int id = get_global_id(0);
+  int sbase = src[id]*rowLen;
+  int dbase = dst[id]*rowLen;
+  for (int i = 0; i < rowLen; i++) {
+    data[dbase+i] = data[sbase+i];
+  }
+}
+
+// OpenCL 1.x has no atomic add for floats
+void atomicAddFloat(volatile __global float* addr, float val)
+{
+  union { unsigned int u; float f; } old, sum;
+  do {
+    old.f = *addr;
+    sum.f = old.f + val;
+  } while (atomic_cmpxchg((volatile __global unsigned int*)addr, old.u, sum.u) != old.u);
+}
+
+// Sum the weighted signal rates of each cell (one work item per cell and
+// grid node) into the grid nodes
+__kernel void addSignalRates(const int numSignals,
+                             const int gridTotalSize,
+                             __global const int* indices,
+                             __global const float* sigRates,
+                             __global float* gridRates)
+{
+  int id = get_global_id(0);
+  int gidx = indices[id];
+  for (int s = 0; s < numSignals; s++) {
+    float rate = sigRates[id*numSignals+s];
+    if (rate != 0.f) {
+      atomicAddFloat(gridRates + s*gridTotalSize + gidx, rate);
+    }
+  }
+}
@@ -7,66 +7,33 @@ import pyopencl as cl
 import pyopencl.array as cl_array
 from pyopencl.array import vec
 import math
+import time
+from CellModeller.Capacity import newCapacity, copyRows
+from CellModeller.CLProgramCache import buildProgram
 from functools import reduce
 
 
-def unique_stable(ar, return_index=False, return_inverse=False):
-    """
-    Find the unique elements of an array.
-
-    Copied from numpy's unique, but uses stable sorts.
-    """
-    import numpy as np
-    try:
-        ar = ar.flatten()
-    except AttributeError:
-        if not return_inverse and not return_index:
-            items = sorted(set(ar)) # sorted is stable
-            return np.asarray(items)
-        else:
-            ar = np.asanyarray(ar).flatten()
-
-    if ar.size == 0:
-        if return_inverse and return_index:
-            return ar, np.empty(0, np.bool), np.empty(0, np.bool)
-        elif return_inverse or return_index:
-            return ar, np.empty(0, np.bool)
-        else:
-            return ar
-
-    if return_inverse or return_index:
-        perm = ar.argsort(kind='mergesort') # using mergesort for stability
-        aux = ar[perm]
-        flag = np.concatenate(([True], aux[1:] != aux[:-1]))
-        if return_inverse:
-            iflag = np.cumsum(flag) - 1
-            iperm = perm.argsort(kind='mergesort') # using mergesort for stability
-            if return_index:
-                return aux[flag], perm[flag], iflag[iperm]
-            else:
-                return aux[flag], iflag[iperm]
-        else:
-            return aux[flag], perm[flag]
-
-    else:
-        ar.sort(kind='mergesort')
-        flag = np.concatenate(([True], ar[1:] != ar[:-1]))
-        return ar[flag]
-
-
-
-
 class CLEulerSigIntegrator:
-    def __init__(self, sim, nSignals, nSpecies, maxCells, sig, regul=None, boundcond='constant'):
+    def __init__(self, sim, nSignals, nSpecies, maxCells, sig, regul=None, boundcond='constant', growFactor=1.5, growThreshold=0.9, deviceResident=False):
         self.sim = sim
         self.dt = self.sim.dt
         self.regul = regul
         self.boundcond = boundcond
+        # With deviceResident the species and cell signal levels are kept on
+        # the device between steps, see CLCrankNicIntegrator
+        self.deviceResident = deviceResident
+        # Which copies of the species and cell signal levels are current
+        self.hostValid = True
+        self.deviceValid = False
 
 
         self.nSpecies = nSpecies
         self.nSignals = nSignals
         self.maxCells = maxCells
+        # maxCells is grown by growFactor when more than growThreshold of
+        # the space is in use, see reserve()
+        self.growFactor = growFactor
+        self.growThreshold = growThreshold
 
         # The signalling model, must be a grid based thing
         self.signalling = sig
@@ -95,6 +62,7 @@ class CLEulerSigIntegrator:
 
         (self.context, self.queue) = self.sim.getOpenCL()
         self.initArrays()
+        self.signalLevel_dev.set(self.signalLevel.reshape(self.gridDim))
         #self.initKernels()
 
         self.setCellStates(sim.cellStates)
@@ -119,16 +87,46 @@ class CLEulerSigIntegrator:
         self.signalRate = self.rates[0:self.signalDataLen]
         self.specRate = self.rates[self.signalDataLen:self.signalDataLen+self.maxSpecDataLen].reshape(self.maxCells,self.nSpecies)
 
+    def reserve(self, n):
+        # Make sure there is space for n cells, reallocating the levels and
+        # per-cell arrays if needed. The views onto them, including the
+        # species and signals of each cell state, are rebuilt.
+        maxCells = newCapacity(self.maxCells, n, self.growFactor, self.growThreshold)
+        if maxCells == self.maxCells:
+            return
+
+        t = time.time()
+        old = dict(self.__dict__)
+        self.maxCells = maxCells
+        self.maxSpecDataLen = self.maxCells*self.nSpecies
+        storageLen = self.maxSpecDataLen + self.signalDataLen
+        self.levels = numpy.zeros(storageLen,dtype=numpy.float32)
+        self.levels[0:len(old['levels'])] = old['levels']
+        self.rates = numpy.zeros(storageLen,dtype=numpy.float32)
+        self.makeViews()
+        self.initArrays()
+        copyRows(self.queue, old, self.__dict__, old['maxCells'], old['maxCells'])
+        self.queue.finish()
+        for c in self.sim.cellStates.values():
+            c.species = self.specLevel[c.idx,:]
+            c.signals = self.cellSigLevels[c.idx,:]
+        print("Resized " + self.__class__.__name__ \
+                + " to maxCells = %i in %f second(s)" % (self.maxCells, time.time()-t))
+
     def addCell(self, cellState):
         idx = cellState.idx
+        self.reserve(max(self.nCells, idx)+1)
+        self.hostArrays()
         self.nCells += 1
         cellState.species = self.specLevel[idx,:]
         cellState.signals = self.cellSigLevels[idx,:]
-        self.celltype[idx] = numpy.int32(cellState.cellType)
 
     def divide(self, pState, d1State, d2State):
         # Simulator should have organised indexing:
 
+        self.reserve(max(self.nCells+2, d1State.idx+1, d2State.idx+1))
+        self.hostArrays()
+
         # Set up slicing of levels for each daughter and copy parent levels
         d1idx = d1State.idx
         self.nCells += 1
@@ -136,7 +134,6 @@ class CLEulerSigIntegrator:
         self.cellSigLevels[d1idx,:] = pState.signals
         d1State.species = self.specLevel[d1idx,:]
         d1State.signals = self.cellSigLevels[d1idx,:]
-        self.celltype[d1idx] = d1State.cellType
 
         d2idx = d2State.idx
         self.nCells += 1
@@ -144,14 +141,27 @@ class CLEulerSigIntegrator:
         self.cellSigLevels[d2idx,:] = pState.signals
         d1State.species = self.specLevel[d1idx,:]
         d1State.signals = self.cellSigLevels[d1idx,:]
-        self.celltype[d1idx] = d1State.cellType
 
         d2idx = d2State.idx
         self.nCells += 1
         self.specLevel[d2idx,:] = pState.species
         d2State.species = self.specLevel[d2idx,:]
         d2State.signals = self.cellSigLevels[d2idx,:]
-        self.celltype[d2idx] = d2State.cellType
+
+    def divideCells(self, pidxs, d1idxs, d2idxs, d1States, d2States):
+        # Divide a batch of cells: d1 reuses the parent's row, so copy the
+        # parent levels into the d2 rows in one go
+        self.reserve(self.nCells+len(d2idxs))
+        self.nCells += len(d2idxs)
+        # on whichever side has the current levels
+        if self.hostValid:
+            self.specLevel[d2idxs,:] = self.specLevel[pidxs,:]
+            self.cellSigLevels[d2idxs,:] = self.cellSigLevels[pidxs,:]
+        if self.deviceValid:
+            self.copyDeviceRows(pidxs, d2idxs, [self.specLevel_dev, self.cellSigLevels_dev])
+        for state in d1States + d2States:
+            state.species = self.specLevel[state.idx,:]
+            state.signals = self.cellSigLevels[state.idx,:]
 
     def setSignalling(self, sig):
         self.signalling = sig
@@ -162,15 +172,14 @@ class CLEulerSigIntegrator:
         self.initKernels()
 
     def initArrays(self):
-        self.gridIdxs = numpy.zeros((self.maxCells,8),dtype=numpy.int32)
         self.gridIdxs_dev = cl_array.zeros(self.queue, (self.maxCells,8),dtype=numpy.int32)
         self.triWts = numpy.zeros((self.maxCells,8),dtype=numpy.float32)
         self.triWts_dev = cl_array.zeros(self.queue, (self.maxCells,8),dtype=numpy.float32)
-        self.cellSigRates = numpy.zeros((self.maxCells,8,self.nSignals),dtype=numpy.float32)
         self.cellSigRates_dev = cl_array.zeros(self.queue, (self.maxCells,8,self.nSignals),dtype=numpy.float32)
         self.cellSigLevels = numpy.zeros((self.maxCells,self.nSignals),dtype=numpy.float32)
         self.cellSigLevels_dev = cl_array.zeros(self.queue, (self.maxCells,self.nSignals),dtype=numpy.float32)
         self.signalLevel_dev = cl_array.zeros(self.queue, self.gridDim,dtype=numpy.float32)
+        self.signalProd_dev = cl_array.zeros(self.queue, self.gridDim,dtype=numpy.float32)
         self.specLevel_dev = cl_array.zeros(self.queue, (self.maxCells,self.nSpecies), dtype=numpy.float32)
         self.specRate_dev = cl_array.zeros(self.queue, (self.maxCells,self.nSpecies), dtype=numpy.float32)
 
@@ -189,7 +198,7 @@ class CLEulerSigIntegrator:
         kernel_src = kernel_src % {'sigKernel': sigRateKernel,
                                    'specKernel': specRateKernel,
                                    'nSignals': self.nSignals}
-        self.program = cl.Program(self.context, kernel_src).build(cache_dir=False)
+        self.program = buildProgram(self.context, kernel_src)
 
 
     def dydt(self):
@@ -206,11 +215,10 @@ class CLEulerSigIntegrator:
                 numpy.int32(self.signalling.gridDim[3]),
                 self.sim.phys.cell_centers_dev.data,
                 self.triWts_dev.data,
-                self.gridIdxs_dev.data).wait()
-        self.gridIdxs[:] = self.gridIdxs_dev.get()
+                self.gridIdxs_dev.data)
 
-        # put local cell signal levels in array
-        self.signalLevel_dev.set(self.signalLevel)
+        # put local cell signal levels in array (the grid was uploaded at
+        # the end of the last step)
         self.program.setCellSignals(self.queue, (self.nCells,), None,
                 numpy.int32(self.nSignals),
                 numpy.int32(self.gridTotalSize),
@@ -220,11 +228,9 @@ class CLEulerSigIntegrator:
                 self.gridIdxs_dev.data,
                 self.triWts_dev.data,
                 self.signalLevel_dev.data,
-                self.cellSigLevels_dev.data).wait()
+                self.cellSigLevels_dev.data)
 
-        self.celltype_dev.set(self.celltype)
         # compute species rates
-        self.specLevel_dev.set(self.specLevel)
         self.program.speciesRates(self.queue, (self.nCells,), None,
                                   numpy.int32(self.nSignals),
                                   numpy.int32(self.nSpecies),
@@ -234,8 +240,7 @@ class CLEulerSigIntegrator:
                                   self.celltype_dev.data,
                                   self.specLevel_dev.data,
                                   self.cellSigLevels_dev.data,
-                                  self.specRate_dev.data).wait()
-        self.specRate[:] = self.specRate_dev.get()
+                                  self.specRate_dev.data)
 
         # compute signal rates, weighted for grid nodes
         self.program.signalRates(self.queue, (self.nCells,), None,
@@ -248,28 +253,23 @@ class CLEulerSigIntegrator:
                                  self.specLevel_dev.data,
                                  self.cellSigLevels_dev.data,
                                  self.triWts_dev.data,
-                                 self.cellSigRates_dev.data).wait()
-        self.cellSigRates[:] = self.cellSigRates_dev.get()
-
-        # Put cell signal production into diffusion grid:
-        #  - Using a convoluted way to reduce by key to get cell prod rates
-        #  into grid
-        gridIdxs = self.gridIdxs[0:self.nCells,:].reshape(self.nCells*8)
-        order = numpy.argsort(gridIdxs)
-        gridIdxs = gridIdxs[order]
-        cellSigRates = self.cellSigRates[0:self.nCells,:,:].reshape((self.nCells*8,self.nSignals))
-        cellSigRates = cellSigRates[order]
-        cellSigRates.cumsum(axis=0, out=cellSigRates)
-        (u,index) = unique_stable(gridIdxs[::-1],True) # first occurance of each key in reverse keys
-        index = len(gridIdxs)-1-index # last occurance in forward keys
-        cellSigRates = cellSigRates[index]
-        idxs = gridIdxs[index]
-        cellSigRates[1:] = cellSigRates[1:] - cellSigRates[:-1] # difference in cumsums is sum for each index
+                                 self.cellSigRates_dev.data)
 
+        # Put cell signal production into diffusion grid
+        self.signalRate += self.signalProduction().reshape(self.signalDataLen)
 
-        signalRate = self.signalRate.reshape((self.nSignals,self.gridDim[1]*self.gridDim[2]*self.gridDim[3]))
-        signalRate[:,idxs] += cellSigRates.transpose() # add into diffusion grid
 
+    ## Production of each signal at each grid node, (nSignals, gridTotalSize),
+    # from the cell signal rates of the last dydt summed on the device
+    def signalProduction(self):
+        self.signalProd_dev.fill(0)
+        self.program.addSignalRates(self.queue, (self.nCells*8,), None,
+                                    numpy.int32(self.nSignals),
+                                    numpy.int32(self.gridTotalSize),
+                                    self.gridIdxs_dev.data,
+                                    self.cellSigRates_dev.data,
+                                    self.signalProd_dev.data)
+        return self.signalProd_dev.get().reshape((self.nSignals,self.gridTotalSize))
 
     def step(self, dt):
         if dt!=self.dt:
@@ -278,15 +278,13 @@ class CLEulerSigIntegrator:
 
         self.nCells = len(self.cellStates)
         # Check we have enough space allocated
-        try:
-            s = self.specLevel[self.nCells-1]
-        except IndexError:
-            # Could resize here, then would have to rebuild views
-            print("Number of cells exceeded " \
-                    + self.__class__.__name__ \
-                    + "::maxCells (" + self.maxCells + ")")
+        self.reserve(self.nCells)
 
         self.dataLen = self.signalDataLen + self.nCells*self.nSpecies
+        if self.nCells == 0:
+            return
+        self.updateCellTypes()
+        self.syncDevice()
 
         # growth dilution of species
         self.diluteSpecies()
@@ -294,12 +292,19 @@ class CLEulerSigIntegrator:
         # Do u += h(T(u_t)/2 + hf(u_t)) where T=transport operator, f(u_t) is 
         # our regulation function dydt
         self.signalling.transportRates(self.signalRate, self.signalLevel, self.boundcond)
-        self.dydt()
-        self.rates[0:self.dataLen] *= self.dt
-        self.levels[0:self.dataLen] += self.rates[0:self.dataLen]
+        with self.sim.profiler.phase('dydt'):
+            self.dydt()
+        # species on the device, signals on the host
+        self.program.speciesDT(self.queue, (self.nCells,), None,
+                               numpy.int32(self.nSpecies),
+                               self.specLevel_dev.data,
+                               self.specRate_dev.data,
+                               numpy.float32(self.dt))
+        self.signalRate *= self.dt
+        self.signalLevel += self.signalRate
 
         # put local cell signal levels in array
-        self.signalLevel_dev.set(self.signalLevel)
+        self.signalLevel_dev.set(self.signalLevel.reshape(self.gridDim))
         self.program.setCellSignals(self.queue, (self.nCells,), None,
                 numpy.int32(self.nSignals),
                 numpy.int32(self.gridTotalSize),
@@ -309,8 +314,10 @@ class CLEulerSigIntegrator:
                 self.gridIdxs_dev.data,
                 self.triWts_dev.data,
                 self.signalLevel_dev.data,
-                self.cellSigLevels_dev.data).wait()
-        self.cellSigLevels[:] = self.cellSigLevels_dev.get()
+                self.cellSigLevels_dev.data)
+        self.hostValid = False
+        if not self.deviceResident:
+            self.hostArrays()
 
 # Put the final signal levels into the cell states
 #        states = self.cellStates
@@ -318,29 +325,74 @@ class CLEulerSigIntegrator:
 #            if self.signalling:
 #                c.signals = self.signalling.signals(c, self.signalLevel)
 
-        # Update cellType array
-        for (id,c) in list(self.cellStates.items()):
-            self.celltype[c.idx] = numpy.int32(c.cellType)
-        self.celltype_dev.set(self.celltype)
-
 
     def diluteSpecies(self):
-        self.specLevel_dev.set(self.specLevel)
         self.program.diluteSpecs(self.queue, (self.nCells,), None,
                                  numpy.int32(self.nSpecies),
                                  self.sim.phys.cell_old_vols_dev.data,
                                  self.sim.phys.cell_vols_dev.data,
-                                 self.specLevel_dev.data).wait()
-        self.specLevel[:] = self.specLevel_dev.get()
+                                 self.specLevel_dev.data)
+
+    ## Copy the species and cell signal levels to the host, if the device
+    # has changed them
+    def syncHost(self):
+        if not self.hostValid:
+            n = self.nCells
+            if n > 0:
+                self.specLevel_dev[0:n].get(ary=self.specLevel[0:n])
+                self.cellSigLevels_dev[0:n].get(ary=self.cellSigLevels[0:n])
+            self.hostValid = True
+
+    ## Copy the species and cell signal levels to the device, if the host
+    # has changed them
+    def syncDevice(self):
+        if not self.deviceValid:
+            n = self.nCells
+            if n > 0:
+                self.specLevel_dev[0:n].set(self.specLevel[0:n])
+                self.cellSigLevels_dev[0:n].set(self.cellSigLevels[0:n])
+            self.deviceValid = True
+
+    ## Make the host levels (and the species and signals of each cell state)
+    # current, for code that may change them, e.g. a model's update(). They
+    # are copied back to the device at the next step.
+    def hostArrays(self):
+        self.syncHost()
+        self.deviceValid = False
+
+    ## Upload the cell types if they have changed (e.g. in update())
+    def updateCellTypes(self):
+        cellType = self.sim.cellStore['cellType']
+        n = len(cellType)
+        if n > 0 and not numpy.array_equal(self.celltype[0:n], cellType):
+            self.celltype[0:n] = cellType
+            self.celltype_dev[0:n].set(self.celltype[0:n])
+
+    ## Copy rows srcIdxs of the device arrays to rows dstIdxs
+    def copyDeviceRows(self, srcIdxs, dstIdxs, arrays):
+        n = len(srcIdxs)
+        if n == 0:
+            return
+        src = cl_array.to_device(self.queue, numpy.asarray(srcIdxs, dtype=numpy.int32))
+        dst = cl_array.to_device(self.queue, numpy.asarray(dstIdxs, dtype=numpy.int32))
+        for arr in arrays:
+            self.program.copyRows(self.queue, (n,), None,
+                                  numpy.int32(arr.size//arr.shape[0]),
+                                  src.data, dst.data, arr.data)
 
     def setLevels(self, SSLevel, cellSigData):
         self.cellStates = self.sim.cellStates
-        self.levels = SSLevel
-        self.makeViews()
-        self.cellSigLevels = cellSigData
-        self.signalLevel_dev.set(self.signalLevel)
+        # Saved data may be for a different maxCells
+        self.reserve(max(len(self.cellStates), len(cellSigData)))
+        self.levels[:] = 0
+        self.levels[0:len(SSLevel)] = SSLevel
+        self.cellSigLevels[:] = 0
+        self.cellSigLevels[0:len(cellSigData)] = cellSigData
+        self.signalLevel_dev.set(self.signalLevel.reshape(self.gridDim))
         self.specLevel_dev.set(self.specLevel)
         self.cellSigLevels_dev.set(self.cellSigLevels)
+        self.hostValid = True
+        self.deviceValid = True
         cs = self.cellStates
         for id,c in list(cs.items()): #make sure everything is correct here
             c.species = self.specLevel[c.idx,:]
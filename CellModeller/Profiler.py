@@ -0,0 +1,165 @@
+"""
+Per-step timing of the phases of a simulation (regulation, division,
+gridding, contact finding, CG solve, integration, output etc.).
+
+Models time a phase with
+
+    with self.profiler.phase('grid'):
+        ...
+
+which does nothing (beyond the call) unless the profiler is enabled,
+with Simulator(profile=True). When enabled, each phase is timed on the
+host and, if the OpenCL queue was made with profiling enabled (as
+Simulator does when profiling), on the device too, from markers put in
+the queue at the start and end of the phase. With sync (the default) the
+queue is finished at the end of a phase, so that host times include the
+device work the phase enqueued.
+
+Phases may be nested (physics includes grid, contacts, matrix and cgs);
+each is timed on its own, so times of nested phases are not additive.
+
+At the end of each step the step's times are added to the totals,
+appended to steps (unless keepSteps is False), and passed to any
+callbacks, as a dict of step: stepNum, <phase>: host seconds,
+<phase>_calls: number of times timed, and device_<phase>: device
+seconds. They can be written out with writeCSV and writeJSON.
+"""
+
+import time
+import json
+import csv
+import pyopencl as cl
+
+
+class _NullPhase:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+_nullPhase = _NullPhase()
+
+
+class _Phase:
+    def __init__(self, profiler, name):
+        self.profiler = profiler
+        self.name = name
+
+    def __enter__(self):
+        p = self.profiler
+        if p.deviceTiming:
+            self.startEvent = cl.enqueue_marker(p.queue)
+        self.t0 = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        p = self.profiler
+        if p.deviceTiming:
+            p.events.append((self.name, self.startEvent, cl.enqueue_marker(p.queue)))
+        if p.sync and p.queue is not None:
+            p.queue.finish()
+        p.add(self.name, time.perf_counter()-self.t0)
+        return False
+
+
+class Profiler:
+    """Timers for the phases of each simulation step. queue is the OpenCL
+    queue the phases enqueue work on, used for device timing and sync.
+    """
+
+    def __init__(self, enabled=False, queue=None, sync=True, keepSteps=True):
+        self.enabled = enabled
+        self.queue = queue
+        self.sync = sync
+        self.keepSteps = keepSteps
+        self.deviceTiming = enabled and queue is not None and \
+            bool(queue.properties & cl.command_queue_properties.PROFILING_ENABLE)
+        self.callbacks = []
+        self.reset()
+
+    def reset(self):
+        self.steps = []
+        self.totals = {}
+        self.numSteps = 0
+        self.current = {}
+        self.events = []
+
+    ## Context manager timing the phase name
+    def phase(self, name):
+        if not self.enabled:
+            return _nullPhase
+        return _Phase(self, name)
+
+    ## Add seconds of host time to the phase name in the current step
+    def add(self, name, seconds, calls=1):
+        self.current[name] = self.current.get(name, 0.0) + seconds
+        self.current[name+'_calls'] = self.current.get(name+'_calls', 0) + calls
+
+    ## Call func(times) at the end of each step, with the step's times
+    def addCallback(self, func):
+        self.callbacks.append(func)
+
+    ## Finish the times of step stepNum
+    def endStep(self, stepNum):
+        if not self.enabled:
+            return
+        times = {'step': stepNum}
+        times.update(self.current)
+        for (name, start, end) in self.events:
+            end.wait()
+            t = (end.profile.end - start.profile.end)*1e-9
+            times['device_'+name] = times.get('device_'+name, 0.0) + t
+        for (name, t) in times.items():
+            if name != 'step':
+                self.totals[name] = self.totals.get(name, 0) + t
+        self.numSteps += 1
+        if self.keepSteps:
+            self.steps.append(times)
+        self.current = {}
+        self.events = []
+        for func in self.callbacks:
+            func(times)
+
+    ## Names of the phases timed so far
+    def phases(self):
+        return sorted([name for name in self.totals
+                       if not name.endswith('_calls') and not name.startswith('device_')])
+
+    ## Totals over all steps of each phase, as {phase: {'total': host
+    # seconds, 'perStep': host seconds per step, 'calls': number of times
+    # timed, 'device': device seconds (if timed)}}
+    def summary(self):
+        summary = {}
+        for name in self.phases():
+            s = {'total': self.totals[name],
+                 'perStep': self.totals[name]/max(self.numSteps, 1),
+                 'calls': self.totals.get(name+'_calls', 0)}
+            if 'device_'+name in self.totals:
+                s['device'] = self.totals['device_'+name]
+            summary[name] = s
+        return summary
+
+    def report(self):
+        print("%-12s %12s %12s %10s %12s" % ('phase', 'total (s)', 'per step (s)', 'calls', 'device (s)'))
+        for (name, s) in self.summary().items():
+            print("%-12s %12.4f %12.6f %10i %12s" % (name, s['total'], s['perStep'], s['calls'],
+                  '%.4f' % s['device'] if 'device' in s else '-'))
+
+    ## Write the times of each step to a CSV file, a column per phase
+    def writeCSV(self, filename):
+        names = set()
+        for times in self.steps:
+            names.update(times.keys())
+        names.discard('step')
+        fields = ['step'] + sorted(names)
+        with open(filename, 'w', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=fields, restval=0)
+            writer.writeheader()
+            writer.writerows(self.steps)
+
+    ## Write the summary and the times of each step to a JSON file
+    def writeJSON(self, filename):
+        with open(filename, 'w') as f:
+            json.dump({'numSteps': self.numSteps, 'summary': self.summary(), 'steps': self.steps},
+                      f, indent=1)
@@ -2,6 +2,45 @@ import copy
 import os.path
 import sys
 import imp
+import numpy
+from collections.abc import Mapping
+
+
+class Columns(Mapping):
+    """Column views of the cell data, see ModuleRegulator.getColumns. The
+    species and signals levels are only fetched from the integrator (which
+    may keep them on the device) when first used.
+    """
+
+    def __init__(self, sim):
+        self.sim = sim
+        store = sim.cellStore
+        self.n = len(store)
+        self.cols = {}
+        for name in store.columns:
+            self.cols[name] = store[name]
+        self.levelNames = []
+        integ = sim.integ
+        if integ:
+            self.levelNames.append('species')
+            if hasattr(integ, 'cellSigLevels'):
+                self.levelNames.append('signals')
+
+    def __getitem__(self, name):
+        if name in self.levelNames and name not in self.cols:
+            # the module may change them, so they go back to the device
+            self.sim.syncLevels(write=True)
+            integ = self.sim.integ
+            self.cols['species'] = integ.specLevel[0:self.n]
+            if 'signals' in self.levelNames:
+                self.cols['signals'] = integ.cellSigLevels[0:self.n]
+        return self.cols[name]
+
+    def __iter__(self):
+        return iter(list(self.cols.keys()) + [name for name in self.levelNames if name not in self.cols])
+
+    def __len__(self):
+        return len(set(self.cols.keys()) | set(self.levelNames))
 
 class ModuleRegulator:
     def __init__(self, sim, biophys=None, signalling=None):
@@ -45,9 +84,23 @@ class ModuleRegulator:
         for i in range(nCells):
             levels[i,:] = csv[i].species
 
+    ## Column views of the cell data, for the module's optional
+    # update_batch(cols). Contains every column of the simulator's
+    # CellStore (volume, cellType, color, divideFlag, any user columns
+    # such as targetVol, ...), plus species and signals levels if there is
+    # an integrator. Row i of each column is the cell with idx i.
+    def getColumns(self):
+        return Columns(self.sim)
+
     def step(self, dt=0):
+        # Prefer the module's vectorized update_batch function if it has one
+        batchfunc = getattr(self.module, "update_batch", None)
         try:
-            self.module.update(self.cellStates)
+            if callable(batchfunc):
+                batchfunc(self.getColumns())
+            else:
+                self.sim.syncLevels(write=True)
+                self.module.update(self.cellStates)
         except Exception as e:
             print("Problem with regulation module " + self.modName)
             print(e)
@@ -56,6 +109,18 @@ class ModuleRegulator:
         # Call the module's optional divide function
         divfunc = getattr(self.module, "divide", None)
         if callable(divfunc):
+            self.sim.syncLevels(write=True)
             divfunc(pState, d1State, d2State)
 
-
+    ## Divide a batch of cells. Calls the module's optional
+    # divide_batch(cols, d1idxs, d2idxs) function if it has one, else
+    # its optional divide function for each cell in turn
+    def divideCells(self, pStates, d1States, d2States):
+        batchfunc = getattr(self.module, "divide_batch", None)
+        if callable(batchfunc):
+            d1idxs = numpy.array([s.idx for s in d1States], dtype=numpy.int32)
+            d2idxs = numpy.array([s.idx for s in d2States], dtype=numpy.int32)
+            batchfunc(self.getColumns(), d1idxs, d2idxs)
+        else:
+            for k in range(len(pStates)):
+                self.divide(pStates[k], d1States[k], d2States[k])
@@ -0,0 +1,63 @@
+"""
+Full state of the simulation models, for exact restarts (see
+Simulator.saveState and Simulator.loadState).
+
+Unlike the output pickles and checkpoints, which hold the cell states, the
+state of a model here is every array it holds, on the host and device,
+along with its counters and other plain attributes. A model restored into
+a new Simulator built from the same model file carries on exactly as the
+original would have:
+
+    state = getState(sim.phys)
+    ...
+    setState(newsim.phys, state, newsim.CLQueue)
+"""
+
+import numpy
+import pyopencl.array as cl_array
+
+# Types of attributes kept, besides arrays (and lists, tuples and dicts of
+# these)
+_plainTypes = (bool, int, float, str, bytes, type(None), numpy.generic)
+
+
+def _isPlain(val, depth=0):
+    if isinstance(val, _plainTypes):
+        return True
+    if depth > 3:
+        return False
+    if isinstance(val, (list, tuple)):
+        return all([_isPlain(v, depth+1) for v in val])
+    if isinstance(val, dict):
+        return all([_isPlain(k, depth+1) and _isPlain(v, depth+1) for (k, v) in val.items()])
+    return False
+
+
+## The state of obj (e.g. a biophysics or integrator model), as a dict of
+# copies of its numpy and device arrays and its plain attributes.
+# Arrays that are views onto other arrays are left out, as the model
+# rebuilds them, as are references to other objects (the simulator,
+# OpenCL context, kernels etc.).
+def getState(obj):
+    state = {'arrays': {}, 'devArrays': {}, 'attrs': {}}
+    for (name, val) in obj.__dict__.items():
+        if isinstance(val, cl_array.Array):
+            state['devArrays'][name] = val.get()
+        elif isinstance(val, numpy.ndarray):
+            if val.base is None:
+                state['arrays'][name] = val.copy()
+        elif _isPlain(val):
+            state['attrs'][name] = val
+    return state
+
+
+## Restore the state of obj from getState, allocating new arrays of the
+# saved sizes. Views onto the arrays must be rebuilt by the caller.
+def setState(obj, state, queue):
+    d = obj.__dict__
+    d.update(state['attrs'])
+    for (name, arr) in state['arrays'].items():
+        d[name] = arr.copy()
+    for (name, arr) in state['devArrays'].items():
+        d[name] = cl_array.to_device(queue, arr)
+    queue.finish()
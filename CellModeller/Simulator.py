@@ -1,4 +1,10 @@
 from .CellState import CellState
+from .CellStore import CellStore
+from . import CLProgramCache
+from . import Checkpoint
+from . import Restart
+from . import Devices
+from . import Profiler
 import copy
 import pyopencl as cl
 import sys
@@ -10,6 +16,8 @@ import inspect
 import imp
 import configparser
 import importlib
+import itertools
+import random
 
 class Simulator:
     """
@@ -18,7 +26,9 @@ and stepping them forward in time. It is the control interface for the gui
 or script that is running the simulation.
 
 Stores a map from cell_id to CellState, which stores the current simulation
-state of each cell.
+state of each cell. The CellStates are views onto rows of a columnar
+CellStore (cellStore), indexed by cell idx, which vectorized code can use
+to operate on all cells at once.
 
 Constructed on a user-defined python file. This file implements a
 function setup(Simulator, Gui) that constructs the requiredx modules
@@ -26,6 +36,15 @@ function setup(Simulator, Gui) that constructs the requiredx modules
 can also create Renderers and add them by calling
 Simulator.addRenderer(renderer) so that the simulation can be
 visualised.
+
+With replicates=K the simulator runs an ensemble of K independent
+colonies of the model together, in the same models and OpenCL buffers:
+each cell the model adds is added once to each colony, and has its colony
+in the 'colony' column of the cell store. Cells only have contacts with
+cells of their own colony, so the colonies can overlap in space, and each
+step is one set of kernel launches for all of them. Output is written for
+each colony to its own directory, rep-%03i. Signalling is not supported,
+as the colonies would share the signal grid.
 """
 
     ## Construct an empty simulator object. This object will not be able to
@@ -35,11 +54,16 @@ visualised.
                     moduleName, \
                     dt, \
                     pickleSteps=50, \
+                    checkpointFormat='pickle', \
+                    asyncOutput=False, \
                     outputDirName=None, \
                     moduleStr=None, \
                     saveOutput=False, \
-                    clPlatformNum=0, \
-                    clDeviceNum=0, \
+                    clPlatformNum=None, \
+                    clDeviceNum=None, \
+                    params=None, \
+                    profile=False, \
+                    replicates=1, \
                     is_gui=False):
         # Is this simulator running in a gui?
         self.is_gui = is_gui
@@ -50,6 +74,14 @@ visualised.
         self.sig = None
         self.integ = None
         self.pickleSteps = pickleSteps
+        # Output format every pickleSteps steps, 'pickle' or 'npz' (see
+        # Checkpoint)
+        self.checkpointFormat = checkpointFormat
+        # Compress npz checkpoints (uncompressed ones are bigger, but are
+        # memory-mapped when read)
+        self.checkpointCompress = True
+        # Write output files on a background thread (see Checkpoint.Writer)
+        self.outputWriter = Checkpoint.Writer() if asyncOutput else None
 
         # No cells yet, initialise indices and empty lists/dicts, zero counters
         self._next_id = 1
@@ -57,9 +89,19 @@ visualised.
         self.idToIdx = {}
         self.idxToId = {}
         self.cellStates = {}
+        self.cellStore = CellStore()
         self.renderers = []
         self.stepNum = 0
         self.lineage = {}
+        # number of lineage entries already written to an npz checkpoint
+        self.lineageSaved = 0
+
+        # Independent colonies simulated together, and the colony of each
+        # cell id (including those that have divided), for the output
+        self.replicates = replicates
+        self.idToColony = {}
+        if replicates > 1:
+            self.cellStore.addColumn('colony', numpy.int32, (), 0)
 
         # Time step
         self.dt = dt
@@ -68,9 +110,20 @@ visualised.
             self.cfg_file = os.path.join(os.environ["CMPATH"], 'CMconfig.cfg')
         else:
             self.cfg_file = 'CellModeller/CMconfig.cfg'
+        # Time the phases of each step (see Profiler), this also turns on
+        # OpenCL event profiling
+        self.profile = profile
+
+        # OpenCL device, by default from the CELLMODELLER_DEVICE environment
+        # variable (see Devices), or the first device
+        if clPlatformNum is None or clDeviceNum is None:
+            (envPlatformNum, envDeviceNum) = Devices.deviceFromEnv()
+            clPlatformNum = envPlatformNum if clPlatformNum is None else clPlatformNum
+            clDeviceNum = envDeviceNum if clDeviceNum is None else clDeviceNum
         if not self.init_cl(platnum=clPlatformNum, devnum=clDeviceNum):
             print("Couldn't initialise OpenCL context")
             return
+        self.profiler = Profiler.Profiler(profile, self.CLQueue)
 
         # Two ways to specify a module (model):
         self.moduleName = moduleName # Import via standard python
@@ -95,7 +148,12 @@ visualised.
                 importlib.reload(self.module)
             else:
                 self.module = __import__(self.moduleName, globals(), locals(), [], 0)
-            
+
+        # Override module-level parameters of the model (e.g. from a batch
+        # parameter sweep) before setup is called
+        self.params = dict(params or {})
+        for (name, val) in self.params.items():
+            setattr(self.module, name, val)
 
         # TJR: What is this invar thing? I have never seen this used...
         #setup the simulation here:
@@ -110,6 +168,7 @@ visualised.
         
         # Call the user-defined setup function on ourself
         self.module.setup(self)
+        print(CLProgramCache.stats())
 
     def setSaveOutput(self, save):
         self.saveOutput = save
@@ -172,6 +231,11 @@ visualised.
     # 'integ' = integrator
 
     def init(self, phys, reg, sig, integ):
+        if self.replicates > 1:
+            if sig:
+                raise ValueError("Signalling is not supported with replicates, the colonies would share the signal grid")
+            if not hasattr(phys, 'cell_colonies'):
+                raise ValueError("Biophysics model %s does not support replicates" % type(phys).__name__)
         self.phys = phys
         self.reg = reg
         self.sig = sig
@@ -218,7 +282,9 @@ visualised.
         # Create a context and queue
         self.CLContext = cl.Context(properties=[(cl.context_properties.PLATFORM, platform)],
                                           devices=[device])
-        self.CLQueue = cl.CommandQueue(self.CLContext)
+        properties = cl.command_queue_properties.PROFILING_ENABLE if self.profile else 0
+        self.CLQueue = cl.CommandQueue(self.CLContext, properties=properties)
+        CLProgramCache.useContext(self.CLContext)
         print("Set up OpenCL context:")
         print("  Platform: %s"%(str(platform.name)))
         print("  Device: %s"%(str(device.name)))
@@ -246,6 +312,7 @@ visualised.
         self.idxToId = id_map
         self._next_id = idmax+1
         self._next_idx = len(cellStates)
+        self.cellStore.load(cellStates)
         self.reg.cellStates = cellStates
         self.phys.load_from_cellstates(cellStates)
     
@@ -272,8 +339,14 @@ visualised.
             # TJR: Module loaded from pickle, cannot reset?
             pass
 
+        # Finish writing output of the old simulation
+        self.flushOutput()
+
         # Lose old cell states
         self.cellStates = {}
+        self.idToColony = {}
+        self.cellStore.reset()
+        self.profiler.reset()
         # Recreate models via module setup
         self.module.setup(self)
 
@@ -284,10 +357,10 @@ visualised.
         pid = pState.id
         d1id = self.next_id()
         d2id = self.next_id()
-        d1State = copy.deepcopy(pState)
-        d2State = copy.deepcopy(pState)
-        d1State.id = d1id
-        d2State.id = d2id
+        # Parent keeps a copy of its final state, since d1 reuses its row
+        pState.detach()
+        d1State = pState.copy(d1id, self.cellStore, pState.idx)
+        d2State = pState.copy(d2id, self.cellStore, self.next_idx())
 
         #reset cell ages
         d1State.cellAge = 0
@@ -298,6 +371,8 @@ visualised.
         
         self.lineage[d1id] = pid
         self.lineage[d2id] = pid
+        if self.replicates > 1:
+            self.idToColony[d1id] = self.idToColony[d2id] = pState.colony
 
         # Update CellState map
         self.cellStates[d1id] = d1State
@@ -305,10 +380,8 @@ visualised.
         del self.cellStates[pid]
 
         # Update indexing, reuse parent index for d1
-        d1State.idx = pState.idx
         self.idToIdx[d1id] = pState.idx
         self.idxToId[pState.idx] = d1id
-        d2State.idx = self.next_idx()
         self.idToIdx[d2id] = d2State.idx
         self.idxToId[d2State.idx] = d2id
         del self.idToIdx[pid]
@@ -320,14 +393,85 @@ visualised.
             self.integ.divide(pState, d1State, d2State)
         self.reg.divide(pState, d1State, d2State)
 
-    ## Add a new cell to the simulator
-    def addCell(self, cellType=0, cellAdh=0, length=3.5, **kwargs):
+    ## Divide all the cells with idx in pidxs, in one batch.
+    # Ids and indices are allocated in the same order as calling divide()
+    # on each cell in turn, and each model is asked to divide the whole
+    # batch at once if it supports it (divideCells), otherwise cell by cell.
+    def divideCells(self, pidxs):
+        store = self.cellStore
+        n = len(pidxs)
+        pidxs = numpy.asarray(pidxs, dtype=numpy.int32)
+        d1idxs = pidxs # reuse parent index for d1
+        d2idxs = numpy.arange(self._next_idx, self._next_idx+n, dtype=numpy.int32)
+        self._next_idx += n
+        d1ids = list(range(self._next_id, self._next_id+2*n, 2))
+        d2ids = list(range(self._next_id+1, self._next_id+2*n, 2))
+        self._next_id += 2*n
+
+        store.columns['divideFlag'][pidxs] = False
+        pStates = [self.cellStates[self.idxToId[i]] for i in pidxs]
+        # Parents keep a copy of their final state, since d1 reuses the row
+        for pState in pStates:
+            pState.detach()
+
+        # Daughters start as copies of the parent row
+        store.copyRows(pidxs, d2idxs)
+        store.columns['cellAge'][pidxs] = 0
+        store.columns['cellAge'][d2idxs] = 0
+
+        d1States = []
+        d2States = []
+        for k in range(n):
+            pState = pStates[k]
+            d1State = pState.copyView(d1ids[k], store, int(d1idxs[k]))
+            d2State = pState.copyView(d2ids[k], store, int(d2idxs[k]))
+            d1States.append(d1State)
+            d2States.append(d2State)
+            del self.cellStates[pState.id]
+            del self.idToIdx[pState.id]
+            self.cellStates[d1State.id] = d1State
+            self.cellStates[d2State.id] = d2State
+        self.lineage.update(zip(d1ids, [p.id for p in pStates]))
+        self.lineage.update(zip(d2ids, [p.id for p in pStates]))
+        self.idToIdx.update(zip(d1ids, d1idxs.tolist()))
+        self.idToIdx.update(zip(d2ids, d2idxs.tolist()))
+        self.idxToId.update(zip(d1idxs.tolist(), d1ids))
+        self.idxToId.update(zip(d2idxs.tolist(), d2ids))
+        if self.replicates > 1:
+            colonies = store.columns['colony'][pidxs].tolist()
+            self.idToColony.update(zip(d1ids, colonies))
+            self.idToColony.update(zip(d2ids, colonies))
+
+        # Divide the cells in each model
+        if hasattr(self.phys, 'divideCells'):
+            self.phys.divideCells(pidxs, d1idxs, d2idxs, d1States, d2States)
+        else:
+            for k in range(n):
+                asymm = getattr(pStates[k], 'asymm', [1, 1])
+                self.phys.divide(pStates[k], d1States[k], d2States[k], f1=asymm[0], f2=asymm[1])
+        if self.integ:
+            if hasattr(self.integ, 'divideCells'):
+                self.integ.divideCells(pidxs, d1idxs, d2idxs, d1States, d2States)
+            else:
+                for k in range(n):
+                    self.integ.divide(pStates[k], d1States[k], d2States[k])
+        self.reg.divideCells(pStates, d1States, d2States)
+
+    ## Add a new cell to the simulator. With replicates, the cell is added
+    # to colony, or if colony is None once to each colony.
+    def addCell(self, cellType=0, cellAdh=0, length=3.5, colony=None, **kwargs):
+        if self.replicates > 1 and colony is None:
+            for k in range(self.replicates):
+                self.addCell(cellType, cellAdh, length, colony=k, **kwargs)
+            return
         cid = self.next_id()
-        cs = CellState(cid)
+        cs = CellState(cid, self.cellStore, self.next_idx())
         cs.length = length
         cs.cellType = cellType
         cs.cellAdh = cellAdh
-        cs.idx = self.next_idx()
+        if self.replicates > 1:
+            cs.colony = colony
+            self.idToColony[cid] = colony
         self.idToIdx[cid] = cs.idx
         self.idxToId[cs.idx] = cid
         self.cellStates[cid] = cs
@@ -349,24 +493,34 @@ visualised.
     ## Proceed to the next simulation step
     # This method is where objects phys, reg, sig and integ are called
     def step(self):
-        self.reg.step(self.dt)
-        states = dict(self.cellStates)
-        for (cid,state) in list(states.items()):
-            state.time = self.stepNum * self.dt
-            if state.divideFlag:
-                self.divide(state) #neighbours no longer current
-
-        self.phys.set_cells()
-        while not self.phys.step(self.dt): #neighbours are current here
-            pass
+        prof = self.profiler
+        with prof.phase('regulation'):
+            self.reg.step(self.dt)
+        self.cellStore['time'] = self.stepNum * self.dt
+        pidxs = numpy.nonzero(self.cellStore['divideFlag'])[0]
+        if len(pidxs) > 0:
+            with prof.phase('division'):
+                self.divideCells(pidxs) #neighbours no longer current
+
+        with prof.phase('physics'):
+            self.phys.set_cells()
+            while not self.phys.step(self.dt): #neighbours are current here
+                pass
         if self.sig:
-            self.sig.step(self.dt)
+            with prof.phase('signalling'):
+                self.sig.step(self.dt)
         if self.integ:
-            self.integ.step(self.dt)
+            with prof.phase('integration'):
+                self.integ.step(self.dt)
+            if self.is_gui:
+                # the renderers read the cell states
+                self.syncLevels()
 
         if self.saveOutput and self.stepNum%self.pickleSteps==0:
-            self.writePickle()
+            with prof.phase('output'):
+                self.writeOutput()
 
+        prof.endStep(self.stepNum)
         self.stepNum += 1
         return True
 
@@ -383,10 +537,35 @@ visualised.
             #this should probably also check for overlaps
             self.addCell(pos=tuple(cpos), dir=tuple(ndir), length=clen)
 
+    ## Wait for any output being written in the background
+    def flushOutput(self):
+        if self.outputWriter:
+            self.outputWriter.flush()
+
+    ## Write the output file of the current step, in checkpointFormat
+    def writeOutput(self):
+        if self.replicates > 1:
+            self.writeReplicates()
+        elif self.checkpointFormat == 'npz':
+            self.writeCheckpoint()
+        else:
+            self.writePickle()
+
+    ## Make the species and signal levels of the cells current on the host,
+    # as the integrator may keep them on the device between steps. With
+    # write they are copied back to the device at the next step, for code
+    # that may change them (e.g. the model's update()).
+    def syncLevels(self, write=False):
+        if self.integ and hasattr(self.integ, 'syncHost'):
+            if write:
+                self.integ.hostArrays()
+            else:
+                self.integ.syncHost()
+
     ## Write current simulation state to an output file
     def writePickle(self, csv=False):
         filename = os.path.join(self.outputDirPath, 'step-%05i.pickle' % self.stepNum)
-        outfile = open(filename, 'wb')
+        self.syncLevels()
         data = {}
         data['cellStates'] = self.cellStates
         data['stepNum'] = self.stepNum
@@ -404,13 +583,91 @@ visualised.
             data['sigGrid'] = self.integ.signalLevel
             data['sigData'] = self.integ.cellSigLevels
             data['sigGrid'] = self.integ.signalLevel
-        pickle.dump(data, outfile, protocol=-1)
+        # the cell states are serialized now, as they change with the next step
+        data = pickle.dumps(data, protocol=-1)
+        if self.outputWriter:
+            self.outputWriter.submit(Checkpoint.writeBytes, filename, data)
+        else:
+            Checkpoint.writeBytes(filename, data)
         #output csv file with cell pos,dir,len - sig?
 
+    ## Write current simulation state to a columnar checkpoint file
+    def writeCheckpoint(self):
+        filename = os.path.join(self.outputDirPath, 'step-%05i.npz' % self.stepNum)
+        self.syncLevels()
+        # only the lineage since the last checkpoint
+        lineage = dict(itertools.islice(self.lineage.items(), self.lineageSaved, None))
+        arrays = {}
+        if self.integ:
+            arrays['specData'] = self.integ.levels
+        if self.sig:
+            arrays['sigGridOrig'] = self.sig.gridOrig
+            arrays['sigGridDim'] = self.sig.gridDim
+            arrays['sigGridSize'] = self.sig.gridSize
+        if self.sig and self.integ:
+            arrays['sigGrid'] = self.integ.signalLevel
+            arrays['sigData'] = self.integ.cellSigLevels
+        if getattr(self.phys, 'computeNeighbours', False):
+            # neighbour idxs of the cells in CSR form (see
+            # CLBacterium.update_neighbours), not kept on the cell states
+            arrays['nbrOffsets'] = self.phys.cell_nbr_offsets
+            arrays['nbrIdxs'] = self.phys.cell_nbrs
+        data = Checkpoint.snapshot(self.cellStates, self.cellStore, self.stepNum,
+                                   lineage, self.moduleName, arrays)
+        if self.outputWriter:
+            self.outputWriter.submit(Checkpoint.writeData, filename, data,
+                                     self.checkpointCompress)
+        else:
+            Checkpoint.writeData(filename, data, self.checkpointCompress)
+        self.lineageSaved = len(self.lineage)
+
+    ## Write the output file of the current step for each colony, in
+    # checkpointFormat, to the directory rep-%03i of the colony. Each holds
+    # the cell states and lineage of one colony, as if it were a run of its
+    # own (e.g. to read with CellModeller.io), but not the arrays of the
+    # models, so use saveState to restart the ensemble.
+    def writeReplicates(self):
+        self.syncLevels()
+        npz = self.checkpointFormat == 'npz'
+        colonies = self.cellStore.columns['colony']
+        cellStates = [{} for k in range(self.replicates)]
+        for (cid, state) in self.cellStates.items():
+            cellStates[colonies[state.idx]][cid] = state
+        # npz checkpoints only hold the lineage since the last one
+        lineage = [{} for k in range(self.replicates)]
+        start = self.lineageSaved if npz else 0
+        for (cid, pid) in itertools.islice(self.lineage.items(), start, None):
+            lineage[self.idToColony[cid]][cid] = pid
+        for k in range(self.replicates):
+            path = os.path.join(self.outputDirPath, 'rep-%03i' % k)
+            if not os.path.exists(path):
+                os.mkdir(path)
+            if npz:
+                filename = os.path.join(path, 'step-%05i.npz' % self.stepNum)
+                data = Checkpoint.snapshot(cellStates[k], self.cellStore, self.stepNum,
+                                           lineage[k], self.moduleName)
+                if self.outputWriter:
+                    self.outputWriter.submit(Checkpoint.writeData, filename, data,
+                                             self.checkpointCompress)
+                else:
+                    Checkpoint.writeData(filename, data, self.checkpointCompress)
+            else:
+                filename = os.path.join(path, 'step-%05i.pickle' % self.stepNum)
+                data = {'cellStates': cellStates[k], 'stepNum': self.stepNum, 'lineage': lineage[k],
+                        'moduleStr': self.moduleOutput, 'moduleName': self.moduleName}
+                data = pickle.dumps(data, protocol=-1)
+                if self.outputWriter:
+                    self.outputWriter.submit(Checkpoint.writeBytes, filename, data)
+                else:
+                    Checkpoint.writeBytes(filename, data)
+        self.lineageSaved = len(self.lineage)
+
     # Populate simulation from saved data pickle
     def loadGeometryFromPickle(self, data):
-        self.setCellStates(data['cellStates'])
-        self.lineage = data['lineage']
+        # (a dict copy, as data may be a Checkpoint with read-only cellStates)
+        self.setCellStates(dict(data['cellStates']))
+        self.lineage = dict(data['lineage'])
+        self.lineageSaved = 0
         idx_map = {}
         id_map = {}
         idmax = 0
@@ -430,8 +687,10 @@ visualised.
 
     # Populate simulation from saved data pickle
     def loadFromPickle(self, data):
-        self.setCellStates(data['cellStates'])
-        self.lineage = data['lineage']
+        # (a dict copy, as data may be a Checkpoint with read-only cellStates)
+        self.setCellStates(dict(data['cellStates']))
+        self.lineage = dict(data['lineage'])
+        self.lineageSaved = 0
         self.stepNum = data['stepNum']
         idx_map = {}
         id_map = {}
@@ -452,3 +711,67 @@ visualised.
                 self.integ.setLevels(data['specData'])
 
 
+
+    ## Save the full state of the simulation to filename, so that
+    # loadState can carry on exactly as this simulation would. This
+    # includes the cell states and lineage, the arrays of the biophysics,
+    # signalling and integrator models (e.g. cell velocities and contacts),
+    # and the state of the python and numpy random number generators.
+    def saveState(self, filename):
+        self.flushOutput()
+        n = len(self.cellStore)
+        state = {}
+        state['stepNum'] = self.stepNum
+        state['nextId'] = self._next_id
+        state['nextIdx'] = self._next_idx
+        state['idToIdx'] = self.idToIdx
+        state['idxToId'] = self.idxToId
+        state['lineage'] = self.lineage
+        state['lineageSaved'] = self.lineageSaved
+        state['idToColony'] = self.idToColony
+        state['cellStates'] = self.cellStates
+        state['cellStore'] = dict([(name, col[0:n].copy()) for (name, col) in self.cellStore.columns.items()])
+        state['random'] = random.getstate()
+        state['numpyRandom'] = numpy.random.get_state()
+        for name in ['phys', 'sig', 'integ']:
+            model = getattr(self, name)
+            if model:
+                state[name] = Restart.getState(model)
+        Checkpoint.writeBytes(filename, pickle.dumps(state, protocol=-1))
+
+    ## Restore the full state of a simulation saved with saveState. This
+    # simulator must have been set up with the same model.
+    def loadState(self, filename):
+        with open(filename, 'rb') as f:
+            state = pickle.load(f)
+        self.setCellStates(state['cellStates'])
+        self.stepNum = state['stepNum']
+        self._next_id = state['nextId']
+        self._next_idx = state['nextIdx']
+        self.idToIdx = state['idToIdx']
+        self.idxToId = state['idxToId']
+        self.lineage = state['lineage']
+        self.lineageSaved = state['lineageSaved']
+        self.idToColony = state.get('idToColony', {})
+        for (name, col) in state['cellStore'].items():
+            if name in self.cellStore.columns:
+                self.cellStore.columns[name][0:len(col)] = col
+
+        queue = self.CLQueue
+        if self.phys and 'phys' in state:
+            Restart.setState(self.phys, state['phys'], queue)
+        if self.sig and 'sig' in state:
+            Restart.setState(self.sig, state['sig'], queue)
+            self.sig.setCellStates(self.cellStates)
+        if self.integ and 'integ' in state:
+            Restart.setState(self.integ, state['integ'], queue)
+            # views onto the restored levels
+            self.integ.cellStates = self.cellStates
+            self.integ.makeViews()
+            for c in self.cellStates.values():
+                c.species = self.integ.specLevel[c.idx,:]
+                if hasattr(self.integ, 'cellSigLevels'):
+                    c.signals = self.integ.cellSigLevels[c.idx,:]
+
+        random.setstate(state['random'])
+        numpy.random.set_state(state['numpyRandom'])
@@ -0,0 +1,176 @@
+"""
+Reading saved simulation runs for analysis.
+
+A Trajectory is the output directory of a run: a sequence of frames, one
+per step-%05i.npz checkpoint (see Checkpoint) or step-%05i.pickle file.
+Frames give per-cell fields as numpy arrays, in the same cell order for
+every field of a frame, without building CellState objects:
+
+    from CellModeller.io import Trajectory
+    traj = Trajectory('data/ex1_simpleGrowth-...')
+    frame = traj[-1]
+    r = numpy.sqrt((frame['pos'][:,0:2]**2).sum(axis=1))
+    for (step, lens) in traj.field('length'):
+        ...
+
+Checkpoint arrays are only read when a field is accessed, and those
+stored uncompressed are memory-mapped. Pickle files have to be loaded
+whole, once per frame, and the fields are built from their cell states.
+"""
+
+import os
+import re
+import glob
+import pickle
+from collections.abc import Mapping
+import numpy
+
+from CellModeller import Checkpoint
+
+_stepPattern = re.compile(r'step-(\d+)\.(npz|pickle)$')
+
+
+## Open a single output file as a Frame
+def load(filename):
+    return Frame(filename)
+
+
+class Trajectory:
+    """The frames of a run directory, in step order. Indexing gives the
+    k-th frame (negative indices count from the end), frame(stepNum) the
+    frame of a step.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        files = {}
+        for f in glob.glob(os.path.join(path, 'step-*')):
+            m = _stepPattern.search(f)
+            if m:
+                step = int(m.group(1))
+                # prefer checkpoints if a step has both
+                if step not in files or f.endswith('.npz'):
+                    files[step] = f
+        self.steps = sorted(files.keys())
+        self.files = [files[step] for step in self.steps]
+
+    def __len__(self):
+        return len(self.files)
+
+    def __getitem__(self, k):
+        if isinstance(k, slice):
+            return [Frame(f) for f in self.files[k]]
+        return Frame(self.files[k])
+
+    def __iter__(self):
+        for f in self.files:
+            yield Frame(f)
+
+    def frame(self, stepNum):
+        return Frame(self.files[self.steps.index(stepNum)])
+
+    ## Iterate over (stepNum, array) of field name in each frame
+    def field(self, name):
+        for frame in self:
+            yield (frame.stepNum, frame[name])
+
+    ## Iterate over (stepNum, {name: array}) of the given fields in each frame
+    def fields(self, names):
+        for frame in self:
+            yield (frame.stepNum, frame.fields(names))
+
+
+class Frame(Mapping):
+    """One saved step: a mapping from field name (pos, dir, length,
+    species, signals etc.) to an array with a row per cell, in the order
+    of ids.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.checkpoint = None
+        self.pickleData = None
+        self.columns = {}
+        if filename.endswith('.npz'):
+            self.checkpoint = Checkpoint.Checkpoint(filename)
+            self.stepNum = self.checkpoint.stepNum
+            self.names = sorted([k.split('_', 1)[1] for k in self.checkpoint.npz.files
+                                 if k.startswith('col_') or k.startswith('attr_')])
+        else:
+            self.loadPickle()
+            m = _stepPattern.search(filename)
+            self.stepNum = self.pickleData.get('stepNum', int(m.group(1)) if m else None)
+
+    def loadPickle(self):
+        with open(self.filename, 'rb') as f:
+            data = pickle.load(f)
+        # old-style pickles are a tuple of (cellStates, lineage)
+        if isinstance(data, tuple):
+            data = {'cellStates': data[0], 'lineage': data[1]}
+        self.pickleData = data
+        states = list(data['cellStates'].values())
+        self.pickleIds = numpy.array([s.id for s in states])
+        self.pickleIdxs = numpy.array([s.__dict__.get('idx', -1) for s in states])
+        names = set()
+        for s in states:
+            names.update(s.__dict__.keys())
+        for name in names:
+            if name in ['_store', 'id', 'idx']:
+                continue
+            try:
+                arr = numpy.asarray([getattr(s, name) for s in states])
+            except (AttributeError, ValueError):
+                continue
+            if arr.dtype.kind in 'biuf':
+                self.columns[name] = arr
+        self.names = sorted(self.columns.keys())
+
+    ## Cell ids, one per row
+    @property
+    def ids(self):
+        if self.checkpoint:
+            return self.checkpoint.ids()
+        return self.pickleIds
+
+    ## Rows of the cells in the simulation's CellStore (cell.idx)
+    @property
+    def idxs(self):
+        if self.checkpoint:
+            return self.checkpoint.array('idxs')
+        return self.pickleIdxs
+
+    def __len__(self):
+        return len(self.names)
+
+    def __iter__(self):
+        return iter(self.names)
+
+    def __getitem__(self, name):
+        if name not in self.columns:
+            if not self.checkpoint or name not in self.names:
+                raise KeyError(name)
+            self.columns[name] = self.checkpoint.column(name)
+        return self.columns[name]
+
+    ## Dict of the arrays of the given fields
+    def fields(self, names):
+        return dict([(name, self[name]) for name in names])
+
+    @property
+    def numCells(self):
+        return len(self.ids)
+
+    ## Lineage (cell id: parent id) up to this frame
+    @property
+    def lineage(self):
+        if self.checkpoint:
+            return self.checkpoint['lineage']
+        return self.pickleData.get('lineage', {})
+
+    ## The data dict of this frame (as written by Simulator.writePickle), e.g.
+    # for Simulator.loadFromPickle. Cell states are built when accessed.
+    @property
+    def data(self):
+        if self.checkpoint:
+            return self.checkpoint
+        return self.pickleData
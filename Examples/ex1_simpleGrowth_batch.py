@@ -0,0 +1,51 @@
+import random
+from CellModeller.Regulation.ModuleRegulator import ModuleRegulator
+from CellModeller.Biophysics.BacterialModels.CLBacterium import CLBacterium
+import numpy
+import math
+
+# Same model as ex1_simpleGrowth, using the vectorized update_batch function
+# instead of update
+
+cell_cols = {0:[0,1.0,0], 1:[1.0,0,0]}
+
+def setup(sim):
+    # Set biophysics, signalling, and regulation models
+    biophys = CLBacterium(sim, jitter_z=False, max_cells=100000, gamma=100.)
+
+    # use this file for reg too
+    regul = ModuleRegulator(sim, sim.moduleName)	
+    # Only biophys and regulation
+    sim.init(biophys, regul, None, None)
+
+    # Store targetVol as a column so update_batch can see it
+    sim.cellStore.addColumn('targetVol')
+ 
+    # Specify the initial cell and its location in the simulation
+    sim.addCell(cellType=0, pos=(0,0,0), dir=(1,0,0))
+
+    # Add some objects to draw the models
+    if sim.is_gui:
+        from CellModeller.GUI import Renderers
+        therenderer = Renderers.GLBacteriumRenderer(sim)
+        sim.addRenderer(therenderer)
+
+    sim.pickleSteps = 100
+
+def init(cell):
+    # Specify mean and distribution of initial cell size
+    cell.targetVol = 3.5 + random.uniform(0.0,0.5)
+    # Specify growth rate of cells
+    cell.growthRate = 1.0
+    cell.color = cell_cols[cell.cellType]
+
+def update_batch(cols):
+    # Flag all cells that reach target size for division at once
+    cols['divideFlag'][:] = cols['volume'] > cols['targetVol']
+
+def divide_batch(cols, d1idxs, d2idxs):
+    # Specify target cell size that triggers cell division, for all
+    # daughters at once
+    targetVol = cols['targetVol']
+    targetVol[d1idxs] = 3.5 + numpy.random.uniform(0.0,0.5,len(d1idxs))
+    targetVol[d2idxs] = 3.5 + numpy.random.uniform(0.0,0.5,len(d2idxs))
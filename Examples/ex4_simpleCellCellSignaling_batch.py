@@ -0,0 +1,117 @@
+import random
+from CellModeller.Regulation.ModuleRegulator import ModuleRegulator
+from CellModeller.Biophysics.BacterialModels.CLBacterium import CLBacterium
+import numpy
+import math
+
+from CellModeller.Signalling.GridDiffusion import GridDiffusion #add
+from CellModeller.Integration.CLCrankNicIntegrator import CLCrankNicIntegrator #add
+
+# Same model as ex4_simpleCellCellSignaling, using the vectorized
+# update_batch function instead of update
+
+max_cells = 2**15
+
+#Specify parameter for solving diffusion dynamics #Add
+grid_dim = (64, 8, 12) # dimension of diffusion space, unit = number of grid
+grid_size = (4, 4, 4) # grid size
+grid_orig = (-128, -14, -8) # where to place the diffusion space onto simulation space
+
+
+def setup(sim):
+    # Set biophysics, signalling, and regulation models
+    biophys = CLBacterium(sim, jitter_z=False, max_planes=2)
+ 
+    # add the planes to set physical  boundaries of cell growth
+    biophys.addPlane((0,-16,0), (0,1,0), 1)
+    biophys.addPlane((0,16,0), (0,-1,0), 1)
+
+    sig = GridDiffusion(sim, 1, grid_dim, grid_size, grid_orig, [10.0])
+    integ = CLCrankNicIntegrator(sim, 1, 3, max_cells, sig, boundcond='reflect')
+
+    # use this file for reg too
+    regul = ModuleRegulator(sim, sim.moduleName)	
+    # Only biophys and regulation
+    sim.init(biophys, regul, sig, integ)
+
+    # Store targetVol as a column so update_batch can see it
+    sim.cellStore.addColumn('targetVol')
+
+    # Specify the initial cell and its location in the simulation
+    sim.addCell(cellType=0, pos=(-10.0,0,0))  #Add
+    sim.addCell(cellType=1, pos=(10.0,0,0)) #Add
+
+    if sim.is_gui:
+        # Add some objects to draw the models
+        from CellModeller.GUI import Renderers
+        therenderer = Renderers.GLBacteriumRenderer(sim)
+        sim.addRenderer(therenderer)
+        sigrend = Renderers.GLGridRenderer(sig, integ) # Add
+        sim.addRenderer(sigrend) #Add
+
+    sim.pickleSteps = 10
+
+def init(cell):
+    # Specify mean and distribution of initial cell size
+    cell.targetVol = 2.5 + random.uniform(0.0,0.5)
+    # Specify growth rate of cells
+    cell.growthRate = 2.0
+    # Specify initial concentration of chemical species
+    cell.species[:] = [0, 0, 0]
+    # Specify initial concentration of signaling molecules 
+    cell.signals[:] = [0]
+
+def specRateCL(): # Add if/else, new species
+    return '''
+    const float D1 = 0.1f;
+    const float k1 = 1.f;
+    const float k2 = 1.f;
+    const float k3 = 1.f;
+    const float k4 = 5e-5;
+
+    float x0 = species[0];
+    float x0_sig = signals[0];
+
+    float RFP = species[1];
+    float GFP = species[2];
+    
+    if (cellType==0){
+    rates[0] = k1 + D1*(x0_sig-x0)*area/gridVolume;
+    rates[1] = k2;
+    rates[2] = 0;
+
+    } else {
+    rates[0] = D1*(x0_sig-x0)*area/gridVolume;
+    rates[1] = 0;
+    rates[2] = k3*x0*x0/(k4 + x0*x0);
+    }
+    '''
+
+    # D1 = diffusion rate of x0 
+    # k1 = production rate of x0
+
+def sigRateCL(): #Add
+    return '''
+    const float D1=0.1f;
+    float x0 = species[0];
+    float x0_sig = signals[0];
+    rates[0] = -D1*(x0_sig-x0)*area/gridVolume;
+    '''
+    # D1 = diffusion rate of x0 
+
+def update_batch(cols):
+    # Colour by RFP/GFP levels and flag cells that reach target size for
+    # division, for all cells at once
+    species = cols['species']
+    color = cols['color']
+    color[:,0] = 0.1 + species[:,1]/20.0
+    color[:,1] = 0.1 + species[:,2]/20.0
+    color[:,2] = 0.1
+    cols['divideFlag'][:] = cols['volume'] > cols['targetVol']
+
+def divide_batch(cols, d1idxs, d2idxs):
+    # Specify target cell size that triggers cell division, for all
+    # daughters at once
+    targetVol = cols['targetVol']
+    targetVol[d1idxs] = 2.5 + numpy.random.uniform(0.0,0.5,len(d1idxs))
+    targetVol[d2idxs] = 2.5 + numpy.random.uniform(0.0,0.5,len(d2idxs))
@@ -9,6 +9,7 @@ from reportlab.lib.colors import Color
 
 import numpy
 import pickle
+from CellModeller import io
 
 mxsig0 = 0
 
@@ -165,6 +166,9 @@ def importPickle(fname):
             data = {'cellStates':data[0]}
         # Return dictionary of simulation data
         return data
+    elif fname[-4:]=='.npz':
+        print(('Importing CellModeller checkpoint file: %s'%fname))
+        return io.load(fname).data
     else:
         return None
 
@@ -189,11 +193,11 @@ def main():
     infns = sys.argv[1:]
     for infn in infns:
         # File names
-        if infn[-7:]!='.pickle':
-            print(('Ignoring file %s, because its not a pickle...'%(infn)))
+        if infn[-7:]!='.pickle' and infn[-4:]!='.npz':
+            print(('Ignoring file %s, because its not a pickle or checkpoint...'%(infn)))
             continue
 
-        outfn = infn.replace('.pickle', '.pdf')
+        outfn = os.path.splitext(infn)[0]+'.pdf'
         outfn = os.path.basename(outfn) # Put output in this dir
         print(('Processing %s to generate %s'%(infn,outfn)))
         
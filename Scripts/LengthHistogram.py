@@ -1,35 +1,28 @@
 import sys
 import os
-import math
 import numpy as np
 sys.path.append('.')
-import pickle
-import CellModeller
+from CellModeller import io
 #import matplotlib.pyplot as plt
 
-file = sys.argv[1] #select pickle file in command line
+file = sys.argv[1] #select pickle or npz file in command line
 output_file = open('LengthData.csv','w')
 
 
-def rad_pos(cellstate):
-    return np.sqrt(cellstate.pos[0]*cellstate.pos[0]+cellstate.pos[1]*cellstate.pos[1])
+def rad_pos(pos):
+    return np.sqrt(pos[:,0]*pos[:,0]+pos[:,1]*pos[:,1])
 
-def lengthHist(pickle, bins, file=False):
-    print(('opening '+ pickle))
-    data = pickle.load(open(pickle,'r'))
-    cs = data['cellStates']
-    it = iter(cs)
-    n = len(cs)
+def lengthHist(fname, bins, file=False):
+    print(('opening '+ fname))
+    return frameLengthHist(io.load(fname), bins, file)
+
+def frameLengthHist(frame, bins, file=False):
+    n = frame.numCells
     print(('Number of cells = '+str(n)))
-    lens = []
-    r = []
-    for it in cs:
-        radialPosition = rad_pos(cs[it])
-        cellLength = cs[it].length+2*cs[it].radius
-        r.append(radialPosition)
-        lens.append(cellLength)
-        if file:
-            file.write(str(radialPosition)+', '+ str(cellLength)+'\n')
+    r = rad_pos(frame['pos'])
+    lens = frame['length']+2*frame['radius']
+    if file:
+        np.savetxt(file, np.column_stack((r, lens)), fmt='%s', delimiter=', ')
     #plt.hist(lens,bins)
     #heatmap, xedges, yedges = np.histogram2d(r, lens, bins=100)
     #extent = [xedges[0], xedges[-1], yedges[0], yedges[-1]]
@@ -39,17 +32,16 @@ def lengthHist(pickle, bins, file=False):
     return r, lens
 
 def dirLengthHist(dir,bins,file=False):
-    for f in os.listdir(dir):
-        if '.pickle' in f:
-            number = f[5:-7]
-            if file:
-                fout = open('LengthData'+number+'.csv')
-            print(('step number = ', number))
-            n, lens = lengthHist(dir + f,bins,file)
-            if file:
-                fout.close()
+    for frame in io.Trajectory(dir):
+        number = '%05i'%frame.stepNum
+        fout = False
+        if file:
+            fout = open('LengthData'+number+'.csv','w')
+        print(('step number = ', number))
+        n, lens = frameLengthHist(frame,bins,fout)
+        if fout:
+            fout.close()
 
 bin = np.arange(0.0,6.0,0.1)
 lengthHist(file,bin,output_file)
 output_file.close()
-
@@ -4,18 +4,15 @@ import subprocess
 import string
 import shutil
 
-from CellModeller.Simulator import Simulator
+from CellModeller import Batch
+from CellModeller import Devices
 
 max_cells = 50000
 cell_buffer = 256
 
 def simulate(modfilename, platform, device, steps=50):
-    (path,name) = os.path.split(modfilename)
-    modname = str(name).split('.')[0]
-    sys.path.append(path)
-    sim = Simulator(modname, 0.025, clPlatformNum=platform, clDeviceNum=device, saveOutput=True)
-    while len(sim.cellStates) < max_cells-cell_buffer:
-        sim.step()
+    Batch.runOne(modfilename, 0.025, platform=platform, device=device, saveOutput=True,
+                 maxCells=max_cells-cell_buffer)
 
 def main():
     # Get module name to load
@@ -25,23 +22,10 @@ def main():
     else:
         moduleName = sys.argv[1]
 
-    # Get OpenCL platform/device numbers
-    if len(sys.argv)<3:
-        # User input of OpenCL setup
-        import pyopencl as cl
-        # Platform
-        platforms = cl.get_platforms()
-        print("Select OpenCL platform:")
-        for i in range(len(platforms)):
-            print(('press '+str(i)+' for '+str(platforms[i])))
-        platnum = int(eval(input('Platform Number: ')))
-
-        # Device
-        devices = platforms[platnum].get_devices()
-        print("Select OpenCL device:")
-        for i in range(len(devices)):
-            print(('press '+str(i)+' for '+str(devices[i])))
-        devnum = int(eval(input('Device Number: ')))
+    # Get OpenCL platform/device numbers, by default from the
+    # CELLMODELLER_DEVICE environment variable (see CellModeller.Devices)
+    if len(sys.argv)<4:
+        (platnum, devnum) = Devices.deviceFromEnv()
     else:
         platnum = int(sys.argv[2])
         devnum = int(sys.argv[3])
@@ -1,23 +1,28 @@
-import os
+#
+# Run a model for a range of values of gamma, in parallel.
+#
+# The model should use a module-level gamma in its setup, e.g.
+#   gamma = 100.
+#   def setup(sim):
+#       biophys = CLBacterium(sim, ..., gamma=gamma)
+#
+# Usage: python batch_iter.py model.py [workers]
+#
 import sys
-import subprocess
-import string
-import shutil
 
-from CellModeller.Simulator import Simulator
-
-sys.path.append('../../Models')
+from CellModeller import Batch
 
 max_cells = 100000
 cell_buffer = 256
 
 gammas = [2,5,10,15,30,50,100,500]
 
-def simulate(mod_name, ingam, fname):
-    sim = Simulator(mod_name, 0.25, ingam, 25, fname)
-    while len(sim.cellStates) < max_cells-cell_buffer:
-        sim.step()
+def main():
+    modfilename = sys.argv[1]
+    workers = int(sys.argv[2]) if len(sys.argv)>2 else None
+    runs = Batch.makeRuns({'gamma': gammas})
+    Batch.runBatch(modfilename, runs, workers=workers, dt=0.25, pickleSteps=25,
+                   maxCells=max_cells-cell_buffer)
 
-#here we are varying gamma from 1 to 50, every 2
-for i in range(len(gammas)):
-    simulate(sys.argv[1],gammas[i],(str(sys.argv[1])+'_gamma='+str(gammas[i]))
+if __name__ == "__main__":
+    main()
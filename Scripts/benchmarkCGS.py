@@ -0,0 +1,123 @@
+#
+# Compare the CGS solver modes in CLBacterium (standard/fused, and the
+# Jacobi/block-Jacobi preconditioners) on a packed colony of overlapping
+# cells. All modes solve the same system; the iterations per second,
+# iteration count, total solve time and final residual are reported, and
+# the solution is compared with the standard unpreconditioned one.
+#
+# Usage: python benchmarkCGS.py [--layers L] [n_cells ...]
+#
+# With L > 1 the cells are stacked in L layers, giving a dense 3D colony.
+#
+import sys
+import math
+import time
+import random
+import numpy
+import pyopencl as cl
+
+from CellModeller.Biophysics.BacterialModels.CLBacterium import CLBacterium
+
+repeats = 3
+dt = 0.025
+# tighter than the default, so that the solve takes a realistic number of
+# iterations for a dense colony
+cgs_tol = 1e-5
+
+# (name, fused_cgs, preconditioner)
+modes = [('standard', False, None),
+         ('fused', True, None),
+         ('jacobi', False, 'jacobi'),
+         ('block_jacobi', False, 'block_jacobi'),
+         ('fused+block_jacobi', True, 'block_jacobi')]
+
+class BenchSim:
+    # Just enough of the Simulator for CLBacterium
+    def __init__(self):
+        self.context = cl.create_some_context(interactive=False)
+        self.queue = cl.CommandQueue(self.context)
+
+    def getOpenCL(self):
+        return (self.context, self.queue)
+
+def make_colony(sim, n, layers):
+    d = int(math.ceil(math.sqrt(float(n)/layers)))
+    # allocate for the block preconditioner, so that all modes can be run
+    phys = CLBacterium(sim, max_cells=n, jitter_z=False, printing=False,
+                       max_sqs=256**2, cgs_tol=cgs_tol,
+                       preconditioner='block_jacobi')
+    phys.setRegulator(None)
+    random.seed(1)
+    for k in range(n):
+        (l, ij) = (k//(d*d), k%(d*d))
+        (i, j) = (ij//d - d//2, ij%d - d//2)
+        x = i*2.9 + random.uniform(-0.05,0.05)
+        y = j*0.95 + random.uniform(-0.05,0.05)
+        z = l*0.95 + (random.uniform(-0.05,0.05) if layers > 1 else 0.0)
+        th = random.uniform(-0.15, 0.15)
+        phys.cell_centers[k] = (x, y, z, 0)
+        phys.cell_dirs[k] = (math.cos(th), math.sin(th), 0, 0)
+        phys.cell_lens[k] = 2.0
+        phys.cell_rads[k] = 0.5
+        phys.cell_growth_rates[k] = 2.0
+    phys.n_cells = n
+    phys.set_cells()
+    phys.calc_cell_geom()
+
+    # Set up contacts and the matrix, as in the first substep of a tick
+    phys.sub_tick_init(dt)
+    phys.predict()
+    phys.find_contacts()
+    phys.collect_tos()
+    phys.compact_contacts()
+    phys.build_matrix()
+    return phys
+
+def solve(phys, fused, preconditioner):
+    phys.fused_cgs = fused
+    phys.precond = phys.preconditioners[preconditioner]
+    best = None
+    for r in range(repeats):
+        phys.queue.finish()
+        t0 = time.time()
+        (iters, res) = phys.CGSSolve(dt, 10.0)
+        phys.queue.finish()
+        t = time.time()-t0
+        if best is None or t < best:
+            best = t
+    deltap = phys.deltap_dev[0:phys.n_cells].get().view(numpy.float32).reshape((phys.n_cells, 8))
+    # remove rotation of cells about their own axis, which does not change
+    # anything and is not determined by the system
+    dirs = phys.cell_dirs[0:phys.n_cells].view(numpy.float32).reshape((phys.n_cells, 4))[:,0:3]
+    deltap[:,3:6] -= (deltap[:,3:6]*dirs).sum(axis=1)[:,numpy.newaxis]*dirs
+    return (iters, res, best, deltap)
+
+def bench(sim, n, layers):
+    phys = make_colony(sim, n, layers)
+    print("%i cells, %i contacts" % (n, phys.n_cts))
+    ref = None
+    for (name, fused, preconditioner) in modes:
+        (iters, res, t, x) = solve(phys, fused, preconditioner)
+        if ref is None:
+            ref = x
+        diff = numpy.abs(x-ref).max()/max(numpy.abs(ref).max(), 1e-12)
+        print("  %-20s %8i %10.1f %10.4f %10.2e %10.2e" % (
+            name, iters, iters/t, t, res, diff))
+
+def main():
+    args = sys.argv[1:]
+    layers = 1
+    if '--layers' in args:
+        k = args.index('--layers')
+        layers = int(args[k+1])
+        del args[k:k+2]
+    sizes = [int(a) for a in args] or [1000, 10000, 100000]
+    sim = BenchSim()
+    print("Device: %s, %i layer(s)" % (sim.context.devices[0].name, layers))
+    print("  %-20s %8s %10s %10s %10s %10s" % (
+        'mode', 'iters', 'it/s', 'solve (s)', 'residual', 'rel diff'))
+    for n in sizes:
+        bench(sim, n, layers)
+
+if __name__ == '__main__':
+    main()
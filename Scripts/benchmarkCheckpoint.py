@@ -0,0 +1,90 @@
+#
+# Compare the write/read time and file size of the pickle output format
+# with the columnar npz checkpoints (CellModeller.Checkpoint), for a
+# synthetic colony of n_cells cells. For the checkpoints, the time taken to
+# snapshot the data is also shown, which is as long as the simulation waits
+# when output is written in the background (Simulator(asyncOutput=True)).
+#
+# Usage: python benchmarkCheckpoint.py [n_cells ...]
+#
+import os
+import sys
+import time
+import pickle
+import shutil
+import tempfile
+import numpy
+
+from CellModeller.CellState import CellState
+from CellModeller.CellStore import CellStore
+from CellModeller import Checkpoint
+
+def make_states(n):
+    store = CellStore()
+    store.addColumn('targetVol')
+    cellStates = {}
+    lineage = {}
+    for i in range(n):
+        cid = i+1
+        state = CellState(cid, store, i)
+        state.targetVol = 3.5 + numpy.random.uniform(0.0, 0.5)
+        state.neighbours = list(numpy.random.randint(1, n+1, 4))
+        cellStates[cid] = state
+        if cid > 1:
+            lineage[cid] = cid//2
+    for name in ['pos', 'dir', 'length', 'volume', 'growthRate']:
+        store[name] = numpy.random.uniform(0.0, 1.0, store[name].shape)
+    return (cellStates, store, lineage)
+
+def timed(f):
+    t0 = time.time()
+    res = f()
+    return (time.time()-t0, res)
+
+def bench(n, path):
+    (cellStates, store, lineage) = make_states(n)
+    results = []
+
+    pname = os.path.join(path, 'step-00001.pickle')
+    def write_pickle():
+        data = {'cellStates': cellStates, 'stepNum': 1, 'lineage': lineage,
+                'moduleStr': '', 'moduleName': 'bench'}
+        with open(pname, 'wb') as f:
+            pickle.dump(data, f, protocol=-1)
+    def read_pickle():
+        with open(pname, 'rb') as f:
+            data = pickle.load(f)
+        return len(data['cellStates'])
+    (tw, _) = timed(write_pickle)
+    (tr, _) = timed(read_pickle)
+    results.append(('pickle', None, tw, tr, None, os.path.getsize(pname)))
+
+    for compress in [True, False]:
+        cname = os.path.join(path, 'step-%05i.npz' % (2 if compress else 3))
+        (ts, data) = timed(lambda: Checkpoint.snapshot(cellStates, store, 1, lineage, 'bench'))
+        (tw, _) = timed(lambda: Checkpoint.writeData(cname, data, compress))
+        # reading all cell states, and just one column
+        (tr, _) = timed(lambda: [s.volume for s in Checkpoint.load(cname)['cellStates'].values()])
+        (tc, _) = timed(lambda: Checkpoint.load(cname).column('volume'))
+        results.append(('npz' + (' compressed' if compress else ''), ts, ts+tw, tr, tc,
+                         os.path.getsize(cname)))
+
+    print("%i cells" % n)
+    for (name, ts, tw, tr, tc, size) in results:
+        print("  %-16s %12s %10.2f %10.2f %12s %10.1f" % (name,
+              '%.2f' % ts if ts is not None else '-', tw, tr,
+              '%.3f' % tc if tc is not None else '-', size/1024.0/1024.0))
+
+def main():
+    sizes = [int(a) for a in sys.argv[1:]] or [10000, 100000, 300000]
+    print("  %-16s %12s %10s %10s %12s %10s" % ('format', 'snapshot (s)', 'write (s)',
+                                                 'read (s)', 'column (s)', 'size (MB)'))
+    path = tempfile.mkdtemp()
+    try:
+        for n in sizes:
+            bench(n, path)
+    finally:
+        shutil.rmtree(path)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,114 @@
+#
+# Model used by benchmarkSuite.py: a packed colony of n_cells cells on a
+# lattice, growing and dividing. The module-level parameters below are set
+# by the benchmark for each scenario (see the params argument of
+# Simulator).
+#
+import random
+import math
+import numpy
+from CellModeller.Regulation.ModuleRegulator import ModuleRegulator
+from CellModeller.Biophysics.BacterialModels.CLBacterium import CLBacterium
+from CellModeller.Integration.CLCrankNicIntegrator import CLCrankNicIntegrator
+from CellModeller.Integration.CLEulerIntegrator import CLEulerIntegrator
+from CellModeller.Signalling.GridDiffusion import GridDiffusion
+
+n_cells = 1000          # initial cells
+layers = 1              # layers of cells stacked in z
+planes = False          # confine the colony to a channel between two planes
+sphere = False          # confine the colony inside a sphere
+signalling = False      # one signal on a 64x64x8 grid, Crank-Nicolson integrator
+species = False         # one species, Euler integrator (no signalling)
+resident = False        # keep species levels on the device (deviceResident)
+neighbours = False      # find the neighbours of each cell (compNeighbours)
+adaptive = False        # choose the length of each physics tick (adaptive_dt)
+replicates = 1          # colonies in the ensemble (also passed to the Simulator)
+max_cells = None        # default 4*n_cells*replicates
+
+cell_length = 2.0
+spacing = (cell_length+1.0, 1.0, 1.0) # lattice spacing, cells just touching
+
+grid_dim = (64, 64, 8)
+grid_size = (4, 4, 4)
+grid_orig = (-128, -128, -16)
+
+
+def lattice():
+    d = int(math.ceil(math.sqrt(float(n_cells)/layers)))
+    pos = []
+    for k in range(n_cells):
+        (l, ij) = (k//(d*d), k%(d*d))
+        (i, j) = (ij//d - d//2, ij%d - d//2)
+        pos.append((i*spacing[0], j*spacing[1], (l - (layers-1)*0.5)*spacing[2]))
+    return (d, pos)
+
+
+def setup(sim):
+    ncells = max_cells or 4*n_cells*replicates
+    (d, pos) = lattice()
+    biophys = CLBacterium(sim, max_cells=ncells, max_planes=2, max_spheres=1,
+                          max_sqs=256**2, jitter_z=(layers > 1), gamma=100.0, printing=False,
+                          compNeighbours=neighbours, adaptive_dt=adaptive,
+                          # keeps the squares of overlapping colonies apart
+                          hash_grid_size=(2**16 if replicates > 1 else None))
+    if planes:
+        # channel just wider than the colony
+        h = (d//2 + 1)*spacing[1]
+        biophys.addPlane((0,-h,0), (0,1,0), 1)
+        biophys.addPlane((0,h,0), (0,-1,0), 1)
+    if sphere:
+        # room for the colony to grow for a while
+        biophys.addSphere((0,0,0), 1.5*d*spacing[0]*0.5, 1.0, -1)
+
+    sig = None
+    integ = None
+    if signalling:
+        sig = GridDiffusion(sim, 1, grid_dim, grid_size, grid_orig, [10.0])
+        integ = CLCrankNicIntegrator(sim, 1, 1, ncells, sig, boundcond='reflect', deviceResident=resident)
+    elif species:
+        integ = CLEulerIntegrator(sim, 1, ncells, deviceResident=resident)
+
+    regul = ModuleRegulator(sim, sim.moduleName)
+    sim.init(biophys, regul, sig, integ)
+    sim.cellStore.addColumn('targetVol')
+
+    for p in pos:
+        th = random.uniform(-0.1, 0.1)
+        sim.addCell(cellType=0, pos=p, dir=(math.cos(th), math.sin(th), 0), length=cell_length)
+
+
+def init(cell):
+    cell.targetVol = cell_length + 1.0 + random.uniform(0.0, 0.5)
+    cell.growthRate = 2.0
+    if signalling or species:
+        cell.species[:] = [0]
+    if signalling:
+        cell.signals[:] = [0]
+
+
+def specRateCL():
+    if signalling:
+        return '''
+        const float D1 = 0.1f;
+        rates[0] = 1.f + D1*(signals[0]-species[0])*area/gridVolume;
+        '''
+    return '''
+    rates[0] = 1.f - 0.1f*species[0];
+    '''
+
+
+def sigRateCL():
+    return '''
+    const float D1 = 0.1f;
+    rates[0] = -D1*(signals[0]-species[0])*area/gridVolume;
+    '''
+
+
+def update_batch(cols):
+    cols['divideFlag'][:] = cols['volume'] > cols['targetVol']
+
+
+def divide_batch(cols, d1idxs, d2idxs):
+    targetVol = cols['targetVol']
+    targetVol[d1idxs] = cell_length + 1.0 + numpy.random.uniform(0.0, 0.5, len(d1idxs))
+    targetVol[d2idxs] = cell_length + 1.0 + numpy.random.uniform(0.0, 0.5, len(d2idxs))
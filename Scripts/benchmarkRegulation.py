@@ -0,0 +1,75 @@
+#
+# Compare the per-cell update(cells) regulation path with the vectorized
+# update_batch(cols) path, using the division/colouring rules from
+# ex4_simpleCellCellSignaling. Does not need OpenCL.
+#
+# Usage: python benchmarkRegulation.py [n_cells ...]
+#
+import sys
+import time
+import random
+import numpy
+
+from CellModeller.CellState import CellState
+from CellModeller.CellStore import CellStore
+
+n_species = 3
+repeats = 10
+
+def update(cells):
+    for (id, cell) in cells.items():
+        cell.color = [0.1+cell.species[1]/20.0, 0.1+cell.species[2]/20.0, 0.1]
+        if cell.volume > cell.targetVol:
+            cell.divideFlag = True
+
+def update_batch(cols):
+    species = cols['species']
+    color = cols['color']
+    color[:,0] = 0.1 + species[:,1]/20.0
+    color[:,1] = 0.1 + species[:,2]/20.0
+    color[:,2] = 0.1
+    cols['divideFlag'][:] = cols['volume'] > cols['targetVol']
+
+def make_cells(n):
+    store = CellStore()
+    store.addColumn('targetVol')
+    specLevel = numpy.random.uniform(0, 10, (n, n_species)).astype(numpy.float32)
+    cells = {}
+    for i in range(n):
+        cell = CellState(i+1, store, i)
+        cell.volume = random.uniform(2.0, 3.5)
+        cell.targetVol = 2.5 + random.uniform(0.0, 0.5)
+        cell.species = specLevel[i,:]
+        cells[i+1] = cell
+    return (store, cells, specLevel)
+
+def bench(n):
+    (store, cells, specLevel) = make_cells(n)
+
+    t0 = time.time()
+    for r in range(repeats):
+        update(cells)
+    t_dict = (time.time()-t0)/repeats
+    flags_dict = store['divideFlag'].copy()
+    colors_dict = store['color'].copy()
+
+    store['divideFlag'] = False
+    t0 = time.time()
+    for r in range(repeats):
+        cols = dict((name, store[name]) for name in store.columns)
+        cols['species'] = specLevel[0:n]
+        update_batch(cols)
+    t_batch = (time.time()-t0)/repeats
+
+    assert (store['divideFlag']==flags_dict).all()
+    assert numpy.allclose(store['color'], colors_dict)
+    print('%8i cells   update: %10.6f s   update_batch: %10.6f s   speedup: %6.1fx' \
+            % (n, t_dict, t_batch, t_dict/t_batch))
+
+def main():
+    sizes = [int(a) for a in sys.argv[1:]] or [1000, 10000, 100000]
+    for n in sizes:
+        bench(n)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,220 @@
+#
+# Benchmark suite for the simulation hot paths, on fixed, seeded scenarios
+# (see benchmarkColony.py for the model):
+#
+#   monolayer_1k/10k/50k  2D colony of 1000, 10000 and 50000 cells
+#   colony_3d             10000 cells in 4 layers
+#   planes                5000 cells in a channel between two planes
+#   sphere                5000 cells inside a sphere
+#   signalling_cranknic   1000 cells, one signal on a 64x64x8 grid (Crank-Nicolson)
+#   species_euler         5000 cells with one species (Euler), no signalling
+#   *_resident            as above, with the levels kept on the device
+#   neighbours            5000 cells, finding the neighbours of each cell
+#   adaptive              5000 cells, with adaptive physics ticks
+#   ensemble_8x1k         8 replicate colonies of 1000 cells in one simulator
+#
+# Each scenario sets up its colony, runs a warm-up step, then times
+# n_steps steps. Reported for each: steps/s, CG iterations and physics
+# ticks per step, contacts that did not fit in max_contacts, times the
+# contact candidates were found, per-phase times (with --profile), peak
+# host memory, device memory held by the models, and the time and size of
+# writing an npz checkpoint and a pickle of the final state. Results are
+# written to a JSON file, with the device and versions, and can be
+# compared with an earlier results file to catch performance regressions:
+#
+# Usage: python benchmarkSuite.py [-o results.json] [--compare old.json]
+#            [--threshold 0.1] [--steps n] [--profile] [scenario ...]
+#
+# Exits with status 1 if --compare finds a scenario with steps/s lower (or
+# checkpoint time higher) than the old results by more than threshold.
+#
+import os
+import sys
+import glob
+import json
+import time
+import random
+import shutil
+import platform
+import argparse
+import resource
+import subprocess
+import tempfile
+import numpy
+import pyopencl as cl
+import pyopencl.array as cl_array
+
+import CellModeller
+from CellModeller import Devices
+from CellModeller.Simulator import Simulator
+
+model = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'benchmarkColony.py')
+
+# name: (model parameters, steps timed)
+scenarios = {
+    'monolayer_1k': ({'n_cells': 1000}, 50),
+    'monolayer_10k': ({'n_cells': 10000}, 20),
+    'monolayer_50k': ({'n_cells': 50000}, 10),
+    'colony_3d': ({'n_cells': 10000, 'layers': 4}, 20),
+    'planes': ({'n_cells': 5000, 'planes': True}, 20),
+    'sphere': ({'n_cells': 5000, 'sphere': True}, 20),
+    'signalling_cranknic': ({'n_cells': 1000, 'signalling': True}, 20),
+    'species_euler': ({'n_cells': 5000, 'species': True}, 20),
+    'signalling_resident': ({'n_cells': 1000, 'signalling': True, 'resident': True}, 20),
+    'species_resident': ({'n_cells': 5000, 'species': True, 'resident': True}, 20),
+    'neighbours': ({'n_cells': 5000, 'neighbours': True}, 20),
+    'adaptive': ({'n_cells': 5000, 'adaptive': True}, 20),
+    'ensemble_8x1k': ({'n_cells': 1000, 'replicates': 8}, 20),
+}
+
+seed = 1
+
+
+## Bytes of device memory held in OpenCL arrays by the models of sim
+def deviceBytes(sim):
+    buffers = {}
+    for obj in [sim.phys, sim.sig, sim.integ]:
+        if obj is None:
+            continue
+        for val in obj.__dict__.values():
+            if isinstance(val, cl_array.Array) and val.base_data is not None:
+                buffers[val.base_data.int_ptr] = val.base_data.size
+    return sum(buffers.values())
+
+
+## Time writing the output of sim in format fmt to path
+def timeOutput(sim, fmt, path):
+    sim.outputDirPath = path
+    sim.moduleOutput = ''
+    sim.checkpointFormat = fmt
+    t0 = time.time()
+    sim.writeOutput()
+    sim.flushOutput()
+    t = time.time()-t0
+    ext = 'npz' if fmt == 'npz' else 'pickle'
+    # (one file for each colony of an ensemble, in its own directory)
+    files = glob.glob(os.path.join(path, '**', 'step-%05i.%s' % (sim.stepNum, ext)), recursive=True)
+    return (t, sum([os.path.getsize(f) for f in files]))
+
+
+def runScenario(name, n_steps=None, profile=False):
+    (params, steps) = scenarios[name]
+    steps = n_steps or steps
+    random.seed(seed)
+    numpy.random.seed(seed)
+    t0 = time.time()
+    sim = Simulator(model, 0.025, params=params, profile=profile,
+                    replicates=params.get('replicates', 1))
+    sim.saveOutput = False
+    setupTime = time.time()-t0
+
+    # warm up (compiles kernels, sizes arrays), not timed
+    sim.step()
+    sim.profiler.reset()
+    n0 = len(sim.cellStates)
+    iters0 = len(sim.phys.cgs_frame_iters)
+    builds0 = sim.phys.n_cand_builds
+    sim.CLQueue.finish()
+    t0 = time.time()
+    for i in range(steps):
+        sim.step()
+    sim.CLQueue.finish()
+    t = time.time()-t0
+    iters = sim.phys.cgs_frame_iters[iters0:]
+    ticks = sim.phys.frame_ticks[iters0:]
+
+    res = {'params': params, 'steps': steps, 'setupTime': setupTime,
+           'cellsStart': n0, 'cellsEnd': len(sim.cellStates), 'contacts': int(sim.phys.n_cts),
+           'ticksPerStep': float(numpy.mean(ticks)) if ticks else 0.0,
+           'tickRejects': sim.phys.tick_rejects,
+           'contactOverflows': sim.phys.ct_overflows,
+           'candidateBuilds': sim.phys.n_cand_builds-builds0,
+           'time': t, 'stepsPerSec': steps/t, 'cellStepsPerSec': steps*0.5*(n0+len(sim.cellStates))/t,
+           'cgsItersPerStep': float(numpy.mean(iters)) if iters else 0.0, 'cgsItersMax': int(max(iters or [0])),
+           'deviceBytes': deviceBytes(sim),
+           'hostPeakBytes': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss*1024}
+    if profile:
+        res['profile'] = sim.profiler.summary()
+
+    path = tempfile.mkdtemp()
+    try:
+        (res['npzTime'], res['npzBytes']) = timeOutput(sim, 'npz', path)
+        (res['pickleTime'], res['pickleBytes']) = timeOutput(sim, 'pickle', path)
+    finally:
+        shutil.rmtree(path)
+    return res
+
+
+def environment():
+    key = Devices.deviceFromEnv()
+    devs = [dev for dev in Devices.listDevices() if dev.key == key]
+    try:
+        version = subprocess.check_output(['git', 'describe', '--always', '--dirty'], text=True,
+                                          cwd=os.path.dirname(os.path.abspath(__file__)),
+                                          stderr=subprocess.DEVNULL).strip()
+    except (OSError, subprocess.CalledProcessError):
+        version = getattr(CellModeller, '__version__', None)
+    return {'version': version, 'time': time.strftime('%Y-%m-%d %H:%M:%S'),
+            'device': repr(devs[0]) if devs else Devices.formatDevice(key),
+            'host': platform.node(), 'python': platform.python_version(),
+            'numpy': numpy.__version__, 'pyopencl': cl.VERSION_TEXT}
+
+
+## Scenarios in new that are slower than in old by more than threshold
+def compare(old, new, threshold):
+    regressions = []
+    print("%-22s %12s %12s %8s" % ('scenario', 'old steps/s', 'new steps/s', 'change'))
+    for (name, res) in new['scenarios'].items():
+        if name not in old.get('scenarios', {}):
+            continue
+        o = old['scenarios'][name]
+        change = res['stepsPerSec']/o['stepsPerSec'] - 1.0
+        flag = ''
+        if change < -threshold:
+            regressions.append(name)
+            flag = ' SLOWER'
+        if res['npzTime'] > o['npzTime']*(1.0+threshold) and res['npzTime']-o['npzTime'] > 0.05:
+            regressions.append(name + ' (checkpoint)')
+            flag += ' CHECKPOINT SLOWER'
+        print("%-22s %12.2f %12.2f %+7.1f%%%s" % (name, o['stepsPerSec'], res['stepsPerSec'], change*100, flag))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="CellModeller benchmark suite")
+    parser.add_argument('scenarios', nargs='*', help="scenarios to run (default all): %s" % ', '.join(scenarios))
+    parser.add_argument('-o', '--output', default='benchmark.json', help="results file")
+    parser.add_argument('--compare', help="earlier results file to compare with")
+    parser.add_argument('--threshold', type=float, default=0.1, help="relative slowdown counted as a regression")
+    parser.add_argument('--steps', type=int, help="steps timed in each scenario (default per scenario)")
+    parser.add_argument('--profile', action='store_true', help="also time the phases of each step")
+    args = parser.parse_args()
+    names = args.scenarios or list(scenarios.keys())
+    for name in names:
+        if name not in scenarios:
+            parser.error("unknown scenario %s" % name)
+
+    results = environment()
+    print("Device: %s" % results['device'])
+    results['scenarios'] = {}
+    for name in names:
+        res = runScenario(name, args.steps, args.profile)
+        results['scenarios'][name] = res
+        print("%-22s %8i cells %8.2f steps/s %10.0f cell-steps/s %6.1f CG iters/step %8.1f MB device %6.2f s npz" % (
+              name, res['cellsEnd'], res['stepsPerSec'], res['cellStepsPerSec'], res['cgsItersPerStep'],
+              res['deviceBytes']/1024.0/1024.0, res['npzTime']))
+        # written after each scenario, so that long runs keep their results
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=1)
+    print("Results written to %s" % args.output)
+
+    if args.compare:
+        with open(args.compare) as f:
+            old = json.load(f)
+        regressions = compare(old, results, args.threshold)
+        if regressions:
+            print("Regressions: %s" % ', '.join(regressions))
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main()
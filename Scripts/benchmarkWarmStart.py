@@ -0,0 +1,59 @@
+#
+# Compare the CGS iterations per frame of CLBacterium with and without
+# warm starting (warm_start_cgs), by growing a colony from the given model
+# to n_cells each way.
+#
+# Usage: python benchmarkWarmStart.py [model.py] [n_cells]
+#
+# model defaults to Examples/ex1_simpleGrowth.py.
+#
+import os
+import sys
+import time
+import random
+import numpy
+
+from CellModeller.Simulator import Simulator
+
+def run(modname, n, warm):
+    random.seed(1)
+    numpy.random.seed(1)
+    sim = Simulator(modname, 0.025, saveOutput=False)
+    sim.saveOutput = False # models may turn this on in setup()
+    sim.phys.warm_start_cgs = warm
+    sim.phys.printing = False
+    t0 = time.time()
+    while len(sim.cellStates) < n:
+        sim.step()
+    t = time.time()-t0
+    return (sim.phys.cgs_frame_iters, t)
+
+def main():
+    if len(sys.argv)>1:
+        modfilename = sys.argv[1]
+    else:
+        modfilename = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                   '..', 'Examples', 'ex1_simpleGrowth.py')
+    (path, name) = os.path.split(modfilename)
+    modname = str(name).split('.')[0]
+    sys.path.append(path)
+    n = int(sys.argv[2]) if len(sys.argv)>2 else 1000
+    results = {}
+    for warm in [False, True]:
+        results[warm] = run(modname, n, warm)
+
+    (cold, tcold) = results[False]
+    (warm, twarm) = results[True]
+    print("%s to %i cells" % (modname, n))
+    print("  %-6s %8s %12s %12s %10s" % ('', 'frames', 'iterations', 'iters/frame', 'time (s)'))
+    for (name, iters, t) in [('cold', cold, tcold), ('warm', warm, twarm)]:
+        print("  %-6s %8i %12i %12.1f %10.2f" % (name, len(iters), sum(iters),
+                                                 float(sum(iters))/max(len(iters),1), t))
+    # per-frame counts over the last frames, where the colony is largest
+    last = min(len(cold), len(warm))
+    print("Iterations per frame, last 10 frames:")
+    print("  cold: %s" % cold[last-10:last])
+    print("  warm: %s" % warm[last-10:last])
+
+if __name__ == '__main__':
+    main()
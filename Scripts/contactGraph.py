@@ -2,8 +2,8 @@ import sys
 import os
 import math
 import numpy as np
-import pickle
 import CellModeller
+from CellModeller import io
 import subprocess
 import string
 import shutil
@@ -71,25 +71,17 @@ def generate_network(G,num_cells,ct_tos,n_cts,pos,celldata):
         for j in range(0, n_cts[i]):  #make all edges from contact_tos
             G.add_edge(i,ct_tos[i,j], width=8 , color = 'black')
 
-def get_current_contacts(G, data):
-    cs = data['cellStates']
-    it = iter(cs)
-    n = len(cs)
-    cell_type={}
-    pos_dict={}
-    for it in cs:
-        cell_type[cs[it].idx] = cs[it].cellType
-        pos_dict[cs[it].idx] = cs[it].pos[0:2]
+def get_current_contacts(G, frame):
+    data = frame.data
+    n = frame.numCells
+    idxs = frame.idxs
+    cell_type = dict(zip(idxs.tolist(), frame['cellType'].tolist()))
+    pos_dict = dict(zip(idxs.tolist(), frame['pos'][:,0:2]))
     modname = data['moduleName']
     moduleStr = data['moduleStr']
     sim = Simulator(modname, 0.0, moduleStr=moduleStr, saveOutput=False)
     sim.loadFromPickle(data)
-    sim.phys.update_grid() # we assume local cell_centers is current
-    sim.phys.bin_cells()
-    sim.phys.cell_sqs = sim.phys.cell_sqs_dev.get() # get updated cell sqs
-    sim.phys.sort_cells()
-    sim.phys.sorted_ids_dev.set(sim.phys.sorted_ids) # push changes to the device
-    sim.phys.sq_inds_dev.set(sim.phys.sq_inds)
+    sim.phys.grid_cells()
     sim.phys.find_contacts(predict=False)
     sim.phys.get_cts()
     ct_pts=sim.phys.ct_pts #these are the points on the cell surface - they can be transformed into the global coordinate system
@@ -104,21 +96,13 @@ bg_color = Color(1.0,1.0,1.0,alpha=1.0)
 
 G = networkx.Graph()
 fname = sys.argv[1]
-data = pickle.load(open(fname,'rb'))
-cs = data['cellStates']
-it = iter(cs)
-n = len(cs)
-oname = fname.replace('.pickle','_graph.pdf')
+frame = io.load(fname)
+n = frame.numCells
+oname = os.path.splitext(fname)[0]+'_graph.pdf'
 
 print(("num_cells = "+str(n)))
 
-cell_type={}
-pos_dict={}
-for it in cs:
-    cell_type[cs[it].idx] = cs[it].cellType
-    pos_dict[cs[it].idx] = cs[it].pos[0:2]
-
-get_current_contacts(G, data)
+get_current_contacts(G, frame)
 
 print(("num_contacts = " + str(networkx.number_of_edges(G))))
 degrees = list(G.degree().values())
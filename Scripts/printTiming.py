@@ -1,18 +1,13 @@
 import sys
 import os
 sys.path.append('.')
-import pickle
-import CellModeller
+from CellModeller import io
 
 dir = os.path.join('data', sys.argv[1])
 
 print("No. cells\ttime (s)")
 print("-------------------")
-for f in os.listdir(dir):
-    if 'pickle' in f:
-        ff = os.path.join(dir,f)
-        (cs,lin) = pickle.load(open(ff,'r'))
-        n = len(cs)
-        t = os.path.getmtime(ff)
-        print(("%i\t%f"%(n,t)))
-
+for frame in io.Trajectory(dir):
+    n = frame.numCells
+    t = os.path.getmtime(frame.filename)
+    print(("%i\t%f"%(n,t)))
@@ -0,0 +1,36 @@
+#
+# Run a model with the phases of each step timed (Simulator(profile=True),
+# see CellModeller.Profiler), print the time spent in each phase, and
+# write the times of each step to CSV and JSON files.
+#
+# Usage: python profileModel.py model.py [n_steps] [output file root]
+#
+import os
+import sys
+import time
+
+from CellModeller.Simulator import Simulator
+
+def main():
+    if len(sys.argv)<2:
+        print("Usage: python profileModel.py model.py [n_steps] [output file root]")
+        sys.exit(1)
+    modfilename = sys.argv[1]
+    n_steps = int(sys.argv[2]) if len(sys.argv)>2 else 500
+    root = sys.argv[3] if len(sys.argv)>3 else 'profile'
+
+    sim = Simulator(modfilename, 0.025, profile=True)
+    sim.saveOutput = False # models may turn this on in setup()
+    t0 = time.time()
+    for i in range(n_steps):
+        sim.step()
+    t = time.time()-t0
+
+    print("%i steps, %i cells, %f s per step" % (n_steps, len(sim.cellStates), t/n_steps))
+    sim.profiler.report()
+    sim.profiler.writeCSV(root+'.csv')
+    sim.profiler.writeJSON(root+'.json')
+    print("Step times written to %s.csv and %s.json" % (root, root))
+
+if __name__ == '__main__':
+    main()
@@ -1,10 +1,8 @@
 import sys
 import os
-import math
 import numpy as np
 sys.path.append('.')
-import pickle
-import CellModeller
+from CellModeller import io
 import matplotlib.pyplot as plt
 
 pname= sys.argv[1]
@@ -15,30 +13,27 @@ fout.write("r spec_level \n")
 bin_num=20
 rad_max=95
 
-narray=np.zeros(bin_num)
-specArray=np.zeros(bin_num)
-
-data = pickle.load(open(pname,'r'))
-cs = data['cellStates']
-it = iter(cs)
-n = len(cs)
+frame = io.load(pname)
+pos = frame['pos']
+spec = frame['species'][:,0]
+n = frame.numCells
 
 rArray = np.multiply(list(range(0,bin_num)),rad_max/bin_num)
 
-for it in cs:
-    r = np.sqrt(cs[it].pos[0]*cs[it].pos[0]+cs[it].pos[1]*cs[it].pos[1])
-    for x in range(0,bin_num):
-        if((r>=x*rad_max/bin_num)and(r<(x+1)*rad_max/bin_num)):
-            specArray[x]=specArray[x]*narray[x]+cs[it].species[0]
-            narray[x]+=1
-            specArray[x]=specArray[x]/narray[x]
+# mean level of species 0 in each radial bin
+r = np.sqrt(pos[:,0]*pos[:,0]+pos[:,1]*pos[:,1])
+bins = np.floor(r/(rad_max/bin_num)).astype(int)
+inside = bins<bin_num
+narray = np.bincount(bins[inside], minlength=bin_num)
+specSum = np.bincount(bins[inside], weights=spec[inside], minlength=bin_num)
+specArray = specSum/np.maximum(narray,1)
 
 for x in range(0,bin_num):
-    fout.write(str((x+1)*rad_max/bin_num/2)+" "+str(narray[x]))
+    fout.write(str((x+1)*rad_max/bin_num/2)+" "+str(float(narray[x])))
     if(narray[x]==0): fout.write(" 0.0\n")
     else: fout.write(" "+str(specArray[x])+"\n")
 
 fout.close()
 
 plt.plot(rArray,specArray)
-plt.show()
\ No newline at end of file
+plt.show()
@@ -0,0 +1,86 @@
+#
+# Check that the contact candidates (Verlet lists) reused by CLBacterium
+# between rebuilds (see update_candidates) still hold every cell within
+# touching distance.
+#
+# Runs the model for n_steps, and each time contacts are found with the
+# lists kept from an earlier substep, finds the candidates again with a
+# fresh grid search and no skin, and checks that each cell's fresh
+# candidates are among its kept ones. The kept lists are then put back,
+# so the run carries on as it would have. Exits with status 1 if any are
+# missing.
+#
+# Usage: python testCandidates.py [model.py] [n_steps]
+#
+# model defaults to benchmarkColony.py with 1000 cells.
+#
+import os
+import sys
+import random
+import numpy
+import pyopencl.array as cl_array
+
+from CellModeller.Simulator import Simulator
+
+## Candidate idx sets of each of the first n cells
+def candidateSets(phys, n):
+    n_cands = phys.cell_n_cands_dev.get()[0:n]
+    cands = phys.cell_cands_dev.get()[0:n]
+    return [set(cands[i,0:min(n_cands[i], phys.max_cands)].tolist()) for i in range(n)]
+
+def main():
+    params = None
+    if len(sys.argv)>1:
+        modfilename = sys.argv[1]
+    else:
+        modfilename = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'benchmarkColony.py')
+        params = {'n_cells': 1000}
+    n_steps = int(sys.argv[2]) if len(sys.argv)>2 else 20
+
+    random.seed(1)
+    numpy.random.seed(1)
+    sim = Simulator(modfilename, 0.025, params=params)
+    sim.saveOutput = False # models may turn this on in setup()
+    phys = sim.phys
+
+    stats = {'checks': 0, 'missing': 0}
+    update = phys.update_candidates
+    def checkedUpdate(centers, lens):
+        builds = phys.n_cand_builds
+        update(centers, lens)
+        n = phys.n_cells
+        if phys.n_cand_builds != builds or n == 0:
+            return
+        # the kept lists, then a fresh search without skin
+        kept = (phys.cell_cands_dev.get(), phys.cell_n_cands_dev.get(), phys.max_cands)
+        keptSets = candidateSets(phys, n)
+        skin = phys.contact_skin
+        phys.contact_skin = 0.0
+        phys.grid_cells(centers)
+        phys.find_candidates(centers, lens)
+        phys.contact_skin = skin
+        missing = 0
+        for (i, fresh) in enumerate(candidateSets(phys, n)):
+            missing += len(fresh - keptSets[i])
+        (cands, n_cands, phys.max_cands) = kept
+        phys.cell_cands_dev = cl_array.to_device(phys.queue, cands)
+        phys.cell_n_cands_dev.set(n_cands)
+        stats['checks'] += 1
+        stats['missing'] += missing
+        if missing:
+            print("step %4i substep %2i: %i touching pair(s) missing from the kept candidates" % (
+                sim.stepNum, phys.sub_tick_i, missing))
+    phys.update_candidates = checkedUpdate
+
+    for i in range(n_steps):
+        sim.step()
+        print("step %4i %8i cells  %6i candidate builds  %6i checks of kept lists  %i missing" % (
+            sim.stepNum, phys.n_cells, phys.n_cand_builds, stats['checks'], stats['missing']))
+
+    ok = stats['missing'] == 0 and stats['checks'] > 0
+    print("Kept contact candidates %s (%i checks)" % (
+        'hold every touching pair' if ok else 'do NOT hold every touching pair', stats['checks']))
+    sys.exit(0 if ok else 1)
+
+if __name__ == '__main__':
+    main()
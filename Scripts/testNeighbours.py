@@ -0,0 +1,88 @@
+#
+# Check the neighbour lists found on the device by CLBacterium with
+# compNeighbours=True (update_neighbours) against neighbours found on the
+# host from the contacts.
+#
+# Runs the model for n_steps, and after each step builds the neighbour
+# sets from the contact arrays (ct_tos, cell_n_cts) on the host, and
+# checks that the CSR lists (cell_nbr_offsets, cell_nbrs) hold the same
+# neighbours for every cell, without duplicates, and that the neighbours
+# of the cell states are their ids. Exits with status 1 if not.
+#
+# Usage: python testNeighbours.py [model.py] [n_steps]
+#
+# model defaults to benchmarkColony.py with neighbours, 2000 cells. Other
+# models must use compNeighbours=True.
+#
+import os
+import sys
+import time
+import random
+import numpy
+
+from CellModeller.Simulator import Simulator
+
+## Neighbour idx sets of each cell, from the contacts of the last step
+def hostNeighbours(phys):
+    n = phys.n_cells
+    n_cts = phys.cell_n_cts_dev.get()[0:n]
+    ct_tos = phys.ct_tos_dev.get()[0:n]
+    nbrs = [set() for i in range(n)]
+    for i in range(n):
+        for j in ct_tos[i,0:n_cts[i]].tolist():
+            if j >= 0: # not a plane or sphere contact
+                nbrs[i].add(j)
+                nbrs[j].add(i)
+    return nbrs
+
+def main():
+    params = None
+    if len(sys.argv)>1:
+        modfilename = sys.argv[1]
+    else:
+        modfilename = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'benchmarkColony.py')
+        params = {'n_cells': 2000, 'neighbours': True}
+    n_steps = int(sys.argv[2]) if len(sys.argv)>2 else 20
+
+    random.seed(1)
+    numpy.random.seed(1)
+    sim = Simulator(modfilename, 0.025, params=params)
+    sim.saveOutput = False # models may turn this on in setup()
+    phys = sim.phys
+    if not phys.computeNeighbours:
+        print("Model %s does not compute neighbours (compNeighbours=True)" % modfilename)
+        sys.exit(1)
+
+    ok = True
+    checked = 0
+    for i in range(n_steps):
+        geom = (phys.max_cells, phys.max_contacts)
+        sim.step()
+        if (phys.max_cells, phys.max_contacts) != geom:
+            # contact arrays were reallocated after the neighbours were found
+            continue
+        t = time.time()
+        expected = hostNeighbours(phys)
+        hostTime = time.time()-t
+        offsets = phys.cell_nbr_offsets
+        bad = 0
+        for (k, nbrs) in enumerate(expected):
+            got = phys.cell_nbrs[offsets[k]:offsets[k+1]].tolist()
+            if len(got) != len(set(got)) or set(got) != nbrs:
+                bad += 1
+        for state in sim.cellStates.values():
+            ids = set([sim.idxToId[j] for j in expected[state.idx]])
+            if set(state.neighbours) != ids or state.cts != len(ids):
+                bad += 1
+        checked += 1
+        print("step %4i %8i cells %10i neighbours  %i wrong  (host check %.3f s)" % (
+            sim.stepNum, phys.n_cells, offsets[-1], bad, hostTime))
+        ok = ok and bad == 0
+
+    ok = ok and checked > 0
+    print("Device neighbour lists %s the contacts (%i steps checked)" % (
+        'match' if ok else 'do NOT match', checked))
+    sys.exit(0 if ok else 1)
+
+if __name__ == '__main__':
+    main()
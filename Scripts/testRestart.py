@@ -0,0 +1,85 @@
+#
+# Check that a simulation restarted with Simulator.saveState/loadState
+# follows exactly the same trajectory as one run without interruption.
+#
+# Runs the model for n_steps, saving the state after n_save steps, then
+# loads that state into a new Simulator and runs the remaining steps.
+# Cell positions, directions, lengths and ids, the lineage, and the
+# species levels must match bit for bit. Exits with status 1 if not.
+#
+# Usage: python testRestart.py [model.py] [n_save] [n_steps]
+#
+# model defaults to Examples/ex1_simpleGrowth.py.
+#
+import os
+import sys
+import random
+import tempfile
+import numpy
+
+from CellModeller.Simulator import Simulator
+
+def make_sim(modname):
+    sim = Simulator(modname, 0.025, saveOutput=False)
+    sim.saveOutput = False # models may turn this on in setup()
+    return sim
+
+def trajectory(sim):
+    ids = sorted(sim.cellStates.keys())
+    states = [sim.cellStates[cid] for cid in ids]
+    traj = {'ids': numpy.array(ids),
+            'pos': numpy.array([s.pos for s in states]),
+            'dir': numpy.array([s.dir for s in states]),
+            'length': numpy.array([s.length for s in states]),
+            'lineage': sorted(sim.lineage.items())}
+    if sim.integ:
+        traj['species'] = numpy.array([s.species for s in states])
+    return traj
+
+def main():
+    if len(sys.argv)>1:
+        modfilename = sys.argv[1]
+    else:
+        modfilename = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                   '..', 'Examples', 'ex1_simpleGrowth.py')
+    n_save = int(sys.argv[2]) if len(sys.argv)>2 else 150
+    n_steps = int(sys.argv[3]) if len(sys.argv)>3 else 250
+
+    random.seed(1)
+    numpy.random.seed(1)
+    sim = make_sim(modfilename)
+    for i in range(n_save):
+        sim.step()
+    (fd, statefile) = tempfile.mkstemp(suffix='.state')
+    os.close(fd)
+    try:
+        sim.saveState(statefile)
+        for i in range(n_save, n_steps):
+            sim.step()
+        expected = trajectory(sim)
+
+        # scramble the random number generators, loadState should restore them
+        random.seed(2)
+        numpy.random.seed(2)
+        sim = make_sim(modfilename)
+        sim.loadState(statefile)
+        for i in range(n_save, n_steps):
+            sim.step()
+        got = trajectory(sim)
+    finally:
+        os.remove(statefile)
+
+    ok = True
+    for (name, val) in expected.items():
+        if isinstance(val, numpy.ndarray):
+            same = val.shape == got[name].shape and (val == got[name]).all()
+        else:
+            same = val == got[name]
+        print("%-10s %s" % (name, 'same' if same else 'DIFFERENT'))
+        ok = ok and same
+    print("Restarted run %s the uninterrupted run (%i cells after %i steps)" % (
+        'matches' if ok else 'does NOT match', len(expected['ids']), n_steps))
+    sys.exit(0 if ok else 1)
+
+if __name__ == '__main__':
+    main()
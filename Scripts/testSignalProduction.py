@@ -0,0 +1,75 @@
+#
+# Check that the signal production of the cells, summed into the diffusion
+# grid on the device (signalProduction of the signalling integrators),
+# agrees with the reduction on the host (hostSignalProduction) that it
+# replaced.
+#
+# Runs the model for n_steps, and after each step compares the device sum
+# of the cell signal rates of that step with an exact (double precision)
+# sum, and with the host reduction. Sums are in a different order, so
+# agree to within a tolerance relative to the largest production, rather
+# than bit for bit. The host reduction differences cumulative sums over
+# all the cells, so loses precision as the colony grows, and is held to
+# a looser tolerance (1e-3). Exits with status 1 if either is exceeded.
+#
+# Usage: python testSignalProduction.py [model.py] [n_steps] [tolerance]
+#
+# model defaults to benchmarkColony.py with signalling, 2000 cells.
+#
+import os
+import sys
+import random
+import numpy
+
+from CellModeller.Simulator import Simulator
+from CellModeller.Integration.CLCrankNicIntegrator import hostSignalProduction
+
+def main():
+    params = None
+    if len(sys.argv)>1:
+        modfilename = sys.argv[1]
+    else:
+        modfilename = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'benchmarkColony.py')
+        params = {'n_cells': 2000, 'signalling': True}
+    n_steps = int(sys.argv[2]) if len(sys.argv)>2 else 20
+    tolerance = float(sys.argv[3]) if len(sys.argv)>3 else 1e-5
+
+    random.seed(1)
+    numpy.random.seed(1)
+    sim = Simulator(modfilename, 0.025, params=params)
+    sim.saveOutput = False # models may turn this on in setup()
+    integ = sim.integ
+    if not hasattr(integ, 'signalProduction'):
+        print("Model %s has no signalling integrator" % modfilename)
+        sys.exit(1)
+
+    hostTolerance = 1e-3
+    worst = 0.0
+    worstHost = 0.0
+    for i in range(n_steps):
+        sim.step()
+        n = integ.nCells
+        got = integ.signalProduction()
+        gridIdxs = integ.gridIdxs_dev.get()[0:n]
+        cellSigRates = integ.cellSigRates_dev.get()[0:n]
+        exact = numpy.zeros((integ.nSignals, integ.gridTotalSize))
+        for s in range(integ.nSignals):
+            numpy.add.at(exact[s], gridIdxs.reshape(n*8), cellSigRates[:,:,s].reshape(n*8))
+        host = hostSignalProduction(gridIdxs, cellSigRates, integ.nSignals, integ.gridTotalSize)
+        scale = max(numpy.abs(exact).max(), 1e-30)
+        err = numpy.abs(got-exact).max()/scale
+        errHost = numpy.abs(got-host).max()/scale
+        worst = max(worst, err)
+        worstHost = max(worstHost, errHost)
+        print("step %4i %8i cells  max production %12.6g  relative difference %.3g (exact) %.3g (host)" % (
+            sim.stepNum, n, scale, err, errHost))
+
+    ok = worst <= tolerance and worstHost <= hostTolerance
+    print("Device signal production %s the exact sum (worst relative difference %.3g, tolerance %g)" % (
+        'matches' if worst <= tolerance else 'does NOT match', worst, tolerance))
+    print("Device signal production %s the host reduction (worst relative difference %.3g, tolerance %g)" % (
+        'matches' if worstHost <= hostTolerance else 'does NOT match', worstHost, hostTolerance))
+    sys.exit(0 if ok else 1)
+
+if __name__ == '__main__':
+    main()
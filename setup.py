@@ -32,6 +32,9 @@ setup(
         'CellModeller.GUI'
     ],
     package_data={'': ['*.cl', '*.ui']},
+    entry_points={
+        'console_scripts': ['cellmodeller-batch=CellModeller.Batch:main']
+    },
     python_requires='>=3',
     version=str(version_git)
 )